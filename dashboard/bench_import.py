@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''Import-time benchmark for the dashboard. imports webapp in fresh interpreters,
+reports the median wall time and the slowest modules from python -X importtime, and
+exits with status 1 if the median is over --max-seconds, so it can run as a CI check.
+run from the dashboard directory:
+
+    python bench_import.py --runs 5 --max-seconds 2 --json import_time.json
+'''
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+#must not be imported just by loading the app
+SERVING_BLACKLIST = ['seaborn', 'folium', 'sklearn', 'matplotlib.pyplot']
+
+
+def import_once(module):
+    '''Import module in a new interpreter
+
+    Returns
+    -------
+    seconds: float
+        wall time of the whole interpreter run
+    cumulative: dict
+        module name to cumulative import time in seconds, from -X importtime
+    '''
+    start = time.time()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    seconds = time.time() - start
+
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        #import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cum, name = line[len('import time:'):].split('|')
+        cumulative[name.strip()] = int(cum) / 1e6
+
+    return seconds, cumulative
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure how long importing the dashboard takes')
+    parser.add_argument('--module', default='webapp')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--max-seconds', type=float, default=None)
+    parser.add_argument('--json', default=None, help='also write the results to this file')
+    args = parser.parse_args()
+
+    times = []
+    for i in range(args.runs):
+        seconds, cumulative = import_once(args.module)
+        times.append(seconds)
+
+    top = sorted(cumulative.items(), key=lambda item: -item[1])[:args.top]
+    loaded = [name for name in SERVING_BLACKLIST if name in cumulative]
+
+    results = {'module' : args.module,
+               'runs' : args.runs,
+               'median_seconds' : float(np.median(times)),
+               'min_seconds' : float(np.min(times)),
+               'max_seconds' : float(np.max(times)),
+               'slowest_modules' : top,
+               'unwanted_imports' : loaded}
+
+    print('import %s: median %.2fs, min %.2fs, max %.2fs over %d runs'
+          % (args.module, results['median_seconds'], results['min_seconds'], results['max_seconds'], args.runs))
+    for name, seconds in top:
+        print('  %7.3fs  %s' % (seconds, name))
+    if loaded:
+        print('imported on the serving path: %s' % ', '.join(loaded))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if loaded or (args.max_seconds is not None and results['median_seconds'] > args.max_seconds):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+'''Local load test. hits a running dashboard (see serve.py) from many threads at once
+and reports throughput, latency percentiles and status codes:
+
+    python loadtest.py --url http://localhost:5000 --concurrency 32 --seconds 30
+
+by default every client asks for the same handful of views, which exercises request
+coalescing; --distinct gives every request different parameters instead
+'''
+import argparse
+import threading
+import time
+from collections import Counter
+from datetime import date, timedelta
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import numpy as np
+
+
+def make_paths(distinct):
+    '''Request paths to cycle through. with distinct, every prediction date differs
+    '''
+    stop_types = ['Pickups and Deliveries', 'Deliveries', 'Pickups']
+    heatmaps = ['/heatmap/?' + urlencode({'startdate' : '1/5/2015', 'enddate' : '7/1/2015',
+                                           'zipcode' : 'all', 'pickup_deliv' : stop_type})
+                for stop_type in stop_types]
+
+    n_dates = 150 if distinct else 1
+    dates = [(date(2015, 8, 1) + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(n_dates)]
+    predictions = ['/predict?' + urlencode({'date_to_predict' : day, 'zipcode_to_predict' : 'all',
+                                            'pickup_deliv_predict' : stop_type})
+                   for day in dates for stop_type in stop_types]
+    forecasts = ['/forecast?' + urlencode([('stop_type', stop_type), ('start', dates[0]), ('days', 14)])
+                 for stop_type in stop_types]
+
+    return heatmaps + predictions + forecasts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the dashboard')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--distinct', action='store_true')
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    paths = make_paths(args.distinct)
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    stop_at = time.time() + args.seconds
+
+    def client(n):
+        i = n
+        while time.time() < stop_at:
+            path = paths[i % len(paths)]
+            i += args.concurrency
+            start = time.time()
+            try:
+                with urlopen(args.url + path, timeout=args.timeout) as r:
+                    r.read()
+                    status = r.status
+            except HTTPError as e:
+                status = e.code
+            except (URLError, OSError):
+                status = 'error'
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] += 1
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(args.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - start
+
+    latencies = np.array(latencies) * 1000.
+    ok = statuses.get(200, 0) + statuses.get(304, 0)
+    print('%d requests in %.1fs from %d clients' % (len(latencies), wall, args.concurrency))
+    print('throughput: %.1f requests/s (%.1f successful/s)' % (len(latencies) / wall, ok / wall))
+    if len(latencies):
+        print('latency ms: p50 %.0f  p90 %.0f  p99 %.0f  max %.0f'
+              % tuple(np.percentile(latencies, [50, 90, 99, 100])))
+    print('status codes: %s' % dict(statuses))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+'''Render the most requested heatmaps and prediction plots into the figure cache.
+run from the dashboard directory at deploy time, after the data files are in place:
+
+    python prerender.py
+
+every worker then serves these from the on-disk cache instead of rendering them
+'''
+import time
+import pandas as pd
+from webapp.matplotlib_funcs import heatmap_png, prediction_png, forecast_end
+from webapp.matplotlib_funcs import heatmap_key, prediction_key, HEATMAP_PATHS, FORECAST_DAYS
+from webapp.figcache import figures
+
+#the defaults of the hourly_volume and prediction pages
+HEATMAP_RANGES = [('1/5/2015', '7/2/2015'), ('1/5/2015', '7/1/2015')]
+PREDICTION_PAGE_DATE = '2015-11-11'
+
+
+def prediction_dates(stop_type):
+    #the first day after the data, and the page's default while the forecast still reaches it
+    end = pd.Timestamp(forecast_end(stop_type))
+    dates = [(end - pd.Timedelta(days=FORECAST_DAYS - 1)).strftime('%Y-%m-%d')]
+    if pd.Timestamp(PREDICTION_PAGE_DATE) <= end and PREDICTION_PAGE_DATE not in dates:
+        dates.append(PREDICTION_PAGE_DATE)
+    return dates
+
+
+for stop_type in sorted(HEATMAP_PATHS):
+    for startdate, enddate in HEATMAP_RANGES:
+        start = time.time()
+        figures.get_or_render(heatmap_key(stop_type, startdate, enddate, zipcode='all'),
+                              lambda: heatmap_png(stop_type, startdate, enddate, zipcode='all'))
+        print('heatmap %s %s-%s: %.2fs' % (stop_type, startdate, enddate, time.time() - start))
+
+    for date_to_predict in prediction_dates(stop_type):
+        start = time.time()
+        figures.get_or_render(prediction_key(stop_type, 'all', date_to_predict),
+                              lambda: prediction_png(stop_type, 'all', date_to_predict))
+        print('predict %s %s: %.2fs' % (stop_type, date_to_predict, time.time() - start))
+
+print(figures.stats())
@@ -1,3 +1,10 @@
 #!/usr/bin/env python
+import os
+
 from webapp import app
-app.run(debug = True)
\ No newline at end of file
+from webapp.warmup import start_warmup
+
+#the reloader runs the app in a child process, only that one needs warming up
+if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    start_warmup()
+app.run(debug = True)
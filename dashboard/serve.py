@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+'''Production entry point. serves the dashboard with a pool of request threads and
+sends fits, renders and aggregations to a pool of worker processes (webapp/offload.py).
+run from the dashboard directory:
+
+    python serve.py --port 5000 --threads 16 --workers 4
+
+uses waitress if it is installed, otherwise the threaded werkzeug server. every request
+logs a json line with its time in each stage; set PROFILE_SLOW_MS to keep a sampled
+profile of the requests slower than that (see webapp/metrics.py)
+'''
+import argparse
+import logging
+
+from webapp import app
+from webapp.offload import pool
+from webapp.matplotlib_funcs import cache_stats
+from webapp.warmup import warmup, start_warmup
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the dashboard')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=16,
+                        help='request threads')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes for CPU-bound work, default one per cpu')
+    parser.add_argument('--max-queue', type=int, default=None,
+                        help='computations running or waiting before requests get a 503, default 4 per worker')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds a request waits for its computation')
+    parser.add_argument('--retry-after', type=int, default=5,
+                        help='Retry-After seconds sent with a 503')
+    args = parser.parse_args()
+
+    #request timing lines are already json
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    #listen right away. the data is loaded and the workers started and warmed up in
+    #the background, and /ready answers 503 until they are
+    pool.configure(max_workers=args.workers, max_queue=args.max_queue,
+                   timeout=args.timeout, retry_after=args.retry_after, initializer=warmup,
+                   report=cache_stats)
+    start_warmup(pool=pool)
+
+    try:
+        from waitress import serve
+    except ImportError:
+        app.run(host=args.host, port=args.port, threaded=True, debug=False)
+    else:
+        serve(app, host=args.host, port=args.port, threads=args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+'''Soak test for the plotting views. renders /heatmap/ and /predict over and over,
+with the figure cache turned off so every request draws a new figure, and prints
+the resident memory of the process as it goes. run from the dashboard directory:
+
+    python soak.py --requests 10000 --threads 4
+
+memory should level off after the first requests. exits with status 1 if it grew
+by more than --max-growth-mb between the first tenth of the run and the end
+'''
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from webapp import app
+from webapp.figcache import figures
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1e6
+
+
+def request_urls(n):
+    '''n urls cycling through a mix of heatmap and prediction views
+    '''
+    stop_types = ['Pickups and Deliveries', 'Deliveries', 'Pickups']
+    starts = [date.strftime('%m/%d/%Y') for date in pd.date_range('1/5/2015', '3/1/2015', freq='7D')]
+    predict_dates = [date.strftime('%Y-%m-%d') for date in pd.date_range('2015-08-01', '2015-12-31', freq='D')]
+
+    urls = []
+    for i in range(n):
+        stop_type = stop_types[i % len(stop_types)]
+        if i % 2 == 0:
+            urls.append(('/heatmap/', {'startdate' : starts[i % len(starts)], 'enddate' : '7/1/2015',
+                                       'zipcode' : 'all', 'pickup_deliv' : stop_type}))
+        else:
+            urls.append(('/predict', {'date_to_predict' : predict_dates[i % len(predict_dates)],
+                                      'zipcode_to_predict' : 'all', 'pickup_deliv_predict' : stop_type}))
+    return urls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--report-every', type=int, default=500)
+    parser.add_argument('--max-growth-mb', type=float, default=50.)
+    args = parser.parse_args()
+
+    #render every time, nothing kept between requests
+    figures.directory = None
+    figures.maxsize = 0
+
+    clients = dict((i, app.test_client()) for i in range(args.threads))
+
+    def fetch(job):
+        i, (url, params) = job
+        r = clients[i % args.threads].get(url, query_string=params)
+        if r.status_code != 200:
+            raise ValueError('%s %s returned %d' % (url, params, r.status_code))
+        return i
+
+    start = time.time()
+    baseline = None
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        for i in pool.map(fetch, enumerate(request_urls(args.requests))):
+            done = i + 1
+            if done == max(1, args.requests // 10):
+                baseline = rss_mb()
+            if done % args.report_every == 0 or done == args.requests:
+                print('%6d requests  %7.1fs  rss %.1f MB' % (done, time.time() - start, rss_mb()))
+                sys.stdout.flush()
+
+    growth = rss_mb() - baseline
+    print('rss growth after the first %d requests: %.1f MB' % (max(1, args.requests // 10), growth))
+    if growth > args.max_growth_mb:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
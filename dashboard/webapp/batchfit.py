@@ -0,0 +1,193 @@
+# coding: utf-8
+
+'''Fit the forecast regression for every zipcode and region at once
+
+Every series of a stop type is regressed on the same design matrix, so instead of
+one LinearRegression fit per series the design matrix is factorized once (SVD) and
+all series are solved together as one multi-output least-squares problem. The
+solution is the same minimum-norm least-squares fit LinearRegression finds, so
+predictions match the per-series fits to numerical tolerance.
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from webapp.datastore import store
+from webapp.storage import MappedTable, zip_label
+from webapp.matplotlib_funcs import (STOP_TYPES, regression_design, lasso_features, forecast_end,
+                                     fill_closed_days, market_closed_days)
+from webapp.regions import REGION_PREFIXES, rollup_rows
+from webapp.metrics import timer
+
+
+class BatchLinearRegression(object):
+    '''Ordinary least squares with an intercept, for many outputs sharing one X
+
+    Parameters
+    ----------
+    rcond: float
+        singular values below rcond times the largest are treated as zero, which
+        is what makes collinear dummy features solvable. default matches
+        numpy.linalg.lstsq
+    '''
+
+    def __init__(self, rcond=None):
+        self.rcond = rcond
+
+    def fit(self, X, Y):
+        '''Fit every column of Y on X
+
+        Parameters
+        ----------
+        X: array, n_samples x n_features
+        Y: array, n_samples x n_outputs, or n_samples for a single output
+
+        Returns
+        -------
+        self, with coef_ (n_outputs x n_features) and intercept_ (n_outputs) set
+        '''
+        X = np.asarray(X, dtype=float)
+        Y = np.asarray(Y, dtype=float)
+        single = Y.ndim == 1
+        if single:
+            Y = Y[:, None]
+
+        #centering takes care of the intercept, as in LinearRegression
+        X_offset = X.mean(axis=0)
+        Y_offset = Y.mean(axis=0)
+        Xc = X - X_offset
+
+        #one factorization for all outputs
+        U, s, Vt = np.linalg.svd(Xc, full_matrices=False)
+        rcond = self.rcond if self.rcond is not None else np.finfo(float).eps * max(Xc.shape)
+        keep = s > rcond * s[0]
+        s_inv = np.zeros_like(s)
+        s_inv[keep] = 1. / s[keep]
+
+        coef = np.dot(Vt.T * s_inv, np.dot(U.T, Y - Y_offset))
+
+        self.coef_ = coef.T
+        self.intercept_ = Y_offset - np.dot(X_offset, coef)
+        self.rank_ = int(keep.sum())
+        self.singular_ = s
+        if single:
+            self.coef_ = self.coef_[0]
+            self.intercept_ = self.intercept_[0]
+
+        return self
+
+    def predict(self, X):
+        '''Predictions for every output, n_samples x n_outputs
+        '''
+        return np.dot(np.asarray(X, dtype=float), self.coef_.T) + self.intercept_
+
+
+def load_all_series(outdir, table):
+    '''Daily counts for every zipcode in a count table and every region rolled up
+    from it, as one dates x series dataframe
+    '''
+    counts = store.get(outdir + 'di_%s_allcounts' % table, MappedTable)
+    names = counts.names()
+    series = [np.asarray(counts.column(name), dtype=float) for name in names]
+    columns = [zip_label(name) for name in names]
+
+    regions_path = outdir + 'di_%s_regions' % table
+    if os.path.exists(regions_path):
+        regions = store.get(regions_path, MappedTable)
+        #on the dates of the count table they were rolled up from
+        rows = rollup_rows(counts, regions)
+        for name in regions.names():
+            series.append(np.asarray(regions.column(name), dtype=float)[rows])
+            columns.append(name)
+
+    return pd.DataFrame(np.column_stack(series), index=counts.index(), columns=columns)
+
+
+def batch_forecasts(stop_type, outdir='', futuredate=None):
+    '''Fit the lasso-feature regression for every zipcode and region of a stop type in
+    one step, and predict through futuredate
+
+    Gives the same y, y_pred and y_pred_future as matplotlib_funcs.fit_lassocoefs_model
+    run once per series.
+
+    Parameters
+    ----------
+    stop_type: string
+        'Pickups and Deliveries', 'Deliveries' or 'Pickups'
+    outdir: string
+        place where the dataprep tables are stored
+    futuredate: string
+        last date to predict. default matplotlib_funcs.forecast_end
+
+    Returns
+    -------
+    forecasts: dict
+        'y', 'y_pred' and 'y_pred_future' dataframes with one column per series,
+        'coefs' (series x features, zero where a series doesn't use a feature),
+        'intercepts' (series) and 'lr_fit', the BatchLinearRegression fitted with
+        the whole market's features
+    '''
+    table = STOP_TYPES[stop_type][0]
+    with timer('load'):
+        #every series in the batch shares the whole market's selection
+        feature_list = lasso_features(outdir, stop_type)
+
+        Y = load_all_series(outdir, table)
+
+    #get rid of the zeros of days the business was closed, like july 4th
+    with timer('filter'):
+        Y = fill_closed_days(Y, market_closed_days(outdir, table))
+
+    mindate = Y.index.min()
+    maxdate = Y.index.max()
+    if futuredate is None:
+        futuredate = forecast_end(stop_type, outdir)
+
+    with timer('features'):
+        date_frame, X_vars, X, X_vars_future, X_future = regression_design(mindate, maxdate, futuredate, feature_list)
+
+    with timer('fit'):
+        lr_fit = BatchLinearRegression().fit(X, Y.values)
+
+    with timer('predict'):
+        future_dates = date_frame.loc[X_vars_future.index, 'daterange_str']
+        y_pred = pd.DataFrame(lr_fit.predict(X), index=Y.index, columns=Y.columns)
+        y_pred_future = pd.DataFrame(lr_fit.predict(X_future), index=future_dates.values, columns=Y.columns)
+
+    coefs = pd.DataFrame(lr_fit.coef_, index=Y.columns, columns=feature_list)
+    intercepts = pd.Series(lr_fit.intercept_, index=Y.columns)
+
+    #cities and clusters lassoselect made their own selection for are refitted with
+    #it, a batch per distinct selection, so they match fit_lassocoefs_model
+    groups = {}
+    for name in Y.columns:
+        if name.startswith(REGION_PREFIXES):
+            own = tuple(lasso_features(outdir, stop_type, name))
+            if list(own) != feature_list:
+                groups.setdefault(own, []).append(name)
+
+    for own, names in groups.items():
+        own = list(own)
+        with timer('features'):
+            _, _, X, _, X_future = regression_design(mindate, maxdate, futuredate, own)
+        with timer('fit'):
+            group_fit = BatchLinearRegression().fit(X, Y[names].values)
+        with timer('predict'):
+            y_pred[names] = group_fit.predict(X)
+            y_pred_future[names] = group_fit.predict(X_future)
+
+        for feature in own:
+            if feature not in coefs.columns:
+                coefs[feature] = 0.
+        coefs.loc[names, :] = 0.
+        coefs.loc[names, own] = group_fit.coef_
+        intercepts[names] = group_fit.intercept_
+
+    return {'y' : Y,
+            'y_pred' : y_pred,
+            'y_pred_future' : y_pred_future,
+            'coefs' : coefs,
+            'intercepts' : intercepts,
+            'lr_fit' : lr_fit}
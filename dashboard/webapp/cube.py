@@ -0,0 +1,113 @@
+# coding: utf-8
+
+'''Hour x day-of-week heatmap counts from the event cubes written by dataprep
+
+A cube holds, for every date and hour, the running total of events on that day of
+week over all zipcodes, and each zipcode's counts by date and hour as a sparse list
+(see dataprep.event_cube). The counts for any date range are one difference per day
+of week, or a sum over one zipcode's entries in the range, so a heatmap never
+touches the individual events. Cubes written before the sparse format, one dense
+running-total array for every zipcode, are still read.
+'''
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from webapp.datastore import store
+from webapp.storage import table_dir
+
+
+CUBE_ARRAYS = ('total', 'zip_ptr', 'keys', 'counts')
+
+
+def load_cube(path):
+    '''Memory-map the arrays of the cube saved in path and load its metadata, with
+    'slots', the position of each zipcode
+    '''
+    path = table_dir(path)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    if 'format' not in meta:
+        #dense cube, slot 0 for all zipcodes
+        arrays = {'cube' : np.load(os.path.join(path, 'cube.npy'), mmap_mode='r')}
+        meta['slots'] = dict((zipcode, i + 1) for i, zipcode in enumerate(meta['zipcodes']))
+    else:
+        arrays = dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r')) for name in CUBE_ARRAYS)
+        meta['slots'] = dict((zipcode, i) for i, zipcode in enumerate(meta['zipcodes']))
+
+    return arrays, meta
+
+
+def running_counts(totals, first, last, start_dayofweek):
+    '''Counts by hour and day of week between days first and last, from days x 24
+    running totals within each day of week
+    '''
+    counts = np.zeros((24, 7))
+    #the last seven days of the range cover each day of week once
+    for day in range(last, max(last - 7, first - 1), -1):
+        dayofweek = (start_dayofweek + day) % 7
+        #same day of week, one week before the first one in the range
+        before = day - 7 * ((day - first) // 7 + 1)
+        counts[:, dayofweek] = totals[day] - (totals[before] if before >= 0 else 0)
+    return counts
+
+
+def sparse_counts(arrays, slot, first, last, start_dayofweek):
+    '''Counts by hour and day of week between days first and last, from one
+    zipcode's (day * 24 + hour, count) entries
+    '''
+    lo, hi = arrays['zip_ptr'][slot], arrays['zip_ptr'][slot + 1]
+    keys = arrays['keys'][lo:hi]
+    #entries are ordered by day and hour
+    start = lo + np.searchsorted(keys, first * 24, side='left')
+    stop = lo + np.searchsorted(keys, (last + 1) * 24, side='left')
+
+    keys = np.asarray(arrays['keys'][start:stop], dtype=np.int64)
+    dayofweek = (start_dayofweek + keys // 24) % 7
+    counts = np.bincount((keys % 24) * 7 + dayofweek, weights=arrays['counts'][start:stop], minlength=24 * 7)
+    return counts.reshape(24, 7)
+
+
+def heatmap_counts(path, mindate, maxdate, zipcode=None):
+    '''Count events by hour and day of week between two dates
+
+    Parameters
+    ----------
+    path: string
+        directory holding the cube
+    mindate, maxdate: strings
+        first and last day of the range, inclusive
+    zipcode: string
+        only count events in this zipcode. default counts all zipcodes
+
+    Returns
+    -------
+    counts: pandas dataframe
+        one row per hour (0-23) and one column per day of week (monday is 0)
+    '''
+    arrays, meta = store.get(path, load_cube)
+    start = pd.Timestamp(meta['start'])
+    dense = 'cube' in arrays
+    n_days = arrays['cube'].shape[0] if dense else arrays['total'].shape[0]
+
+    #clip the range to the days in the cube
+    first = max((pd.Timestamp(mindate) - start).days, 0)
+    last = min((pd.Timestamp(maxdate) - start).days, n_days - 1)
+
+    counts = np.zeros((24, 7))
+    if zipcode is None:
+        totals = arrays['cube'][:, 0] if dense else arrays['total']
+        counts = running_counts(totals, first, last, meta['start_dayofweek'])
+    elif str(zipcode) in meta['slots'] and last >= first:
+        slot = meta['slots'][str(zipcode)]
+        if dense:
+            counts = running_counts(arrays['cube'][:, slot], first, last, meta['start_dayofweek'])
+        else:
+            counts = sparse_counts(arrays, slot, first, last, meta['start_dayofweek'])
+
+    return pd.DataFrame(counts, index=pd.Index(np.arange(0, 24, 1), name='hour'),
+                        columns=pd.Index(np.arange(0, 7, 1), name='dayofweek'))
@@ -0,0 +1,205 @@
+# coding: utf-8
+
+'''Process-wide store for the data files the dashboard reads
+
+Each artifact is loaded once per process and handed out to every request after
+that. Before handing it out the store stats the file, and reloads it only if the
+file has changed on disk and its contents hash differently, so a plain touch does
+not trigger a reload. Loaders that memory-map their files (storage.MappedTable,
+cube.load_cube) leave the data in the page cache, where every worker process
+shares one read-only copy.
+
+Tables saved with storage.write_table are checked and loaded through the version
+directory their CURRENT file names, so a loaded table never mixes two versions. If
+a file disappears while it is being checked (a writer replacing it), the artifact
+already loaded keeps being served, and the next request picks up the new one.
+'''
+
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from webapp.storage import table_dir
+
+
+#attempts to load an artifact that is being replaced, when there is none loaded yet
+RETRIES = 3
+RETRY_SECONDS = 0.05
+
+
+def fingerprint(path):
+    '''Cheap change check: size and modification time of the file, or of every file
+    in the directory
+    '''
+    if os.path.isdir(path):
+        names = sorted(os.listdir(path))
+        stats = [(name, os.stat(os.path.join(path, name))) for name in names]
+    else:
+        stats = [(os.path.basename(path), os.stat(path))]
+
+    return tuple((name, st.st_size, st.st_mtime_ns) for name, st in stats)
+
+
+def content_hash(path):
+    '''sha1 of the contents of the file, or of every file in the directory
+    '''
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    else:
+        files = [path]
+
+    digest = hashlib.sha1()
+    for name in files:
+        digest.update(os.path.basename(name).encode('utf-8'))
+        with open(name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def memory_size(value):
+    '''Bytes held by a loaded artifact, as (private, mapped). mapped bytes live in
+    memory-mapped files and are shared between processes
+    '''
+    if hasattr(value, 'memory_size'):
+        return value.memory_size()
+    if isinstance(value, np.memmap):
+        return 0, value.nbytes
+    if isinstance(value, np.ndarray):
+        return value.nbytes, 0
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum()), 0
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True)), 0
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (tuple, list)):
+        sizes = [memory_size(item) for item in value]
+        return sum(size[0] for size in sizes), sum(size[1] for size in sizes)
+    return 0, 0
+
+
+class MissingArtifact(FileNotFoundError):
+    '''Raised when a data file the dashboard needs has not been built
+
+    Parameters
+    ----------
+    path: string
+        the missing file or directory
+    producer: string
+        the script that writes it
+    '''
+
+    def __init__(self, path, producer):
+        FileNotFoundError.__init__(self, '%s is missing, run %s to build it' % (path, producer))
+        self.path = path
+        self.producer = producer
+
+    def __reduce__(self):
+        #raised in the offload workers too, and sent back to the request thread
+        return MissingArtifact, (self.path, self.producer)
+
+
+class DataStore(object):
+    '''Cache of loaded artifacts keyed by (path, loader)
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, path, loader):
+        '''Return loader(path), loading it only the first time or after path has changed
+
+        Parameters
+        ----------
+        path: string
+            file or directory the artifact is loaded from
+        loader: function
+            called with path to load the artifact, or for a table saved with
+            storage.write_table, with the directory of its current version
+        '''
+        key = (path, loader.__name__)
+
+        for attempt in range(RETRIES):
+            try:
+                return self._get(key, path, loader)
+            except FileNotFoundError:
+                #a writer swapped the file out between our reads
+                entry = self.entries.get(key)
+                if entry is not None:
+                    return entry['value']
+                if attempt == RETRIES - 1:
+                    raise
+                time.sleep(RETRY_SECONDS)
+
+    def _get(self, key, path, loader):
+        #a table's current version directory, so the stamp, hash and value agree
+        source = table_dir(path) if os.path.isdir(path) else path
+        stamp = (source, fingerprint(source))
+
+        entry = self.entries.get(key)
+        if entry is not None and entry['fingerprint'] == stamp:
+            return entry['value']
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['fingerprint'] == stamp:
+                return entry['value']
+
+            digest = content_hash(source)
+            if entry is not None and entry['hash'] == digest and entry['fingerprint'][0] == source:
+                #touched but not changed
+                entry['fingerprint'] = stamp
+                return entry['value']
+
+            #a rewritten table with the same contents keeps its hash, so versions built
+            #on it don't change, but is reloaded from its new directory
+            start = time.time()
+            value = loader(source)
+            load_seconds = time.time() - start
+
+            self.entries[key] = {'value' : value,
+                                 'fingerprint' : stamp,
+                                 'hash' : digest,
+                                 'load_seconds' : load_seconds,
+                                 'loaded_at' : time.time(),
+                                 'loads' : entry['loads'] + 1 if entry is not None else 1}
+
+            return value
+
+    def version(self, path, loader):
+        '''Content hash of path as currently loaded by loader, loading it if needed
+        '''
+        self.get(path, loader)
+        return self.entries[(path, loader.__name__)]['hash']
+
+    def stats(self):
+        '''Load time, number of loads and memory held, for every artifact in the store
+        '''
+        stats = []
+        for (path, loader), entry in sorted(self.entries.items()):
+            #memory-mapped tables map more columns as they are used
+            private, mapped = memory_size(entry['value'])
+            stats.append({'path' : path,
+                          'loader' : loader,
+                          'loads' : entry['loads'],
+                          'load_seconds' : entry['load_seconds'],
+                          'loaded_at' : entry['loaded_at'],
+                          'private_bytes' : private,
+                          'mapped_bytes' : mapped})
+
+        return stats
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+
+#shared by every request in this process
+store = DataStore()
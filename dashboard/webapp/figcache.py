@@ -0,0 +1,158 @@
+# coding: utf-8
+
+'''Cache of rendered PNG figures
+
+A heatmap or prediction plot is fully determined by its query parameters and the
+versions of the data it was drawn from, so each rendered image is kept under a key
+made of both: in memory for this process, and on disk so other workers and
+restarts (and images pre-rendered at deploy time, see prerender.py) can reuse it.
+The ETag sent with each image is the hash of its key, so browsers can revalidate
+with If-None-Match and get a 304 without anything being rendered.
+'''
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+from webapp.metrics import timer
+
+
+def figure_etag(key):
+    '''Stable hash of a cache key, the same in every process
+    '''
+    return hashlib.sha1(json.dumps(key, default=str).encode('utf-8')).hexdigest()
+
+
+def render_png(fig):
+    '''Save a matplotlib figure as PNG bytes
+    '''
+    imgIO = BytesIO()
+    with timer('render'):
+        fig.savefig(imgIO, bbox_inches='tight')
+
+    return imgIO.getvalue()
+
+
+class FigureCache(object):
+    '''Bounded in-memory and on-disk LRU cache of rendered images
+
+    Parameters
+    ----------
+    directory: string
+        where images are saved. if None, images are only kept in memory
+    maxsize: int
+        number of images kept in memory
+    max_files: int
+        number of images kept on disk, the least recently written are removed first
+    '''
+
+    def __init__(self, directory=None, maxsize=256, max_files=2000):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.images = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.render_seconds = 0.
+
+    def _file(self, etag):
+        return os.path.join(self.directory, etag + '.png')
+
+    def _remember(self, etag, png, last_modified):
+        with self.lock:
+            self.images[etag] = (png, last_modified)
+            self.images.move_to_end(etag)
+            while len(self.images) > self.maxsize:
+                self.images.popitem(last=False)
+
+    def _read_disk(self, etag):
+        if self.directory is None or not os.path.exists(self._file(etag)):
+            return None
+        with open(self._file(etag), 'rb') as f:
+            png = f.read()
+        return png, os.path.getmtime(self._file(etag))
+
+    def _write_disk(self, etag, png):
+        if self.directory is None:
+            return
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        #write then rename, so other workers never read half an image
+        tmp_file = self._file(etag) + '.%d.tmp' % os.getpid()
+        with open(tmp_file, 'wb') as f:
+            f.write(png)
+        os.replace(tmp_file, self._file(etag))
+
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.png')]
+        if len(files) > self.max_files:
+            files.sort(key=os.path.getmtime)
+            for name in files[:len(files) - self.max_files]:
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+
+    def lookup(self, key):
+        '''Return (png, etag, last_modified) for key if the image has been rendered,
+        otherwise (None, etag, None)
+        '''
+        etag = figure_etag(key)
+
+        with self.lock:
+            if etag in self.images:
+                self.images.move_to_end(etag)
+                self.hits += 1
+                png, last_modified = self.images[etag]
+                return png, etag, last_modified
+
+        found = self._read_disk(etag)
+        if found is None:
+            return None, etag, None
+
+        self.disk_hits += 1
+        self._remember(etag, found[0], found[1])
+        return found[0], etag, found[1]
+
+    def get_or_render(self, key, render):
+        '''Return (png, etag, last_modified) for key, calling render() for the PNG bytes
+        if it is not cached
+        '''
+        png, etag, last_modified = self.lookup(key)
+        if png is not None:
+            return png, etag, last_modified
+
+        self.misses += 1
+        start = time.time()
+        png = render()
+        self.render_seconds += time.time() - start
+        last_modified = time.time()
+
+        self._write_disk(etag, png)
+        self._remember(etag, png, last_modified)
+
+        return png, etag, last_modified
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'size' : len(self.images),
+                'maxsize' : self.maxsize,
+                'hits' : self.hits,
+                'disk_hits' : self.disk_hits,
+                'misses' : self.misses,
+                'hit_rate' : (self.hits + self.disk_hits) / float(lookups) if lookups else 0.,
+                'render_seconds_total' : self.render_seconds,
+                'directory' : self.directory}
+
+    def clear(self):
+        with self.lock:
+            self.images = OrderedDict()
+
+
+#shared by every request in this process. run from the dashboard directory, like run.py
+figures = FigureCache(directory=os.environ.get('FIGURE_CACHE_DIR', 'figure_cache'))
@@ -0,0 +1,217 @@
+# coding: utf-8
+
+'''Forecasts for many dates, zipcodes and stop types in one call
+
+The numbers are the same ones /predict plots: one regression on the lasso-selected
+features per series. All series of a stop type are fitted together by
+batchfit.batch_forecasts and cached, and a list of zipcodes is the sum of its
+zipcodes' forecasts (the fit is linear in the counts), so answering a request is a
+single matrix product of a zip selection matrix with the cached predictions.
+'''
+
+import numpy as np
+import pandas as pd
+
+from webapp.batchfit import batch_forecasts
+from webapp.matplotlib_funcs import STOP_TYPES, model_key, forecast_end
+from webapp.modelcache import models
+from webapp.regions import REGION_PREFIXES
+from webapp.spatial import is_area, area_zipcodes
+from webapp.storage import zip_label
+
+
+#per-request limits
+MAX_DATES = 92
+MAX_SERIES = 500
+MAX_VALUES = 100000
+
+
+def batch_model(stop_type, outdir='', futuredate=None):
+    '''batch_forecasts for every series of stop_type, through the process-wide model
+    cache
+
+    Returns
+    -------
+    predictions: pandas dataframe
+        in-sample and future predictions, dates x series
+    '''
+    if futuredate is None:
+        futuredate = forecast_end(stop_type, outdir)
+    key = model_key(stop_type, outdir=outdir, futuredate=futuredate) + ('batch',)
+
+    def fit():
+        forecasts = batch_forecasts(stop_type, outdir=outdir, futuredate=futuredate)
+        predictions = pd.concat([forecasts['y_pred'], forecasts['y_pred_future']])
+        #the last training day starts the future predictions too
+        return predictions[~predictions.index.duplicated()]
+
+    return models.get_or_fit(key, fit)
+
+
+def parse_dates(dates=None, start=None, days=None):
+    '''Normalize the requested dates to 'YYYY-MM-DD' strings. either a list of dates,
+    or a start date and a number of days
+    '''
+    if dates is None or len(dates) == 0:
+        if start is None or days is None:
+            raise ValueError('Give a list of dates, or a start date and a number of days')
+        days = int(days)
+        if days < 1 or days > MAX_DATES:
+            raise ValueError('days must be between 1 and %d' % MAX_DATES)
+        dates = pd.date_range(start, periods=days, freq='D')
+    else:
+        if len(dates) > MAX_DATES:
+            raise ValueError('At most %d dates per request' % MAX_DATES)
+        try:
+            dates = pd.to_datetime(list(dates))
+        except (ValueError, TypeError):
+            raise ValueError('Dates must be given as YYYY-MM-DD')
+
+    return [date.strftime('%Y-%m-%d') for date in dates]
+
+
+def _string_list(params, name, default):
+    values = params.get(name)
+    if values is None or values == []:
+        return default
+    if not isinstance(values, list):
+        raise ValueError('%s must be a list' % name)
+    #json numbers are accepted for zipcodes, true and false are not
+    if any(isinstance(value, bool) or not isinstance(value, (str, int)) for value in values):
+        raise ValueError('%s must be a list of strings' % name)
+    return [str(value) for value in values]
+
+
+def parse_request(params):
+    '''Check the fields of a /forecast request and normalize them
+
+    Parameters
+    ----------
+    params: dict
+        'stop_types', 'zips' and 'dates' lists, or 'start' and 'days' instead of
+        'dates', and 'stream'. from a json body or query arguments
+
+    Returns
+    -------
+    stop_types, zips, dates: lists of strings
+        dates from parse_dates, zipcodes as strings
+    stream: bool
+    '''
+    if not isinstance(params, dict):
+        raise ValueError('The request body must be a json object')
+
+    stop_types = _string_list(params, 'stop_types', ['Pickups and Deliveries'])
+    zips = _string_list(params, 'zips', ['all'])
+    dates = _string_list(params, 'dates', None)
+
+    start = params.get('start')
+    if start is not None and not isinstance(start, str):
+        raise ValueError('start must be a YYYY-MM-DD string')
+    days = params.get('days')
+    if days is not None and (isinstance(days, bool) or not isinstance(days, (int, str))):
+        raise ValueError('days must be a number')
+    if isinstance(days, str) and not days.strip().isdigit():
+        raise ValueError('days must be a number')
+
+    stream = params.get('stream')
+    if stream not in (None, True, False, '', '0', '1', 'true', 'false'):
+        raise ValueError('stream must be true or false')
+
+    return stop_types, zips, parse_dates(dates, start, days), stream in (True, '1', 'true')
+
+
+def selection_matrix(zips, columns, outdir=''):
+    '''Matrix that sums the columns of the batch predictions into each requested series
+
+    Parameters
+    ----------
+    zips: list of strings
+        each one a zipcode, comma-separated zipcodes, a region name, an area
+        (spatial.py) or 'all'
+    columns: list of strings
+        series in the batch predictions
+    outdir: string
+        place where zip_summary_2 is stored, for areas
+
+    Returns
+    -------
+    S: array, len(zips) x len(columns)
+    '''
+    position = dict((name, i) for i, name in enumerate(columns))
+    zip_columns = [i for i, name in enumerate(columns) if not (name == 'all' or name.startswith(REGION_PREFIXES))]
+
+    S = np.zeros((len(zips), len(columns)))
+    for row, zip_of_interest in enumerate(zips):
+        #a zipcode may come as a json number
+        zip_of_interest = str(zip_of_interest)
+        if zip_of_interest in position:
+            S[row, position[zip_of_interest]] = 1.
+        elif zip_of_interest == 'all':
+            S[row, zip_columns] = 1.
+        elif zip_of_interest.startswith(REGION_PREFIXES):
+            raise ValueError('Region not found in table')
+        elif is_area(zip_of_interest):
+            #as in select_series, zipcodes of the area without counts add nothing
+            inside = [position[zipcode] for zipcode in area_zipcodes(zip_of_interest, outdir) if zipcode in position]
+            if not inside:
+                raise ValueError('No zipcodes with counts in area')
+            S[row, inside] = 1.
+        else:
+            #duplicates count once, as in select_series
+            for zipcode in set(zip_label(zipcode) for zipcode in zip_of_interest.split(",")):
+                if zipcode not in position:
+                    raise ValueError('Zip not found in table')
+                S[row, position[zipcode]] = 1.
+
+    return S
+
+
+def check_grid(stop_types, zips, dates):
+    '''Raise ValueError if a forecast_grid request is empty, names an unknown stop
+    type or is over the per-request limits
+    '''
+    if not stop_types or not zips or not dates:
+        raise ValueError('Give at least one stop type, zipcode and date')
+    unknown = [stop_type for stop_type in stop_types if stop_type not in STOP_TYPES]
+    if unknown:
+        raise ValueError('Unknown stop types %s' % unknown)
+    if len(zips) > MAX_SERIES:
+        raise ValueError('At most %d zipcodes or regions per request' % MAX_SERIES)
+    if len(stop_types) * len(zips) * len(dates) > MAX_VALUES:
+        raise ValueError('At most %d forecasts per request' % MAX_VALUES)
+
+
+def forecast_grid(stop_types, zips, dates, outdir=''):
+    '''Forecasts for every combination of stop type, zip set and date
+
+    Parameters
+    ----------
+    stop_types: list of strings
+        'Pickups and Deliveries', 'Deliveries' and/or 'Pickups'
+    zips: list of strings
+        each one a zipcode, comma-separated zipcodes, a region name, an area
+        (spatial.py) or 'all'
+    dates: list of strings
+        'YYYY-MM-DD' dates, from parse_dates
+
+    Returns
+    -------
+    values: array, len(stop_types) x len(zips) x len(dates)
+    '''
+    check_grid(stop_types, zips, dates)
+
+    values = np.zeros((len(stop_types), len(zips), len(dates)))
+    for i, stop_type in enumerate(stop_types):
+        #one batch model per stop type covers the whole horizon, whatever dates are asked for
+        predictions = batch_model(stop_type, outdir=outdir)
+
+        rows = predictions.index.get_indexer(dates)
+        if (rows < 0).any():
+            missing = [date for date, row in zip(dates, rows) if row < 0]
+            raise ValueError('No forecast for dates %s, forecasts run from %s to %s'
+                             % (missing, predictions.index[0], predictions.index[-1]))
+
+        S = selection_matrix(zips, list(predictions.columns), outdir=outdir)
+        values[i] = np.dot(S, predictions.values[rows].T)
+
+    return values
@@ -1,17 +1,18 @@
 
 # coding: utf-8
 
+import os
+
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from datetime import datetime
-import os, sys
-import json
-from sklearn.cross_validation import train_test_split
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import r2_score, mean_squared_error, explained_variance_score
-import itertools
-import seaborn as sns
+
+from webapp.regions import select_series, series_paths, zip_set_key, REGION_PREFIXES
+from webapp.cube import heatmap_counts, load_cube
+from webapp.datastore import store
+from webapp.modelcache import ModelCache, models
+from webapp.storage import MappedTable, INDEX_KEY
+from webapp.figcache import render_png
+from webapp.metrics import timer
 
 
 def ordersbyhrandday(tbl, zipcode = None, plot=False):
@@ -32,59 +33,111 @@ def ordersbyhrandday(tbl, zipcode = None, plot=False):
 
 
 
-def make_heatmap(pickup_deliv, mindate, maxdate, zipcode=None):
+#event tables (and their cubes, at path + '_cube') for each stop type
+HEATMAP_PATHS = {'Deliveries' : 'webapp/static/data/orderzips_filt',
+                 'Pickups' : 'webapp/static/data/submissionzips_filt',
+                 'Pickups and Deliveries' : 'webapp/static/data/subandordzips_filt'}
+
+
+#part of every figure's cache key. bump it whenever make_heatmap,
+#linear_regression_lassocoefs or what they plot changes, so images cached in memory
+#and on disk by the old code are not served
+RENDER_VERSION = 2
+
+
+def heatmap_key(pickup_deliv, mindate, maxdate, zipcode=None):
+    '''Everything the make_heatmap figure depends on: the stop type, the normalized
+    date range and zipcode, the version of the event cube and RENDER_VERSION
+    '''
+    if pickup_deliv not in HEATMAP_PATHS:
+        raise ValueError('Unknown stop type %s' % pickup_deliv)
+    path = HEATMAP_PATHS[pickup_deliv]
+    if zipcode == 'all':
+        zipcode = None
+    if zipcode is not None and not (zipcode.isdigit() and len(zipcode) == 5):
+        raise ValueError('Zipcode must be 5 digits or all, got %r' % zipcode)
+    dtf = '%Y-%m-%d'
+
+    return ('heatmap', pickup_deliv, pd.Timestamp(mindate).strftime(dtf), pd.Timestamp(maxdate).strftime(dtf),
+            zipcode, store.version(path + '_cube', load_cube), RENDER_VERSION)
+
 
+def new_figure(figsize):
+    '''A Figure with its own Agg canvas, outside pyplot, so nothing global keeps it
+    alive after the request and concurrent requests don't share drawing state
+    '''
     from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
     from matplotlib.figure import Figure
-    from matplotlib.dates import DateFormatter
-    from io import BytesIO
 
-    if pickup_deliv=='Deliveries':
-        tbl = pd.read_pickle('webapp/static/data/orderzips_filt.pkl')
-    if pickup_deliv=='Pickups':
-        tbl = pd.read_pickle('webapp/static/data/submissionzips_filt.pkl')
-    if pickup_deliv=='Pickups and Deliveries':
-        tbl = pd.read_pickle('webapp/static/data/subandordzips_filt.pkl')
+    fig = Figure(figsize=figsize)
+    FigureCanvas(fig)
 
-    daterng = pd.date_range(mindate, maxdate, freq='D')
-    rng = [date.strftime('%Y-%m-%d') for date in daterng]
+    return fig
 
-    tbl = tbl[tbl.daterange_str.isin(rng)]
 
-    print(zipcode)
-    print(type(zipcode))
+def heatmap_table(pickup_deliv, mindate, maxdate, zipcode=None):
+    '''Event counts by day of week (rows, Mon to Sun) and hour of day (columns, 7 to 18)
+    '''
+    path = HEATMAP_PATHS[pickup_deliv]
 
     if zipcode == 'all':
         zipcode=None
 
-    a_, tbl = ordersbyhrandday(tbl=tbl, zipcode=zipcode)
+    #hour x dayofweek counts straight from the precomputed event cube
+    with timer('load'):
+        tbl = heatmap_counts(path + '_cube', mindate, maxdate, zipcode=zipcode)
+
+    with timer('filter'):
+        tbl_limits = tbl.loc[7:18]
 
-    tbl_limits = tbl.ix[7:18]
-    tbl_transpose = tbl_limits.transpose()
+    return tbl_limits.transpose()
+
+
+def heatmap_data(pickup_deliv, mindate, maxdate, zipcode=None):
+    '''The numbers behind make_heatmap, for drawing it client side
+    '''
+    tbl_transpose = heatmap_table(pickup_deliv, mindate, maxdate, zipcode=zipcode)
+
+    return {'hours' : [int(hour) for hour in tbl_transpose.columns],
+            'days' : ['Mon','Tue','Wed','Thu','Fri','Sat','Sun'],
+            'counts' : tbl_transpose.values.astype(int).tolist()}
+
+
+def make_heatmap(pickup_deliv, mindate, maxdate, zipcode=None):
+
+    tbl_transpose = heatmap_table(pickup_deliv, mindate, maxdate, zipcode=zipcode)
 
     m, n = tbl_transpose.shape
 
-    fig, ax = plt.subplots(figsize=(7, 4))
+    with timer('draw'):
+        fig = new_figure(figsize=(7, 4))
+        ax = fig.add_subplot(1, 1, 1)
 
-    ax.imshow(tbl_transpose, interpolation='nearest',cmap='Reds').get_axes()
-    #add cmap='Reds' to change color scheme
-    ax.xaxis.set_ticks(np.arange(0, n, 1))
-    ax.set_xticklabels(tbl_transpose.columns)
-    ax.set_yticks(np.arange(0, m, 1))
-    ax.set_yticklabels(['Mon','Tue','Wed','Thu','Fri','Sat','Sun'])
-    ax.grid('off')
+        ax.imshow(tbl_transpose, interpolation='nearest',cmap='Reds')
+        #add cmap='Reds' to change color scheme
+        ax.xaxis.set_ticks(np.arange(0, n, 1))
+        ax.set_xticklabels(tbl_transpose.columns)
+        ax.set_yticks(np.arange(0, m, 1))
+        ax.set_yticklabels(['Mon','Tue','Wed','Thu','Fri','Sat','Sun'])
+        ax.grid('off')
 
-    plt.ylabel('Day of week')
-    plt.xlabel('Hour of day')
+        ax.set_ylabel('Day of week')
+        ax.set_xlabel('Hour of day')
 
-    for i in range(m):
-        for j in range(n):
-            ax.text(j, i, (int(tbl_transpose.iget_value(i, j))),
-                    size='small', ha='center', va='center')
+        for i in range(m):
+            for j in range(n):
+                ax.text(j, i, (int(tbl_transpose.iat[i, j])),
+                        size='small', ha='center', va='center')
 
     return fig
 
 
+def heatmap_png(pickup_deliv, mindate, maxdate, zipcode=None):
+    '''make_heatmap as PNG bytes, so it can be rendered in another process
+    '''
+    return render_png(make_heatmap(pickup_deliv, mindate, maxdate, zipcode=zipcode))
+
+
 def setup_datetable(mindate, futuredate):
     datereange = pd.date_range(mindate,futuredate,freq='D')
 
@@ -99,8 +152,15 @@ def setup_datetable(mindate, futuredate):
     return date_frame
 
 
-def make_regression_features_oct(df):
+def make_regression_features_oct(df, calendar=None):
     '''Create features for regression given a dataframe
+
+    Parameters
+    ----------
+    df: pandas dataframe
+        date table from setup_datetable
+    calendar: pandas holiday calendar
+        default USFederalHolidayCalendar
     '''
 
     from pandas.tseries.holiday import USFederalHolidayCalendar
@@ -113,31 +173,40 @@ def make_regression_features_oct(df):
     x_dayofmonth = df.dayofmonth
     x_dayofmonth = pd.get_dummies(x_dayofmonth, prefix='dayofmonth')
 
-    x_week1 = pd.Series([1 if day < 8 else 0 for day in df.dayofmonth],name='week1')
-    x_week2 = pd.Series([1 if (day >= 8 and day < 16) else 0 for day in df.dayofmonth],name='week2')
-    x_week3 = pd.Series([1 if (day >= 16 and day < 23) else 0 for day in df.dayofmonth],name='week3')
-    x_week4 = pd.Series([1 if day >= 23 else 0 for day in df.dayofmonth],name='week4')
+    dayofmonth = df.dayofmonth.values
+    dayofweek = df.dayofweek.values
 
-    x_isweekend = pd.Series([1 if (day == 5 or day == 6) else 0 for day in df.dayofweek],name='isweekend')
+    def flag(values, name):
+        return pd.Series(values.astype(np.int64), name=name)
 
-    x_istueswed = pd.Series([1 if (day == 1 or day == 2) else 0 for day in df.dayofweek],name='istueswed')
+    x_week1 = flag(dayofmonth < 8, 'week1')
+    x_week2 = flag((dayofmonth >= 8) & (dayofmonth < 16), 'week2')
+    x_week3 = flag((dayofmonth >= 16) & (dayofmonth < 23), 'week3')
+    x_week4 = flag(dayofmonth >= 23, 'week4')
 
-    x_isfrisat = pd.Series([1 if (day == 4 or day == 5) else 0 for day in df.dayofweek],name='isfrisat')
+    x_isweekend = flag((dayofweek == 5) | (dayofweek == 6), 'isweekend')
+
+    x_istueswed = flag((dayofweek == 1) | (dayofweek == 2), 'istueswed')
+
+    x_isfrisat = flag((dayofweek == 4) | (dayofweek == 5), 'isfrisat')
 
     #get holidays
-    calendar = USFederalHolidayCalendar()
+    if calendar is None:
+        calendar = USFederalHolidayCalendar()
     holidays = calendar.holidays(start=df.datetime.min(), end=df.datetime.max())
-    x_isholiday = pd.Series([1 if day in holidays.tolist() else 0 for day in df.datetime],name='x_isholiday')
-
-    #find 3-day weekends
-    x_isholidaywknd = pd.Series(np.zeros(len(x_isholiday)),name='x_isholidaywknd')
-    x_weekendandholiday = x_isweekend + x_isholiday
-    for i in range(1, len(x_weekendandholiday)-2):
-        if x_weekendandholiday[i] == 1:
-            if x_weekendandholiday[i+1] == 1 and x_weekendandholiday[i+2] ==1:
-                x_isholidaywknd[i] = 1
-                x_isholidaywknd[i+1] = 1
-                x_isholidaywknd[i+2] = 1
+    x_isholiday = flag(pd.DatetimeIndex(df.datetime).isin(holidays), 'x_isholiday')
+
+    #find 3-day weekends: runs of three days that are a weekend day or a holiday (but
+    #not both), starting from the second day of the table
+    offday = (x_isweekend + x_isholiday).values == 1
+    n = len(offday)
+    starts = np.zeros(n, dtype=bool)
+    if n > 3:
+        starts[1:n-2] = offday[1:n-2] & offday[2:n-1] & offday[3:n]
+    wknd = starts.copy()
+    wknd[1:] |= starts[:-1]
+    wknd[2:] |= starts[:-2]
+    x_isholidaywknd = pd.Series(wknd.astype(float), name='x_isholidaywknd')
 
     x_week1tueswed = x_week1 & x_istueswed
     x_week2tueswed = x_week2 & x_istueswed
@@ -166,6 +235,30 @@ def make_regression_features_oct(df):
     return X_vars
 
 
+#date tables and feature matrices only depend on the dates and the holiday calendar,
+#so they are built once per date range and shared by every model
+feature_cache = ModelCache(maxsize=16)
+
+
+def regression_features(mindate, futuredate, calendar=None):
+    '''setup_datetable and make_regression_features_oct for mindate to futuredate,
+    cached by (mindate, futuredate, calendar). the returned tables are shared, so
+    don't modify them in place
+
+    Returns
+    -------
+    date_frame, X_vars_all: pandas dataframes
+    '''
+    key = (pd.Timestamp(mindate), pd.Timestamp(futuredate),
+           type(calendar).__name__ if calendar is not None else 'USFederalHolidayCalendar')
+
+    def build():
+        date_frame = setup_datetable(mindate, futuredate)
+        return date_frame, make_regression_features_oct(date_frame, calendar=calendar)
+
+    return feature_cache.get_or_fit(key, build)
+
+
 def divide_by_dates(date_frame, X_vars, startdate, enddate, features):
 
     startdate_ix = date_frame.loc[date_frame['datetime'] == startdate].index.tolist()
@@ -180,83 +273,323 @@ def divide_by_dates(date_frame, X_vars, startdate, enddate, features):
     return X_vars_cur, X
 
 
-def linear_regression_lassocoefs(stop_type, zip_of_interest, date_to_predict):
+def regression_design(mindate, maxdate, futuredate, feature_list):
+    '''Build the date table and the training and future design matrices for a model
+    trained on mindate to maxdate and predicting through futuredate
 
-    #start getting data!
-    outdir = ''
+    Returns
+    -------
+    date_frame: pandas dataframe
+        from setup_datetable, mindate to futuredate
+    X_vars, X: dataframe and array
+        features for mindate to maxdate
+    X_vars_future, X_future: dataframe and array
+        features for maxdate to futuredate
+    '''
+    date_frame, X_vars_all = regression_features(mindate, futuredate)
+
+    X_vars,X = divide_by_dates(date_frame, X_vars_all, mindate, maxdate, feature_list)
+    X_vars_future,X_future = divide_by_dates(date_frame, X_vars_all, maxdate, pd.to_datetime(futuredate), feature_list)
+
+    return date_frame, X_vars, X, X_vars_future, X_future
+
+
+#count table and lasso coefficient file for each stop type
+STOP_TYPES = {'Pickups and Deliveries' : ('subandord', 'lasso_coefs_subandords.pkl'),
+              'Deliveries' : ('orders', 'lasso_coefs_ords.pkl'),
+              'Pickups' : ('submissions', 'lasso_coefs_subs.pkl')}
+
+#change this whenever make_regression_features_oct or the model itself changes, so
+#models fitted by the old code are not served from the cache
+FEATURES_VERSION = 'oct-2'
+
+#days past the last day of a count table that its models forecast
+FORECAST_DAYS = 366
+
+#datascience/lassoselect.py saves each run to lasso_coefs/<version>/ and names the
+#current one in lasso_coefs/CURRENT, along with per-region selections
+LASSO_DIR = 'lasso_coefs/'
+REGION_COEFS_FILE = 'lasso_coefs_regions.pkl'
+
+
+def read_pointer(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def coefs_path(outdir, coefs_file):
+    '''Path of a lasso coefficient file in the current lassoselect run, or the one in
+    outdir itself if the pipeline has never run
+    '''
+    pointer = outdir + LASSO_DIR + 'CURRENT'
+    if os.path.exists(pointer):
+        return outdir + LASSO_DIR + store.get(pointer, read_pointer) + '/' + coefs_file
+    return outdir + coefs_file
+
+
+def lasso_paths(outdir, stop_type):
+    '''Coefficient files a model of stop_type may read, for use in cache keys
+    '''
+    paths = [coefs_path(outdir, STOP_TYPES[stop_type][1])]
+    if os.path.exists(coefs_path(outdir, REGION_COEFS_FILE)):
+        paths.append(coefs_path(outdir, REGION_COEFS_FILE))
+    return paths
+
+
+def lasso_features(outdir, stop_type, zip_of_interest='all'):
+    '''Features the lasso selected for stop_type: the ones selected for the city or
+    cluster itself when zip_of_interest is one that lassoselect ran for, otherwise
+    the ones selected for the whole market
+    '''
+    paths = lasso_paths(outdir, stop_type)
+    features = store.get(paths[0], pd.read_pickle)
 
-    if stop_type == 'Pickups and Deliveries':
-        tbl = pd.read_pickle(outdir + 'di_subandord_allcounts.pkl')
-        features = pd.read_pickle(outdir + 'lasso_coefs_subandords.pkl')
-    if stop_type == 'Deliveries':
-        tbl = pd.read_pickle(outdir + 'di_orders_allcounts.pkl')
-        features = pd.read_pickle(outdir + 'lasso_coefs_ords.pkl')
-    if stop_type == 'Pickups':
-        tbl = pd.read_pickle(outdir + 'di_submissions_allcounts.pkl')
-        features = pd.read_pickle(outdir + 'lasso_coefs_subs.pkl')
-
-    #get rid of zero value on july 4th
-    tbl.loc['2015-07-04'][:] = np.nan
-    tbl.interpolate(inplace=True)
-
-    #change zipcodes to strings
-    zips_to_str = {zip_fl:str(zip_fl) for zip_fl in tbl.columns}
-    tbl = tbl.rename(columns=zips_to_str)
-
-    #extract just zipcodes of interest
-    if zip_of_interest == 'all':
-        y = tbl[list(zips_to_str.values())].sum(axis=1)
-    else:
-        zip_input_list = zip_of_interest.split(",")
-
-        if len(zip_input_list) > 1:
-            try:
-                y = tbl[zip_input_list].sum(axis=1)
-            except:
-                raise ValueError('Zip not found in table')
-        else:
-            y = tbl[zip_input_list]
+    if len(paths) > 1 and zip_of_interest.startswith(REGION_PREFIXES):
+        regional = store.get(paths[1], pd.read_pickle)
+        regional = regional[(regional['stop_type'] == stop_type) & (regional['series'] == zip_of_interest)]
+        if len(regional):
+            features = regional
+
+    return features['var'].tolist()
+
+
+def forecast_end(stop_type, outdir=''):
+    '''Last date forecast for stop_type: FORECAST_DAYS after the last day of its
+    count table, as a 'YYYY-MM-DD' string
+    '''
+    if stop_type not in STOP_TYPES:
+        raise ValueError('Unknown stop type %s' % stop_type)
+    table = STOP_TYPES[stop_type][0]
+    lastdate = pd.Timestamp(store.get(outdir + 'di_%s_allcounts' % table, MappedTable).column(INDEX_KEY)[-1])
+    return (lastdate + pd.Timedelta(days=FORECAST_DAYS)).strftime('%Y-%m-%d')
+
+
+def closed_days(totals):
+    '''Days on which the whole market had no events at all, between its first and
+    last days with events (july 4th 2015 in the original data). the business was
+    closed, so their zeros are gaps in the series rather than demand to fit. zeros
+    before the first events or after the last ones are left alone
+
+    Parameters
+    ----------
+    totals: array
+        whole-market count on each day
+
+    Returns
+    -------
+    closed: array of bools
+    '''
+    totals = np.asarray(totals)
+    closed = totals == 0
+    active = np.flatnonzero(~closed)
+    if not len(active):
+        return np.zeros(len(totals), dtype=bool)
+    closed[:active[0]] = False
+    closed[active[-1]:] = False
+    return closed
+
+
+def fill_closed_days(y, closed):
+    '''Interpolate the series (or every column of the dataframe) y over the closed
+    days, from closed_days
+    '''
+    if not closed.any():
+        return y
+    y = y.astype(float)
+    y.loc[closed] = np.nan
+    return y.interpolate()
+
+
+def market_closed_days(outdir, table):
+    '''closed_days of a count table, on its dates
+    '''
+    return closed_days(select_series(outdir, table, 'all').values)
+
+
+def fit_lassocoefs_model(stop_type, zip_of_interest, outdir='', futuredate=None):
+    '''Fit the linear regression on the lasso-selected features for a stop type and
+    set of zipcodes, and predict through futuredate, by default forecast_end
+
+    Returns
+    -------
+    model: dict
+        'y', 'y_pred', 'y_pred_future', 'lr_fit', 'X_vars', 'X_vars_future' and
+        'date_frame'
+    '''
+    #sklearn is slow to import, only load it once a model is actually fitted
+    from sklearn.linear_model import LinearRegression
+
+    table = STOP_TYPES[stop_type][0]
+
+    with timer('load'):
+        #make list of features to include in model
+        feature_list = lasso_features(outdir, stop_type, zip_of_interest)
+
+        #daily counts for the zipcodes or region of interest
+        y = select_series(outdir, table, zip_of_interest)
+
+    #get rid of the zeros of days the business was closed, like july 4th
+    with timer('filter'):
+        y = fill_closed_days(y, market_closed_days(outdir, table))
 
     y.name = 'y'
 
-    mindate = tbl.index.min()
-    maxdate = tbl.index.max()
-    futuredate = '2015-12-31'
+    mindate = y.index.min()
+    maxdate = y.index.max()
+    if futuredate is None:
+        futuredate = forecast_end(stop_type, outdir)
 
-    date_frame = setup_datetable(mindate, futuredate)
+    with timer('features'):
+        date_frame, X_vars, X, X_vars_future, X_future = regression_design(mindate, maxdate, futuredate, feature_list)
 
-    X_vars_all = make_regression_features_oct(date_frame)
+    with timer('fit'):
+        lr = LinearRegression()
+        lr_fit = lr.fit(X,y)
 
-    #make list of features to include in model
-    feature_list = features['var'].tolist()
+    with timer('predict'):
+        y_pred = lr_fit.predict(X)
 
-    X_vars,X = divide_by_dates(date_frame, X_vars_all, mindate, maxdate, feature_list)
-    X_vars_future,X_future = divide_by_dates(date_frame, X_vars_all, maxdate, pd.to_datetime(futuredate), feature_list)
+        y_pred_future = lr_fit.predict(X_future)
+
+    X_vars_future.reset_index(inplace=True, drop=True)
+
+    return {'y' : y,
+            'y_pred' : y_pred,
+            'y_pred_future' : y_pred_future,
+            'lr_fit' : lr_fit,
+            'X_vars' : X_vars,
+            'X_vars_future' : X_vars_future,
+            'date_frame' : date_frame}
+
+
+def model_key(stop_type, outdir='', futuredate=None):
+    '''Everything a fitted model of stop_type depends on apart from the series: the
+    training window, FEATURES_VERSION, futuredate (default forecast_end) and the
+    content versions of the count tables and lasso files, so a changed data file or
+    a new lassoselect run never serves a stale model
+    '''
+    if stop_type not in STOP_TYPES:
+        raise ValueError('Unknown stop type %s' % stop_type)
+    if futuredate is None:
+        futuredate = forecast_end(stop_type, outdir)
+    table = STOP_TYPES[stop_type][0]
+
+    versions = [store.version(path, MappedTable) for path in series_paths(outdir, table)]
+    versions += [store.version(path, pd.read_pickle) for path in lasso_paths(outdir, stop_type)]
+
+    dates = store.get(outdir + 'di_%s_allcounts' % table, MappedTable).column(INDEX_KEY)
+
+    return (stop_type, (dates[0], dates[-1]), FEATURES_VERSION, futuredate, tuple(versions))
+
+
+def lassocoefs_model(stop_type, zip_of_interest, outdir='', futuredate=None):
+    '''fit_lassocoefs_model, through the process-wide model cache, keyed by model_key
+    and the normalized zip set
+    '''
+    if futuredate is None:
+        futuredate = forecast_end(stop_type, outdir)
+    key = model_key(stop_type, outdir=outdir, futuredate=futuredate) + (zip_set_key(zip_of_interest, outdir),)
 
-    lr = LinearRegression()
-    lr_fit = lr.fit(X,y)
-    y_pred = lr_fit.predict(X)
+    return models.get_or_fit(key, lambda: fit_lassocoefs_model(stop_type, zip_of_interest,
+                                                               outdir=outdir, futuredate=futuredate))
 
-    y_pred_future = lr_fit.predict(X_future)
+
+def prediction_key(stop_type, zip_of_interest, date_to_predict):
+    '''Everything the linear_regression_lassocoefs figure depends on, RENDER_VERSION
+    included
+    '''
+    return ('predict', zip_set_key(zip_of_interest), date_to_predict, RENDER_VERSION) + model_key(stop_type)
+
+
+def predict_lassocoefs(stop_type, zip_of_interest, date_to_predict):
+    '''Fitted model and the prediction for one date
+
+    Returns
+    -------
+    model: dict
+        from fit_lassocoefs_model
+    date_to_predict_x, date_to_predict_y: floats
+        days since the start of the data, and predicted count, for date_to_predict
+    '''
+    #start getting data!
+    outdir = ''
+
+    #fitted once per stop type, zip set and data version, then reused
+    model = lassocoefs_model(stop_type, zip_of_interest, outdir=outdir)
+
+    y_pred_future = model['y_pred_future']
+    X_vars_future = model['X_vars_future']
+    date_frame = model['date_frame']
 
     #find requested datestring in predicted values
     date_to_predict_ix = date_frame[date_frame.daterange_str == date_to_predict].index.tolist()
-    X_vars_future.reset_index(inplace=True, drop=True)
+    if not date_to_predict_ix:
+        raise ValueError('Date %s is not a YYYY-MM-DD date between %s and %s'
+                         % (date_to_predict, date_frame.daterange_str.iloc[0], date_frame.daterange_str.iloc[-1]))
 
-    date_to_predict_ix_y = (X_vars_future[X_vars_future['dayssincestart'] == date_to_predict_ix].index.tolist())
+    date_to_predict_ix_y = (X_vars_future[X_vars_future['dayssincestart'] == date_to_predict_ix[0]].index.tolist())
 
     date_to_predict_x = float(date_to_predict_ix[0])
-    date_to_predict_y = float(y_pred_future[date_to_predict_ix_y])
+    date_to_predict_y = float(np.asarray(y_pred_future)[date_to_predict_ix_y][0])
+
+    return model, date_to_predict_x, date_to_predict_y
+
+
+def prediction_data(stop_type, zip_of_interest, date_to_predict):
+    '''The series behind linear_regression_lassocoefs' plot, for drawing it client side
+    '''
+    model, date_to_predict_x, date_to_predict_y = predict_lassocoefs(stop_type, zip_of_interest, date_to_predict)
+
+    return {'dates' : [str(date) for date in model['y'].index],
+            'y' : model['y'].values.tolist(),
+            'y_pred' : np.asarray(model['y_pred']).tolist(),
+            'future_days' : model['X_vars_future'].dayssincestart.tolist(),
+            'y_pred_future' : np.asarray(model['y_pred_future']).tolist(),
+            'date_to_predict' : date_to_predict,
+            'date_to_predict_x' : date_to_predict_x,
+            'date_to_predict_y' : date_to_predict_y}
+
+
+def linear_regression_lassocoefs(stop_type, zip_of_interest, date_to_predict):
+
+    model, date_to_predict_x, date_to_predict_y = predict_lassocoefs(stop_type, zip_of_interest, date_to_predict)
 
     #plot figure
-    fig = plt.figure(figsize=(7,4))
-    ax = fig.add_subplot(1, 1, 1)
-    ax.plot(y)
-    ax.plot(y_pred,'r')
-    ax.plot(X_vars_future.dayssincestart,y_pred_future)
-    ax.plot(date_to_predict_x,date_to_predict_y, 'ro', markersize=10)
-    plt.xlabel('Days')
-    plt.ylabel('Number of %s' %stop_type)
-    plt.xticks()
-
-    return fig, date_to_predict_y, lr_fit, X_vars
+    with timer('draw'):
+        fig = new_figure(figsize=(7,4))
+        ax = fig.add_subplot(1, 1, 1)
+        ax.plot(model['y'])
+        ax.plot(model['y_pred'],'r')
+        ax.plot(model['X_vars_future'].dayssincestart,model['y_pred_future'])
+        ax.plot(date_to_predict_x,date_to_predict_y, 'ro', markersize=10)
+        ax.set_xlabel('Days')
+        ax.set_ylabel('Number of %s' %stop_type)
+
+    return fig, date_to_predict_y, model['lr_fit'], model['X_vars']
+
+
+def prediction_png(stop_type, zip_of_interest, date_to_predict):
+    '''linear_regression_lassocoefs' plot as PNG bytes, so it can be rendered in
+    another process
+    '''
+    return render_png(linear_regression_lassocoefs(stop_type, zip_of_interest, date_to_predict)[0])
+
+
+def prediction_png_value(stop_type, zip_of_interest, date_to_predict):
+    '''The plot as PNG bytes and the predicted count, from one fit, so the /predict
+    image and the /prediction page it is embedded in share one computation
+    '''
+    fig, date_to_predict_y, _, _ = linear_regression_lassocoefs(stop_type, zip_of_interest, date_to_predict)
+    return render_png(fig), date_to_predict_y
+
+
+def cache_stats():
+    '''stats() of this process's fitted model and feature caches
+    '''
+    return {'models' : models.stats(), 'features' : feature_cache.stats()}
+
+
+def prediction_value(stop_type, zip_of_interest, date_to_predict):
+    '''Just the predicted count for date_to_predict, without drawing anything
+    '''
+    return predict_lassocoefs(stop_type, zip_of_interest, date_to_predict)[2]
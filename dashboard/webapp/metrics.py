@@ -0,0 +1,232 @@
+# coding: utf-8
+
+'''Stage timers, request counters and a sampling profiler for the dashboard
+
+Code on the hot path wraps its stages (load, features, fit, predict, draw, render,
+...) in timer(). Each stage's time goes into a histogram served in Prometheus text
+format at /metrics, and into the timing log line written at the end of the
+request. Work done in the offload pool reports its stages back with its result
+(see offload.py), so the numbers cover both.
+
+Setting PROFILE_SLOW_MS turns on the profiler: every request is sampled, and those
+slower than the threshold leave a collapsed-stack profile (flamegraph.pl format)
+in PROFILE_DIR.
+'''
+
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+
+#histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Registry(object):
+    '''Counters and histograms keyed by metric name and label values
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+        self.help = {}
+
+    def inc(self, name, labels=(), value=1, help=None):
+        with self.lock:
+            key = (name, tuple(labels))
+            self.counters[key] = self.counters.get(key, 0) + value
+            if help is not None:
+                self.help[name] = help
+
+    def observe(self, name, value, labels=(), help=None):
+        with self.lock:
+            key = (name, tuple(labels))
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+            if help is not None:
+                self.help[name] = help
+
+    def clear(self):
+        with self.lock:
+            self.counters = OrderedDict()
+            self.histograms = OrderedDict()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels)
+
+
+def render(registry, gauges=()):
+    '''Prometheus text exposition of registry, plus gauges given as
+    (name, help, [(labels, value), ...]) tuples
+    '''
+    lines = []
+
+    with registry.lock:
+        counters = list(registry.counters.items())
+        histograms = [(key, list(h.counts), h.count, h.sum) for key, h in registry.histograms.items()]
+
+    typed = set()
+
+    def header(name, kind, help=None):
+        if name not in typed:
+            typed.add(name)
+            lines.append('# HELP %s %s' % (name, help or registry.help.get(name, name)))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+    for (name, labels), value in counters:
+        header(name, 'counter')
+        lines.append('%s%s %s' % (name, _labels(labels), value))
+
+    for (name, labels), counts, count, total in histograms:
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, n in zip(BUCKETS, counts):
+            cumulative += n
+            lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', repr(bound)),)), cumulative))
+        lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', '+Inf'),)), count))
+        lines.append('%s_sum%s %r' % (name, _labels(labels), total))
+        lines.append('%s_count%s %d' % (name, _labels(labels), count))
+
+    for name, help, values in gauges:
+        header(name, 'gauge', help)
+        for labels, value in values:
+            lines.append('%s%s %r' % (name, _labels(labels), float(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+#shared by every request in this process
+registry = Registry()
+
+#stage timings of the request being handled by this thread
+current = threading.local()
+
+
+def begin_request():
+    current.stages = OrderedDict()
+
+
+def request_stages():
+    return getattr(current, 'stages', None)
+
+
+def end_request():
+    stages = request_stages()
+    current.stages = None
+    return stages
+
+
+def record_stage(stage, seconds, observe=True):
+    '''Add seconds spent in stage to this thread's request, and to the stage histogram
+    '''
+    stages = request_stages()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.) + seconds
+    if observe:
+        registry.observe('dashboard_stage_seconds', seconds, labels=(('stage', stage),),
+                         help='Time spent in each stage of the dashboard hot path')
+
+
+@contextmanager
+def timer(stage):
+    '''Time the enclosed block as stage
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.time() - start)
+
+
+def collect_stages(fn, *args):
+    '''Call fn(*args) and return its result with the stages it timed. used to carry
+    stage timings back from pool worker processes
+    '''
+    begin_request()
+    try:
+        result = fn(*args)
+    finally:
+        stages = end_request()
+    return result, stages
+
+
+class SamplingProfiler(object):
+    '''Samples the stack of one thread every interval seconds from a background thread
+
+    Parameters
+    ----------
+    thread_id: int
+        threading.get_ident() of the thread to sample
+    interval: float
+        seconds between samples
+    '''
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.running = False
+        self.thread = None
+
+    def _sample(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._sample)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def dump(self, path):
+        '''Write the samples in collapsed-stack format, one "stack count" line each
+        '''
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+        return path
+
+
+def profile_threshold():
+    '''Seconds above which a request's profile is kept, or None when profiling is off
+    '''
+    value = os.environ.get('PROFILE_SLOW_MS')
+    return float(value) / 1000. if value else None
@@ -0,0 +1,105 @@
+# coding: utf-8
+
+'''Size-bounded LRU cache of fitted regression models
+
+The /prediction page and the /predict plot it embeds ask for the same model, and
+users tend to look at the same few regions, so fitted models are kept keyed by
+everything the fit depends on: stop type, normalized zip set, training window,
+feature-set version and the versions of the data files. A changed count table or
+lasso coefficient file gives a new key, and the stale model ages out of the cache.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ModelCache(object):
+    '''Thread-safe LRU cache of fitted models, with hit rate and fit time counters
+
+    Parameters
+    ----------
+    maxsize: int
+        number of models kept before the least recently used is dropped
+    '''
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.fits = 0
+        self.fit_seconds = 0.
+        self.last_fit_seconds = 0.
+
+    def get_or_fit(self, key, fit):
+        '''Return the model cached under key, or call fit() and cache what it returns
+        '''
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                self.hits += 1
+                return self.models[key]
+            self.misses += 1
+
+        start = time.time()
+        model = fit()
+        elapsed = time.time() - start
+
+        with self.lock:
+            self.fits += 1
+            self.fit_seconds += elapsed
+            self.last_fit_seconds = elapsed
+            self.models[key] = model
+            self.models.move_to_end(key)
+            while len(self.models) > self.maxsize:
+                self.models.popitem(last=False)
+                self.evictions += 1
+
+        return model
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size' : len(self.models),
+                'maxsize' : self.maxsize,
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'hit_rate' : self.hits / float(lookups) if lookups else 0.,
+                'evictions' : self.evictions,
+                'fits' : self.fits,
+                'fit_seconds_total' : self.fit_seconds,
+                'fit_seconds_mean' : self.fit_seconds / self.fits if self.fits else 0.,
+                'fit_seconds_last' : self.last_fit_seconds}
+
+    def clear(self):
+        with self.lock:
+            self.models = OrderedDict()
+
+
+def merge_stats(stats):
+    '''Add up the stats() of the same cache in several processes
+
+    Parameters
+    ----------
+    stats: list of dicts
+        ModelCache.stats() of each process
+
+    Returns
+    -------
+    total: dict
+        counters summed, rates and means recomputed from the sums
+    '''
+    total = {}
+    for name in ['size', 'maxsize', 'hits', 'misses', 'evictions', 'fits', 'fit_seconds_total']:
+        total[name] = sum(s[name] for s in stats)
+    lookups = total['hits'] + total['misses']
+    total['hit_rate'] = total['hits'] / float(lookups) if lookups else 0.
+    total['fit_seconds_mean'] = total['fit_seconds_total'] / total['fits'] if total['fits'] else 0.
+    total['processes'] = len(stats)
+    return total
+
+
+#shared by every request in this process
+models = ModelCache()
@@ -0,0 +1,238 @@
+# coding: utf-8
+
+'''Run the CPU-bound parts of requests in a bounded process pool
+
+Fits, renders and aggregations hold the GIL for hundreds of milliseconds, so under
+the threaded server they are sent to a pool of worker processes instead, and the
+request thread only waits for the answer. Requests for the same thing while it is
+being computed (same key) wait on the one computation already running rather than
+starting another. When too many distinct computations are already queued, new
+ones are refused with Overloaded, which the views turn into a 503 with Retry-After.
+
+Until configure() is called, as under run.py's debug server, everything runs inline
+in the request thread.
+
+The caches that matter (fitted models, feature tables) fill up in the workers, not
+in the server process. Each result comes back with a report from the worker that
+computed it, eg. its cache stats, and the latest report of every worker is kept
+for /modelcache and /metrics.
+'''
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from webapp.metrics import collect_stages, record_stage
+
+
+class Overloaded(Exception):
+    '''Raised when the pool's queue is full, or a computation takes too long
+
+    Parameters
+    ----------
+    retry_after: int
+        seconds the client should wait before trying again
+    '''
+
+    def __init__(self, retry_after):
+        Exception.__init__(self, 'Server busy, retry in %d seconds' % retry_after)
+        self.retry_after = retry_after
+
+
+def call_in_worker(report, fn, *args):
+    '''collect_stages(fn, *args), plus this worker's process id and report()
+    '''
+    result, stages = collect_stages(fn, *args)
+    return result, stages, os.getpid(), report() if report is not None else None
+
+
+class Offloader(object):
+    '''Process pool with request coalescing and load shedding
+    '''
+
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.max_workers = 0
+        self.max_queue = 0
+        self.timeout = None
+        self.retry_after = 5
+        self.initializer = None
+        self.report = None
+        self.reports = {}
+        self.submitted = 0
+        self.coalesced = 0
+        self.shed = 0
+        self.inline = 0
+        self.restarts = 0
+
+    def configure(self, max_workers=None, max_queue=None, timeout=60, retry_after=5, initializer=None,
+                  report=None):
+        '''Start the process pool
+
+        Parameters
+        ----------
+        max_workers: int
+            worker processes. default one per cpu
+        max_queue: int
+            distinct computations running or waiting before new ones are refused.
+            default 4 per worker
+        timeout: float
+            seconds a request waits for its result before giving up with Overloaded
+        retry_after: int
+            seconds sent in the Retry-After header of refused requests
+        initializer: function
+            run in each worker process when it starts, eg. warmup.warmup
+        report: function
+            module-level function run in the worker after each computation, whose
+            result is kept as that worker's latest report, eg. matplotlib_funcs.cache_stats
+        '''
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_queue = max_queue or 4 * self.max_workers
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.initializer = initializer
+        self.report = report
+        self.executor = self._start()
+
+    def _start(self):
+        #spawn rather than fork: the server process is already running threads
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=self.initializer)
+
+    def _restart(self, broken):
+        '''Replace the executor after a worker died (killed, out of memory, segfault),
+        which leaves a ProcessPoolExecutor refusing all work. only the first request
+        to notice replaces it
+        '''
+        with self.lock:
+            if self.executor is not broken:
+                return
+            self.executor = self._start()
+            self.inflight = {}
+            self.reports = {}
+            self.restarts += 1
+        broken.shutdown(wait=False)
+
+    def prestart(self):
+        '''Start every worker process now rather than on the first requests, and wait
+        for their initializers to finish
+
+        Returns
+        -------
+        pids: list of ints
+            process ids of the workers that answered
+        '''
+        futures = [self.executor.submit(call_in_worker, self.report, os.getpid) for _ in range(self.max_workers)]
+        pids = set()
+        for future in futures:
+            pid, report = future.result()[2:]
+            self._remember(pid, report)
+            pids.add(pid)
+        return sorted(pids)
+
+    def _remember(self, pid, report):
+        if report is not None:
+            with self.lock:
+                self.reports[pid] = report
+
+    def _done(self, key, future):
+        with self.lock:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+
+    def run(self, key, fn, *args):
+        '''Return fn(*args), computed in the pool, sharing the computation with any
+        request for the same key already in flight
+
+        Parameters
+        ----------
+        key: tuple
+            identifies the result. requests with equal keys get the same result
+        fn: function
+            module-level function, so it can be sent to a worker process
+        '''
+        if self.executor is None:
+            self.inline += 1
+            return fn(*args)
+
+        with self.lock:
+            executor = self.executor
+            future = self.inflight.get(key)
+            new = future is None
+            if new:
+                if len(self.inflight) >= self.max_queue:
+                    self.shed += 1
+                    raise Overloaded(self.retry_after)
+                try:
+                    future = executor.submit(call_in_worker, self.report, fn, *args)
+                except BrokenProcessPool:
+                    future = None
+                else:
+                    self.inflight[key] = future
+                    self.submitted += 1
+            else:
+                self.coalesced += 1
+
+        if future is None:
+            self._restart(executor)
+            raise Overloaded(self.retry_after)
+
+        #outside the lock, the callback runs right away if fn has already finished
+        if new:
+            future.add_done_callback(lambda f: self._done(key, f))
+
+        try:
+            result, stages, pid, report = future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise Overloaded(self.retry_after)
+        except BrokenProcessPool:
+            #a worker died, with this computation or another one. the pool is
+            #replaced and the client retries, rather than every later request failing
+            self._restart(executor)
+            raise Overloaded(self.retry_after)
+
+        self._remember(pid, report)
+
+        #the worker's stage timings go into this request's timing log. only the request
+        #that started the computation counts them in the histograms
+        for stage, seconds in stages.items():
+            record_stage(stage, seconds, observe=new)
+
+        return result
+
+    def worker_reports(self, report):
+        '''Latest report of each worker process, by process id
+
+        Parameters
+        ----------
+        report: function
+            the function configure() was given. without a pool, everything runs in
+            this process, so it is called here instead
+
+        Returns
+        -------
+        reports: dict
+            process id to the report's result
+        '''
+        if self.executor is None:
+            return {os.getpid() : report()}
+        with self.lock:
+            return dict(self.reports)
+
+    def stats(self):
+        return {'workers' : self.max_workers,
+                'max_queue' : self.max_queue,
+                'in_flight' : len(self.inflight),
+                'submitted' : self.submitted,
+                'coalesced' : self.coalesced,
+                'shed' : self.shed,
+                'inline' : self.inline,
+                'restarts' : self.restarts}
+
+
+#shared by every request in this process
+pool = Offloader()
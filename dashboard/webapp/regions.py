@@ -0,0 +1,166 @@
+# coding: utf-8
+
+'''Daily count series for zipcodes, clusters, cities and the whole market
+
+dataprep.write_region_rollups saves, next to each zip-level count table, a table of
+the same counts already summed up to every cluster and city and to 'all'. Region
+queries are then a single column read, and a list of zipcodes reuses the rollup of
+every cluster it fully covers instead of re-summing those zipcodes.
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from webapp.datastore import store
+from webapp.spatial import is_area, area_zipcodes
+from webapp.storage import MappedTable, zip_label
+
+
+REGION_PREFIXES = ('cluster:', 'city:')
+
+
+def load_clusters(path):
+    '''Load the region hierarchy saved by dataprep.write_region_rollups as a dict of
+    cluster name to the set of its zipcodes
+    '''
+    hierarchy = MappedTable(path).frame()
+    return dict((cluster, set(zip_label(zipcode) for zipcode in members))
+                for cluster, members in hierarchy.groupby('cluster')['zipcode'])
+
+
+def cover_with_clusters(zipcodes, clusters, available):
+    '''Split a set of zipcodes into the clusters it fully covers and the zipcodes left over
+
+    Parameters
+    ----------
+    zipcodes: set of strings
+        requested zipcodes
+    clusters: dict
+        cluster name to set of zipcodes, from load_clusters
+    available: set of strings
+        zipcodes present in the count table. cluster rollups only include these
+
+    Returns
+    -------
+    covered: list of strings
+        rollup columns, as 'cluster:<cluster>', whose zipcodes are all requested
+    leftover: list of strings
+        requested zipcodes not in any of those clusters
+    '''
+    covered = []
+    leftover = set(zipcodes)
+    for cluster, members in sorted(clusters.items()):
+        members = members & available
+        if members and members <= leftover:
+            covered.append('cluster:%s' % cluster)
+            leftover -= members
+
+    return covered, sorted(leftover)
+
+
+def zip_set_key(zip_of_interest, outdir=''):
+    '''Normalize a zip_of_interest string, so that the same set of zipcodes written in
+    a different order or with spaces, or drawn as an area, gives the same key
+    '''
+    if zip_of_interest == 'all' or zip_of_interest.startswith(REGION_PREFIXES):
+        return zip_of_interest
+    if is_area(zip_of_interest):
+        return tuple(area_zipcodes(zip_of_interest, outdir))
+    return tuple(sorted(set(zip_label(zipcode) or '' for zipcode in zip_of_interest.split(","))))
+
+
+def series_paths(outdir, table):
+    '''Files select_series may read for a table, for use in cache keys
+    '''
+    paths = [outdir + 'di_%s_allcounts' % table]
+    for path in [outdir + 'di_%s_regions' % table, outdir + 'region_hierarchy']:
+        if os.path.exists(path):
+            paths.append(path)
+    return paths
+
+
+def rollup_rows(counts, regions):
+    '''Row of the rollup table for each date of the count table it was rolled up from
+
+    Parameters
+    ----------
+    counts, regions: MappedTables
+        a zip-level count table and its region rollups
+
+    Returns
+    -------
+    rows: array of ints
+        regions row of each counts row, in counts order
+    '''
+    rows = pd.Index(regions.index()).get_indexer(counts.index())
+    if (rows < 0).any():
+        raise ValueError('Region rollups in %s miss dates of %s, rerun dataprep.write_region_rollups'
+                         % (regions.path, counts.path))
+    return rows
+
+
+def select_series(outdir, table, zip_of_interest):
+    '''Daily counts for a zipcode, a comma-separated list of zipcodes, a region or 'all'
+
+    Parameters
+    ----------
+    outdir: string
+        place where the dataprep tables are stored
+    table: string
+        'subandord', 'orders' or 'submissions'
+    zip_of_interest: string
+        'all', a region name such as 'cluster:3' or 'city:bayarea', an area such as
+        'radius:37.8,-122.27,5' (see spatial.py), or one or more comma-separated zipcodes
+
+    Returns
+    -------
+    y: pandas series
+        counts per day, indexed by date string
+    '''
+    counts = store.get(outdir + 'di_%s_allcounts' % table, MappedTable)
+    regions_path = outdir + 'di_%s_regions' % table
+    regions = store.get(regions_path, MappedTable) if os.path.exists(regions_path) else None
+
+    #column names may have been saved as numbers, or by a dataprep from before zip_label
+    names = dict((zip_label(name), name) for name in counts.names())
+
+    if is_area(zip_of_interest):
+        #zipcodes of the area without any counts add nothing
+        zipcodes = [zipcode for zipcode in area_zipcodes(zip_of_interest, outdir) if zipcode in names]
+        if not zipcodes:
+            raise ValueError('No zipcodes with counts in area')
+        zip_of_interest = ','.join(zipcodes)
+
+    if zip_of_interest == 'all' or zip_of_interest.startswith(REGION_PREFIXES):
+        if regions is not None:
+            try:
+                values = regions.column(zip_of_interest)
+            except KeyError:
+                raise ValueError('Region not found in table')
+            #on the count table's dates, like a zipcode's series. the fancy index copies
+            #the read-only mapped column
+            return pd.Series(np.asarray(values, dtype=float)[rollup_rows(counts, regions)], index=counts.index())
+        if zip_of_interest != 'all':
+            raise ValueError('Region tables have not been built')
+        return counts.frame().sum(axis=1)
+
+    zip_input_list = [zip_label(zipcode) for zipcode in zip_of_interest.split(",")]
+    if not set(zip_input_list) <= set(names):
+        raise ValueError('Zip not found in table')
+
+    covered, leftover = [], zip_input_list
+    if regions is not None and len(zip_input_list) > 1:
+        clusters = store.get(outdir + 'region_hierarchy', load_clusters)
+        covered, leftover = cover_with_clusters(set(zip_input_list), clusters, set(names))
+
+    y = np.zeros(counts.meta['nrows'])
+    if covered:
+        rows = rollup_rows(counts, regions)
+    for name in covered:
+        y += np.asarray(regions.column(name))[rows]
+    for zipcode in leftover:
+        y += counts.column(names[zipcode])
+
+    return pd.Series(y, index=counts.index())
@@ -0,0 +1,246 @@
+# coding: utf-8
+
+'''Zipcode shapes in view, at the map's resolution, with a metric for each
+
+datascience/shapes.py writes the zipcode shapes simplified for a few zoom levels as
+topojson, plus an index of every zipcode's bounding box. A map request names its
+bounding box and zoom: the zipcodes overlapping the box are found with one
+vectorized test on the index, and only their polygons and arcs, from the closest
+zoom level at or below the map's, are sent, each with the requested column of
+zip_summary_2.
+'''
+
+import json
+
+import numpy as np
+
+from webapp.datastore import store, MissingArtifact
+from webapp.metrics import timer
+from webapp.storage import MappedTable, zip_label
+
+
+SHAPES_DIR = 'webapp/static/data/zip_shapes/'
+INDEX_FILE = 'index.json'
+SUMMARY_TABLE = 'zip_summary_2'
+
+
+class ShapeIndex(object):
+    '''Bounding boxes of every zipcode in the shapes index, as one array
+    '''
+
+    def __init__(self, index):
+        self.key = index['key']
+        self.zooms = sorted(index['zooms'])
+        self.transform = index['transform']
+        self.zipcodes = sorted(index['bboxes'])
+        self.bboxes = np.array([index['bboxes'][z] for z in self.zipcodes], dtype=float).reshape(-1, 4)
+
+    def within(self, bbox):
+        '''Zipcodes whose bounding box overlaps bbox = (west, south, east, north)
+        '''
+        west, south, east, north = bbox
+        b = self.bboxes
+        hits = (b[:, 0] <= east) & (b[:, 2] >= west) & (b[:, 1] <= north) & (b[:, 3] >= south)
+        return [self.zipcodes[i] for i in np.flatnonzero(hits)]
+
+    def level(self, zoom):
+        '''The simplified zoom level to draw a map at zoom with: the closest at or
+        below it, or the coarsest
+        '''
+        below = [z for z in self.zooms if z <= zoom]
+        return below[-1] if below else self.zooms[0]
+
+
+def load_shapes(path, loader):
+    '''store.get for a file of the shapes directory, which only datascience/shapes.py writes
+    '''
+    try:
+        return store.get(path, loader)
+    except FileNotFoundError:
+        raise MissingArtifact(path, 'datascience/shapes.py')
+
+
+def load_index(path):
+    with open(path) as f:
+        return ShapeIndex(json.load(f))
+
+
+def load_level(path):
+    '''A topology written by datascience/shapes.py, with its geometries by zipcode
+    '''
+    with open(path) as f:
+        topology = json.load(f)
+    geometries = topology['objects']['zips']['geometries']
+    topology['by_zip'] = dict((g['id'], g) for g in geometries)
+    return topology
+
+
+def parse_bbox(value):
+    '''(west, south, east, north) from a 'west,south,east,north' string
+    '''
+    try:
+        bbox = [float(v) for v in value.split(',')]
+    except (AttributeError, ValueError):
+        raise ValueError('bbox must be west,south,east,north, got %r' % (value,))
+    if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        raise ValueError('bbox must be west,south,east,north, got %r' % (value,))
+    return tuple(bbox)
+
+
+def zip_rows(path):
+    '''zipcode to row of the zip summary table saved at path
+    '''
+    zipcodes = MappedTable(path).column('zipcodes')
+    return dict((zip_label(z), i) for i, z in enumerate(zipcodes))
+
+
+def load_summary(path):
+    '''The zip_summary_2 table at path, written by datascience/dataprep.py
+    '''
+    try:
+        return store.get(path, MappedTable)
+    except FileNotFoundError:
+        raise MissingArtifact(path, 'datascience/dataprep.py')
+
+
+def zip_metric(metric, zipcodes, outdir=''):
+    '''zipcode to value of one zip_summary_2 column, for zipcodes. None where missing
+    '''
+    path = outdir + SUMMARY_TABLE
+    table = load_summary(path)
+    if metric == 'zipcodes' or metric not in table.names():
+        raise ValueError('Unknown metric %s' % metric)
+
+    column = table.column(metric)
+    if column.dtype.kind not in 'iuf':
+        raise ValueError('Metric %s is not numeric' % metric)
+
+    rows = store.get(path, zip_rows)
+    values = {}
+    for zipcode in zipcodes:
+        row = rows.get(zipcode)
+        value = float(column[row]) if row is not None else np.nan
+        values[zipcode] = None if np.isnan(value) else value
+
+    return values
+
+
+def _remap(arcs, used, new_arcs, source):
+    #copy the arcs of a nested arc index list into new_arcs, renumbering them
+    if isinstance(arcs, list):
+        return [_remap(a, used, new_arcs, source) for a in arcs]
+
+    i = ~arcs if arcs < 0 else arcs
+    if i not in used:
+        used[i] = len(new_arcs)
+        new_arcs.append(source[i])
+    return ~used[i] if arcs < 0 else used[i]
+
+
+def subset(topology, zipcodes, values=None, key='ZCTA5CE10'):
+    '''Topology with only the geometries of zipcodes and the arcs they use, each with
+    its metric value as the 'value' property
+    '''
+    used = {}
+    arcs = []
+    geometries = []
+    for zipcode in zipcodes:
+        geometry = topology['by_zip'].get(zipcode)
+        if geometry is None:
+            continue
+        properties = {key : zipcode}
+        if values is not None:
+            properties['value'] = values.get(zipcode)
+        geometries.append({'type' : geometry['type'],
+                           'id' : zipcode,
+                           'properties' : properties,
+                           'arcs' : _remap(geometry['arcs'], used, arcs, topology['arcs'])})
+
+    return {'type' : 'Topology',
+            'transform' : topology['transform'],
+            'arcs' : arcs,
+            'objects' : {'zips' : {'type' : 'GeometryCollection', 'geometries' : geometries}}}
+
+
+def to_geojson(topology):
+    '''Decode a topology (delta-encoded, quantized arcs) to a geojson feature collection
+    '''
+    scale = np.array(topology['transform']['scale'])
+    translate = np.array(topology['transform']['translate'])
+    points = [np.round(np.cumsum(np.array(arc, dtype=float).reshape(-1, 2), axis=0) * scale + translate, 6)
+              for arc in topology['arcs']]
+
+    def ring(arc_ids):
+        coords = []
+        for arc_id in arc_ids:
+            p = points[~arc_id][::-1] if arc_id < 0 else points[arc_id]
+            coords.extend(p.tolist() if not coords else p[1:].tolist())
+        return coords
+
+    features = []
+    for geometry in topology['objects']['zips']['geometries']:
+        if geometry['type'] == 'Polygon':
+            coordinates = [ring(r) for r in geometry['arcs']]
+        else:
+            coordinates = [[ring(r) for r in polygon] for polygon in geometry['arcs']]
+        features.append({'type' : 'Feature',
+                         'id' : geometry['id'],
+                         'properties' : geometry['properties'],
+                         'geometry' : {'type' : geometry['type'], 'coordinates' : coordinates}})
+
+    return {'type' : 'FeatureCollection', 'features' : features}
+
+
+def map_key(bbox, zoom, metric, fmt='topojson', outdir=''):
+    '''Cache key of a map_data response, changing with the shapes and the metric table
+    '''
+    index = load_shapes(SHAPES_DIR + INDEX_FILE, load_index)
+    level = index.level(zoom)
+    load_shapes(SHAPES_DIR + 'z%d.json' % level, load_level)
+    versions = (store.version(SHAPES_DIR + INDEX_FILE, load_index),
+                store.version(SHAPES_DIR + 'z%d.json' % level, load_level))
+    if metric:
+        load_summary(outdir + SUMMARY_TABLE)
+        versions += (store.version(outdir + SUMMARY_TABLE, MappedTable),)
+
+    return ('map', tuple(bbox), level, metric, fmt) + versions
+
+
+def map_data(bbox, zoom, metric=None, fmt='topojson', outdir=''):
+    '''The zipcodes overlapping bbox, simplified for zoom, joined with a zip_summary_2 column
+
+    Parameters
+    ----------
+    bbox: tuple
+        (west, south, east, north) in degrees
+    zoom: number
+        web map zoom level of the view
+    metric: string
+        zip_summary_2 column, set as each zipcode's 'value' property. None for shapes only
+    fmt: string
+        'topojson' or 'geojson'
+
+    Returns
+    -------
+    data: dict
+    '''
+    if fmt not in ('topojson', 'geojson'):
+        raise ValueError('Unknown format %s' % fmt)
+
+    with timer('load'):
+        index = load_shapes(SHAPES_DIR + INDEX_FILE, load_index)
+        level = index.level(zoom)
+        topology = load_shapes(SHAPES_DIR + 'z%d.json' % level, load_level)
+
+    with timer('filter'):
+        zipcodes = index.within(bbox)
+        values = zip_metric(metric, zipcodes, outdir) if metric else None
+        data = subset(topology, zipcodes, values, index.key)
+
+    if fmt == 'geojson':
+        data = to_geojson(data)
+    data['bbox'] = list(bbox)
+    data['zoom'] = level
+    data['metric'] = metric
+
+    return data
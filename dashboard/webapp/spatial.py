@@ -0,0 +1,261 @@
+# coding: utf-8
+
+'''Zipcodes inside a circle or a drawn polygon
+
+A grid index over the geocoded zipcode centroids (the lats and lngs columns dataprep
+saves in zip_summary_2). Points are sorted by grid cell, so a query only tests the
+points of the cells its bounding box overlaps: one slice per grid row, found by
+binary search, then an exact vectorized distance or point-in-polygon test.
+
+An area is written like a region name, and select_series and the forecasts accept
+it anywhere they accept a list of zipcodes:
+
+    radius:<lat>,<lng>,<km>
+    polygon:<lat>,<lng>;<lat>,<lng>;...    (at least three vertices)
+'''
+
+import numpy as np
+
+from webapp.datastore import store, MissingArtifact
+from webapp.storage import MappedTable, zip_label
+
+
+AREA_PREFIXES = ('radius:', 'polygon:')
+
+SUMMARY_TABLE = 'zip_summary_2'
+
+EARTH_RADIUS_KM = 6371.0088
+
+#largest area accepted, so a typo can't select a continent
+MAX_RADIUS_KM = 500.
+MAX_VERTICES = 1000
+
+
+class GridIndex(object):
+    '''Points bucketed in a regular latitude/longitude grid
+
+    Parameters
+    ----------
+    lats, lngs: arrays of floats
+        point coordinates in degrees. points with a missing coordinate are left out
+    labels: list
+        name of each point
+    per_cell: int
+        number of points a point's own cell should hold, also where points are
+        densest. cells are found by binary search, so small cells cost no memory
+    '''
+
+    def __init__(self, lats, lngs, labels, per_cell=4):
+        lats = np.asarray(lats, dtype=float)
+        lngs = np.asarray(lngs, dtype=float)
+        ok = np.isfinite(lats) & np.isfinite(lngs)
+        labels = np.asarray(labels, dtype=object)[ok]
+        lats, lngs = lats[ok], lngs[ok]
+
+        if len(lats):
+            self.south, self.west = lats.min(), lngs.min()
+            height = max(lats.max() - self.south, 1e-6)
+            width = max(lngs.max() - self.west, 1e-6)
+        else:
+            self.south = self.west = 0.
+            height = width = 1.
+
+        #start from cells holding per_cell points on average, then shrink them until
+        #the cell of an average point holds about per_cell, so dense cities don't end
+        #up with a few crowded cells
+        self.size = np.sqrt(height * width * per_cell / max(len(lats), 1))
+        smallest = max(height, width) / 1e6
+        for _ in range(10):
+            self.size = max(self.size, smallest)
+            self.rows = int(height / self.size) + 1
+            self.cols = int(width / self.size) + 1
+            keys = self._row(lats) * self.cols + self._col(lngs)
+            if not len(keys):
+                break
+            _, counts = np.unique(keys, return_counts=True)
+            crowding = (counts ** 2).sum() / float(len(keys))
+            if crowding <= 2 * per_cell or self.size == smallest:
+                break
+            self.size /= np.sqrt(crowding / per_cell)
+
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.lats = lats[order]
+        self.lngs = lngs[order]
+        self.labels = labels[order]
+
+    def __len__(self):
+        return len(self.lats)
+
+    def _row(self, lats):
+        return np.clip(((np.asarray(lats) - self.south) / self.size).astype(np.int64), 0, self.rows - 1)
+
+    def _col(self, lngs):
+        return np.clip(((np.asarray(lngs) - self.west) / self.size).astype(np.int64), 0, self.cols - 1)
+
+    def candidates(self, south, west, north, east):
+        '''Positions of the points in the grid cells overlapping a bounding box
+        '''
+        if len(self) == 0 or north < self.south or east < self.west:
+            return np.zeros(0, dtype=np.int64)
+
+        #the cells of a grid row in the box are contiguous in key order, so each row
+        #is one slice of the points
+        rows = np.arange(self._row(south), self._row(north) + 1) * self.cols
+        first = np.searchsorted(self.keys, rows + self._col(west))
+        last = np.searchsorted(self.keys, rows + self._col(east) + 1)
+
+        counts = last - first
+        starts = np.cumsum(counts) - counts
+        return np.arange(counts.sum()) + np.repeat(first - starts, counts)
+
+    def within_radius(self, lat, lng, km):
+        '''Points at most km from (lat, lng), nearest first
+
+        Returns
+        -------
+        labels: array
+        distances: array of floats, in km
+        '''
+        dlat = np.degrees(km / EARTH_RADIUS_KM)
+        dlng = dlat / max(np.cos(np.radians(lat)), 1e-6)
+        idx = self.candidates(lat - dlat, lng - dlng, lat + dlat, lng + dlng)
+
+        distances = haversine(lat, lng, self.lats[idx], self.lngs[idx])
+        inside = distances <= km
+        idx, distances = idx[inside], distances[inside]
+        order = np.argsort(distances, kind='mergesort')
+
+        return self.labels[idx[order]], distances[order]
+
+    def in_polygon(self, vertices):
+        '''Points inside a polygon given as an (n, 2) array of (lat, lng) vertices
+
+        Returns
+        -------
+        labels: array
+        '''
+        vertices = np.asarray(vertices, dtype=float)
+        south, west = vertices.min(axis=0)
+        north, east = vertices.max(axis=0)
+        idx = self.candidates(south, west, north, east)
+
+        inside = points_in_polygon(self.lats[idx], self.lngs[idx], vertices)
+        return self.labels[idx[inside]]
+
+
+def haversine(lat, lng, lats, lngs):
+    '''Great circle distance in km from (lat, lng) to each of (lats, lngs)
+    '''
+    lat, lng, lats, lngs = [np.radians(v) for v in (lat, lng, lats, lngs)]
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+
+
+def points_in_polygon(lats, lngs, vertices):
+    '''Even-odd rule test of every point against a polygon of (lat, lng) vertices,
+    all points and edges at once
+
+    Returns
+    -------
+    inside: array of bools
+    '''
+    lats = np.asarray(lats, dtype=float)[:, None]
+    lngs = np.asarray(lngs, dtype=float)[:, None]
+    lat1, lng1 = vertices[:, 0], vertices[:, 1]
+    lat2, lng2 = np.roll(lat1, -1), np.roll(lng1, -1)
+    flat = lat2 == lat1
+    slope = (lng2 - lng1) / np.where(flat, 1., lat2 - lat1)
+
+    #edges crossing the point's latitude (never a flat one), and whether the
+    #crossing is east of the point
+    straddles = (lat1 > lats) != (lat2 > lats)
+    crosses = straddles & (lngs < lng1 + (lats - lat1) * slope)
+
+    return (np.count_nonzero(crosses, axis=1) % 2).astype(bool)
+
+
+def load_centroids(path):
+    '''Grid index of the zipcode centroids in the zip summary table saved at path
+    '''
+    table = MappedTable(path)
+    missing = [name for name in ('zipcodes', 'lats', 'lngs') if name not in table.names()]
+    if missing:
+        raise KeyError(missing[0])
+    zipcodes = [zip_label(z) for z in table.column('zipcodes')]
+    return GridIndex(table.column('lats'), table.column('lngs'), zipcodes)
+
+
+def centroid_index(outdir=''):
+    path = outdir + SUMMARY_TABLE
+    try:
+        return store.get(path, load_centroids)
+    except FileNotFoundError:
+        raise MissingArtifact(path, 'datascience/dataprep.py')
+    except KeyError as e:
+        #a summary saved before the zipcodes were geocoded
+        raise MissingArtifact('%s/%s' % (path, e.args[0]), 'dataprep.latslngs_fromGoogle')
+
+
+def _numbers(text, count=None):
+    try:
+        values = [float(v) for v in text.split(',')]
+    except ValueError:
+        raise ValueError('Expected numbers, got %r' % text)
+    if count is not None and len(values) != count:
+        raise ValueError('Expected %d numbers, got %r' % (count, text))
+    return values
+
+
+def parse_area(area):
+    '''('radius', (lat, lng, km)) or ('polygon', (n, 2) array of vertices) from an
+    area string
+    '''
+    kind, _, spec = area.partition(':')
+
+    if kind == 'radius':
+        lat, lng, km = _numbers(spec, 3)
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            raise ValueError('Center %s,%s is not a latitude and longitude' % (lat, lng))
+        if not 0 < km <= MAX_RADIUS_KM:
+            raise ValueError('Radius must be between 0 and %d km' % MAX_RADIUS_KM)
+        return kind, (lat, lng, km)
+
+    if kind == 'polygon':
+        vertices = np.array([_numbers(vertex, 2) for vertex in spec.split(';') if vertex.strip()])
+        if len(vertices) < 3 or len(vertices) > MAX_VERTICES:
+            raise ValueError('A polygon needs 3 to %d vertices' % MAX_VERTICES)
+        if (np.abs(vertices[:, 0]) > 90).any() or (np.abs(vertices[:, 1]) > 180).any():
+            raise ValueError('Polygon vertices must be latitude,longitude pairs')
+        return kind, vertices
+
+    raise ValueError('Unknown area %s' % area)
+
+
+def is_area(zip_of_interest):
+    return zip_of_interest.startswith(AREA_PREFIXES)
+
+
+def area_zipcodes(area, outdir=''):
+    '''Zipcodes whose centroid is inside an area string, sorted
+
+    Parameters
+    ----------
+    area: string
+        'radius:<lat>,<lng>,<km>' or 'polygon:<lat>,<lng>;<lat>,<lng>;...'
+    outdir: string
+        place where zip_summary_2 is stored
+
+    Returns
+    -------
+    zipcodes: list of strings
+    '''
+    kind, spec = parse_area(area)
+    index = centroid_index(outdir)
+
+    if kind == 'radius':
+        labels, _ = index.within_radius(*spec)
+    else:
+        labels = index.in_polygon(spec)
+
+    return sorted(labels)
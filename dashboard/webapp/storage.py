@@ -0,0 +1,445 @@
+# coding: utf-8
+
+'''Columnar on-disk storage for the dataprep tables
+
+A table is stored as a directory holding one .npy file per column and a meta.json
+sidecar describing the columns, the index and the column the rows are sorted by.
+Numeric and datetime columns are memory-mapped on read, so pulling one zipcode's
+series or one range of dates out of a table only touches those bytes on disk.
+
+Each write goes to a new version directory inside the table's directory, and a
+CURRENT file names the version to read, as lassoselect does with its runs. Readers
+resolve CURRENT once, so a MappedTable keeps reading the version it opened while
+a newer one is written next to it. Tables written before versioning (the files
+directly in the table's directory) are still read. dataprep's event cubes are
+versioned the same way, with new_version and publish_version.
+
+This is the one implementation of the format: datascience/storage.py loads this
+file for the dataprep pipeline, so the writer and the dashboard's reader can't
+drift apart. It only depends on numpy and pandas. For the same reason it holds
+zip_label, the form every table, lookup and query keys zipcodes by.
+'''
+
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+
+FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+INDEX_KEY = '__index__'
+POINTER_FILE = 'CURRENT'
+
+
+def zip_label(value):
+    '''A zipcode as a five-digit string: 94110, 94110.0 and '94110' are all '94110',
+    and 2134 is '02134'. None if it is missing
+    '''
+    if value is None or (isinstance(value, (float, np.floating)) and np.isnan(value)):
+        return None
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return '%05d' % int(value)
+    value = str(value).strip()
+    if value in ('', 'nan', 'None'):
+        return None
+    if value.endswith('.0') and value[:-2].isdigit():
+        value = value[:-2]
+    return value.zfill(5)
+
+
+def zip_labels(values):
+    '''zip_label of every value, as an object array, labelling each distinct value once
+    '''
+    codes, uniques = pd.factorize(np.asarray(values))
+    #codes are -1 for missing values, which picks the None at the end
+    return np.array([zip_label(value) for value in uniques] + [None], dtype=object)[codes]
+
+
+def _encode_column(values):
+    '''Convert a column to a numpy array that can be saved and memory-mapped,
+    and return it with the metadata needed to convert it back, and the mask of
+    missing values of a string column (None if it has none)
+    '''
+    values = pd.Series(values)
+    meta = {}
+    nulls = None
+
+    if isinstance(values.dtype, pd.SparseDtype):
+        values = values.sparse.to_dense()
+
+    if isinstance(values.dtype, pd.DatetimeTZDtype):
+        meta['kind'] = 'datetime'
+        meta['tz'] = str(values.dt.tz)
+        #store utc wall time, the timezone is put back on read
+        data = values.dt.tz_convert('UTC').dt.tz_localize(None).values.astype('datetime64[ns]')
+    elif values.dtype.kind in 'biufcmM':
+        meta['kind'] = 'numeric'
+        data = values.values
+    else:
+        #fixed-width unicode so strings can be memory-mapped too. missing values are
+        #saved as '' with a mask, not as the strings 'None' or 'nan'
+        meta['kind'] = 'string'
+        missing = values.isnull().values
+        if missing.any():
+            nulls = missing
+            values = values.where(~missing, '')
+        data = values.astype(str).values.astype('U')
+
+    return data, meta, nulls
+
+
+def _decode_column(data, meta, nulls=None):
+    '''Undo _encode_column for data read back from disk
+    '''
+    if meta['kind'] == 'datetime':
+        return pd.DatetimeIndex(data).tz_localize('UTC').tz_convert(meta['tz'])
+    if meta['kind'] == 'string':
+        values = np.asarray(data).astype(object)
+        if nulls is not None:
+            values[np.asarray(nulls)] = None
+        return values
+    return data
+
+
+def _save_column(path, column_meta, data, nulls):
+    np.save(os.path.join(path, column_meta['file']), data)
+    if nulls is not None:
+        column_meta['nulls'] = column_meta['file'].replace('.npy', '_nulls.npy')
+        np.save(os.path.join(path, column_meta['nulls']), nulls)
+
+
+def write_table(tbl, path, sort_key=None, excel=False):
+    '''Save a dataframe as a directory of memory-mappable column files
+
+    Parameters
+    ----------
+    tbl: pandas dataframe
+        table to save. column names must be strings or ints
+    path: string
+        directory to save the table in, eg. outdir + 'di_orders_allcounts'.
+        an existing table at path is replaced once the new one is fully written
+    sort_key: string
+        name of the column (or '__index__' for the index) the rows are sorted by.
+        reads can then select a range of rows by key without scanning the table
+    excel: bool
+        if True, also save an .xls copy next to the table. default False
+
+    Returns
+    -------
+    path: string
+        directory the table was saved in
+    '''
+    version_path = new_version(path)
+
+    meta = {'format' : FORMAT_VERSION,
+            'nrows' : len(tbl),
+            'sort_key' : sort_key,
+            'columns' : [],
+            'index' : None}
+
+    for i, name in enumerate(tbl.columns):
+        data, column_meta, nulls = _encode_column(tbl.iloc[:, i])
+        column_meta['name'] = name.item() if isinstance(name, np.generic) else name
+        column_meta['file'] = 'c%d.npy' % i
+        _save_column(version_path, column_meta, data, nulls)
+        meta['columns'].append(column_meta)
+
+    #a default 0..n-1 index is not worth storing
+    if not isinstance(tbl.index, pd.RangeIndex):
+        data, index_meta, nulls = _encode_column(tbl.index.to_series())
+        index_meta['name'] = tbl.index.name
+        index_meta['file'] = 'index.npy'
+        _save_column(version_path, index_meta, data, nulls)
+        meta['index'] = index_meta
+
+    with open(os.path.join(version_path, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+    publish_version(path, version_path)
+
+    if excel:
+        tbl.to_excel(path + '.xls', engine='openpyxl')
+
+    return path
+
+
+def migrate_pickle(pkl_path, path, sort_key=None):
+    '''Convert a table pickled by an older dataprep to a table saved with write_table.
+    the rows are put in sort_key order first if they aren't in it already
+
+    Returns
+    -------
+    path: string
+        directory the table was saved in
+    '''
+    tbl = pd.read_pickle(pkl_path)
+    if sort_key is not None:
+        keys = tbl.index if sort_key == INDEX_KEY else tbl[sort_key]
+        if not keys.is_monotonic_increasing:
+            order = np.argsort(np.asarray(keys), kind='mergesort')
+            tbl = tbl.iloc[order]
+
+    return write_table(tbl, path, sort_key=sort_key)
+
+
+def _current_version(path):
+    try:
+        with open(os.path.join(path, POINTER_FILE)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def new_version(path):
+    '''Create an empty directory for a new version of the table (or other directory
+    of files) at path, to be written and then made current with publish_version
+
+    Returns
+    -------
+    version_path: string
+    '''
+    version = time.strftime('%Y%m%d-%H%M%S')
+    n = 1
+    while os.path.exists(os.path.join(path, version)):
+        version = '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), n)
+        n += 1
+    os.makedirs(os.path.join(path, version))
+    return os.path.join(path, version)
+
+
+def publish_version(path, version_path):
+    '''Point readers of path at a fully written version from new_version, and remove
+    every version but it and the previous one, which stays for readers that opened
+    it before the swap. files from before versioning are removed too
+    '''
+    version = os.path.basename(version_path)
+    previous = _current_version(path)
+
+    #rename is atomic, so readers see the old version or the new one
+    tmp = os.path.join(path, POINTER_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        f.write(version)
+    os.rename(tmp, os.path.join(path, POINTER_FILE))
+
+    for name in os.listdir(path):
+        if name in (version, previous, POINTER_FILE):
+            continue
+        if os.path.isdir(os.path.join(path, name)):
+            shutil.rmtree(os.path.join(path, name))
+        else:
+            os.remove(os.path.join(path, name))
+
+
+def table_dir(path):
+    '''Directory holding the current version of the table saved at path: the one
+    CURRENT names, or path itself for a table from before versioning
+    '''
+    version = _current_version(path)
+    if version is None:
+        return path
+    return os.path.join(path, version)
+
+
+def read_meta(path):
+    '''Load the meta.json sidecar of a table saved with write_table
+    '''
+    with open(os.path.join(table_dir(path), META_FILE)) as f:
+        return json.load(f)
+
+
+def _load(path, column_meta, mmap):
+    return np.load(os.path.join(path, column_meta['file']), mmap_mode='r' if mmap else None)
+
+
+def _read(path, column_meta, mmap, rows=slice(None)):
+    '''Load and decode the rows of one column
+    '''
+    nulls = None
+    if 'nulls' in column_meta:
+        nulls = np.load(os.path.join(path, column_meta['nulls']))[rows]
+    return _decode_column(_load(path, column_meta, mmap)[rows], column_meta, nulls)
+
+
+def _utc_datetime64(value, tz):
+    '''Convert a bound on a datetime sort key to the naive utc values stored on disk.
+    naive bounds are taken to be in the column's timezone
+    '''
+    if value is None:
+        return None
+    value = pd.Timestamp(value)
+    if value.tz is None:
+        value = value.tz_localize(tz)
+    return value.tz_convert('UTC').tz_localize(None).to_datetime64()
+
+
+def _row_slice(path, meta, key_range, mmap):
+    '''Find the rows whose sort key falls in key_range, by binary search
+    '''
+    if key_range is None:
+        return slice(None)
+
+    sort_key = meta['sort_key']
+    if sort_key is None:
+        raise ValueError('Table at %s has no sort key to select a range on' % path)
+    if sort_key == INDEX_KEY:
+        key_meta = meta['index']
+    else:
+        key_meta = [c for c in meta['columns'] if c['name'] == sort_key][0]
+
+    keys = _load(path, key_meta, mmap)
+    lo, hi = key_range
+    if key_meta['kind'] == 'datetime':
+        lo = _utc_datetime64(lo, key_meta['tz'])
+        hi = _utc_datetime64(hi, key_meta['tz'])
+
+    start = np.searchsorted(keys, lo, side='left') if lo is not None else 0
+    stop = np.searchsorted(keys, hi, side='right') if hi is not None else len(keys)
+
+    return slice(start, stop)
+
+
+def read_column(path, name, key_range=None, mmap=True):
+    '''Read a single column of a table saved with write_table
+
+    Parameters
+    ----------
+    path: string
+        directory the table was saved in
+    name: string or int
+        column name, or '__index__' for the index
+    key_range: tuple
+        (first, last) values of the sort key to include, inclusive. either end can be
+        None. default reads every row
+    mmap: bool
+        memory-map the file instead of reading it into memory. default True
+
+    Returns
+    -------
+    values: numpy array or pandas DatetimeIndex
+        the column values. numeric columns come back as read-only memory maps
+    '''
+    path = table_dir(path)
+    meta = read_meta(path)
+    rows = _row_slice(path, meta, key_range, mmap)
+
+    if name == INDEX_KEY:
+        column_meta = meta['index']
+    else:
+        matches = [c for c in meta['columns'] if c['name'] == name]
+        if not matches:
+            raise KeyError('Column %s not found in %s' % (name, path))
+        column_meta = matches[0]
+
+    return _read(path, column_meta, mmap, rows)
+
+
+def read_table(path, columns=None, key_range=None, mmap=True):
+    '''Read a table saved with write_table, loading only the columns and rows asked for
+
+    Parameters
+    ----------
+    path: string
+        directory the table was saved in
+    columns: list
+        names of columns to read. default reads all of them
+    key_range: tuple
+        (first, last) values of the sort key to include, inclusive. either end can be
+        None. default reads every row
+    mmap: bool
+        memory-map the column files instead of reading them whole. default True
+
+    Returns
+    -------
+    tbl: pandas dataframe
+        the requested part of the table, with its index restored
+    '''
+    path = table_dir(path)
+    meta = read_meta(path)
+    rows = _row_slice(path, meta, key_range, mmap)
+
+    by_name = dict((c['name'], c) for c in meta['columns'])
+    if columns is None:
+        columns = [c['name'] for c in meta['columns']]
+    missing = [name for name in columns if name not in by_name]
+    if missing:
+        raise KeyError('Columns %s not found in %s' % (missing, path))
+
+    data = [_read(path, by_name[name], mmap, rows) for name in columns]
+
+    index = None
+    if meta['index'] is not None:
+        index = pd.Index(_read(path, meta['index'], mmap, rows), name=meta['index']['name'])
+
+    tbl = pd.DataFrame(dict(zip(range(len(columns)), data)), index=index)
+    tbl.columns = columns
+
+    return tbl
+
+
+class MappedTable(object):
+    '''Open handle on a saved table. the metadata is read once and each column is
+    memory-mapped the first time it is asked for, then reused. columns are read from
+    the version that was current when the table was opened, even after a newer one
+    is written
+
+    Parameters
+    ----------
+    path: string
+        directory the table was saved in
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.directory = table_dir(path)
+        self.meta = read_meta(self.directory)
+        self.by_name = dict((c['name'], c) for c in self.meta['columns'])
+        self.arrays = {}
+
+    def names(self):
+        return [c['name'] for c in self.meta['columns']]
+
+    def column(self, name):
+        '''Values of one column, or of the index for '__index__'. numeric columns are
+        read-only memory maps
+        '''
+        if name not in self.arrays:
+            if name == INDEX_KEY:
+                column_meta = self.meta['index']
+            elif name in self.by_name:
+                column_meta = self.by_name[name]
+            else:
+                raise KeyError('Column %s not found in %s' % (name, self.path))
+            self.arrays[name] = _read(self.directory, column_meta, True)
+
+        return self.arrays[name]
+
+    def index(self):
+        if self.meta['index'] is None:
+            return pd.RangeIndex(self.meta['nrows'])
+        return pd.Index(self.column(INDEX_KEY), name=self.meta['index']['name'])
+
+    def frame(self, columns=None):
+        '''The table, or some of its columns, as a dataframe
+        '''
+        if columns is None:
+            columns = self.names()
+        tbl = pd.DataFrame(dict((i, self.column(name)) for i, name in enumerate(columns)),
+                           index=self.index())
+        tbl.columns = columns
+        return tbl
+
+    def memory_size(self):
+        '''Bytes held, as (private, mapped). decoded string and datetime columns are
+        private copies
+        '''
+        private = mapped = 0
+        for values in self.arrays.values():
+            if isinstance(values, np.memmap):
+                mapped += values.nbytes
+            else:
+                private += values.nbytes
+        return private, mapped
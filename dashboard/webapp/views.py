@@ -1,68 +1,238 @@
 from flask import render_template, make_response
-from flask import send_file
+from flask import send_file, jsonify, Response
 from webapp import app
-from flask import request
-from webapp.matplotlib_funcs import make_heatmap, linear_regression_lassocoefs
-import pandas as pd
-import folium
-import urllib
-from jinja2 import Template
+from flask import request, g
+from webapp.matplotlib_funcs import heatmap_png, prediction_png_value, cache_stats
+from webapp.matplotlib_funcs import heatmap_key, prediction_key, heatmap_data, prediction_data
+from webapp.offload import pool, Overloaded
+from webapp.warmup import state as warmup_state
+from webapp.figcache import figures, figure_etag
+from webapp.datastore import store, MissingArtifact
+from webapp.modelcache import ModelCache, merge_stats
+from webapp.forecasts import parse_request, check_grid, forecast_grid
+from webapp.shapes import map_data, map_key, parse_bbox
+from webapp.spatial import area_zipcodes
+from webapp.metrics import registry, render, begin_request, end_request, profile_threshold, SamplingProfiler
+import numpy as np
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger('webapp.timing')
+
+# predicted values by prediction_key, next to the plots in the figure cache
+prediction_values = ModelCache(maxsize=1024)
+
+
+def cached_png(key, render):
+    # serve the image cached under key, rendering it first if needed. answers
+    # If-None-Match / If-Modified-Since with a 304
+    if figure_etag(key) in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(figure_etag(key))
+        return response
+
+    png, etag, last_modified = figures.get_or_render(key, render)
+
+    response = make_response(png)
+    response.mimetype = 'image/png'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+
+    return response.make_conditional(request)
+
+
+def prediction_png(key, *args):
+    # the /predict plot. the same computation gives the /prediction value, kept for it
+    png, value = pool.run(key, prediction_png_value, *args)
+    prediction_values.get_or_fit(key, lambda: value)
+    return png
+
+
+def prediction_value(key, *args):
+    # the /prediction value. the same computation gives the /predict plot, cached for it
+    png, value = pool.run(key, prediction_png_value, *args)
+    figures.get_or_render(key, lambda: png)
+    return value
+
+
+def worker_cache_stats():
+    # model and feature cache stats summed over the processes that fit the models:
+    # the pool workers, or this process without a pool
+    reports = pool.worker_reports(cache_stats).values()
+    return dict((cache, merge_stats([report[cache] for report in reports])) for cache in ['models', 'features'])
+
+
+@app.before_request
+def start_timing():
+    # stage timers in this thread add to this request from here on
+    begin_request()
+    g.start = time.time()
+    g.profiler = None
+    if profile_threshold() is not None:
+        g.profiler = SamplingProfiler(threading.get_ident()).start()
+
+
+@app.after_request
+def finish_timing(response):
+    # count the request, and log one json line with its time in each stage
+    seconds = time.time() - g.get('start', time.time())
+    stages = end_request() or {}
+    endpoint = request.endpoint or 'none'
+
+    registry.inc('dashboard_requests_total', labels=(('endpoint', endpoint), ('status', response.status_code)),
+                 help='Requests served, by endpoint and status code')
+    registry.observe('dashboard_request_seconds', seconds, labels=(('endpoint', endpoint),),
+                     help='Time to answer a request, by endpoint')
+
+    profile = None
+    profiler = g.get('profiler')
+    if profiler is not None:
+        profiler.stop()
+        if seconds >= profile_threshold():
+            directory = os.environ.get('PROFILE_DIR', 'profiles')
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            profile = profiler.dump(os.path.join(directory, '%s-%d-%d.folded'
+                                                 % (endpoint, int(time.time() * 1000), threading.get_ident())))
+
+    logger.info(json.dumps({'endpoint' : endpoint,
+                            'path' : request.full_path,
+                            'status' : response.status_code,
+                            'ms' : round(seconds * 1000., 1),
+                            'stages' : dict((stage, round(t * 1000., 1)) for stage, t in stages.items()),
+                            'profile' : profile}))
+
+    return response
+
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    # shed load instead of queueing without bound
+    response = jsonify(error=str(e))
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+@app.errorhandler(MissingArtifact)
+def missing_artifact(e):
+    # a data file the pipeline has not built yet, not a bug in the request
+    response = jsonify(error=str(e), missing=e.path)
+    response.status_code = 503
+    return response
 
 
 @app.route('/heatmap/')
 def heatmap():
 
-    from io import BytesIO
-    import random
-    import matplotlib.pyplot as plt
-    from matplotlib.figure import Figure
-    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+    # use this to get the values of user input from the form, with the page's defaults
+    startdate = request.args.get('startdate', '1/5/2015')
+    enddate = request.args.get('enddate', '7/1/2015')
+    zipcode = request.args.get('zipcode', 'all')
+    pickup_deliv = request.args.get('pickup_deliv', 'Pickups and Deliveries')
 
     try:
-        # use this to get the values of user input from the form
-        startdate = request.args.get('startdate')
-        enddate = request.args.get('enddate')
-        zipcode = request.args.get('zipcode')
-        pickup_deliv = request.args.get('pickup_deliv')
-    except ValueError:
-        startdate = '1/5/2015'
-        enddate = '7/1/2015'
-        zipcode = 'all'
-        pickup_deliv = 'Pickups and Deliveries'
+        key = heatmap_key(pickup_deliv, startdate, enddate, zipcode=zipcode)
+        return cached_png(key, lambda: pool.run(key, heatmap_png, pickup_deliv, startdate, enddate, zipcode))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
 
-    fig = make_heatmap(pickup_deliv, startdate, enddate, zipcode=zipcode)
 
-    imgIO = BytesIO()
-    fig.savefig(imgIO, bbox_inches='tight')
-    imgIO.seek(0)
+@app.route('/predict')
+def predict_future():
 
-    return send_file(imgIO, mimetype='image/png')
+    # use this to get the values of user input from the form, with the page's defaults
+    date_to_predict = request.args.get('date_to_predict', '2015-11-11')
+    zipcode_to_predict = request.args.get('zipcode_to_predict', 'all')
+    pickup_deliv_predict = request.args.get('pickup_deliv_predict', 'Pickups and Deliveries')
 
+    try:
+        key = prediction_key(pickup_deliv_predict, zipcode_to_predict, date_to_predict)
+        return cached_png(key, lambda: prediction_png(key, pickup_deliv_predict, zipcode_to_predict, date_to_predict))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
 
-@app.route('/predict')
-def predict_future():
 
-    from io import BytesIO
+@app.route('/heatmap_data')
+def heatmap_json():
+    # the counts behind /heatmap/, for drawing the heatmap in the browser
+    startdate = request.args.get('startdate', '1/5/2015')
+    enddate = request.args.get('enddate', '7/1/2015')
+    zipcode = request.args.get('zipcode', 'all')
+    pickup_deliv = request.args.get('pickup_deliv', 'Pickups and Deliveries')
 
+    # unknown stop types, unreadable dates and malformed zipcodes are the caller's fault
     try:
-        # use this to get the values of user input from the form
-        date_to_predict = request.args.get('date_to_predict')
-        zipcode_to_predict = request.args.get('zipcode_to_predict')
-        pickup_deliv_predict = request.args.get('pickup_deliv_predict')
-    except ValueError:
-        date_to_predict = '2015-11-11'
-        zipcode_to_predict = 'all'
-        pickup_deliv_predict = 'Pickups and Deliveries'
+        key = ('data',) + heatmap_key(pickup_deliv, startdate, enddate, zipcode=zipcode)
+        return jsonify(pool.run(key, heatmap_data, pickup_deliv, startdate, enddate, zipcode))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
 
-    fig, date_to_predict_y, _, _ = linear_regression_lassocoefs(pickup_deliv_predict, zipcode_to_predict, date_to_predict)
 
-    print(date_to_predict_y)
+@app.route('/predict_data')
+def predict_json():
+    # the series behind /predict, for drawing the plot in the browser
+    date_to_predict = request.args.get('date_to_predict', '2015-11-11')
+    zipcode_to_predict = request.args.get('zipcode_to_predict', 'all')
+    pickup_deliv_predict = request.args.get('pickup_deliv_predict', 'Pickups and Deliveries')
 
-    imgIO = BytesIO()
-    fig.savefig(imgIO, bbox_inches='tight')
-    imgIO.seek(0)
+    # as are unknown zipcodes or regions and dates outside the forecast
+    try:
+        key = ('data',) + prediction_key(pickup_deliv_predict, zipcode_to_predict, date_to_predict)
+        return jsonify(pool.run(key, prediction_data, pickup_deliv_predict, zipcode_to_predict, date_to_predict))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+
+@app.route('/forecast', methods=['GET', 'POST'])
+def forecast():
+    # forecasts for lists of stop types, zipcodes/regions and dates in one call.
+    # POST a json body {"stop_types": [...], "zips": [...], "dates": [...]} (or
+    # "start" and "days" instead of "dates"), or GET with repeated stop_type, zip and
+    # date arguments. stream=1 sends one json line per stop type and zip, each stop
+    # type as soon as its forecasts are computed
+    if request.method == 'POST':
+        params = request.get_json(force=True, silent=True)
+    else:
+        params = {'stop_types' : request.args.getlist('stop_type'),
+                  'zips' : request.args.getlist('zip'),
+                  'dates' : request.args.getlist('date'),
+                  'start' : request.args.get('start'),
+                  'days' : request.args.get('days'),
+                  'stream' : request.args.get('stream')}
 
-    return send_file(imgIO, mimetype='image/png')
+    try:
+        stop_types, zips, dates, stream = parse_request(params)
+        check_grid(stop_types, zips, dates)
+        if not stream:
+            key = ('forecast', tuple(stop_types), tuple(zips), tuple(dates))
+            values = np.round(pool.run(key, forecast_grid, stop_types, zips, dates), 2)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    if stream:
+        def lines():
+            yield json.dumps({'stop_types' : stop_types, 'zips' : zips, 'dates' : dates}) + '\n'
+            for stop_type in stop_types:
+                # the status line is already sent, so errors end the stream with an error line
+                try:
+                    key = ('forecast', (stop_type,), tuple(zips), tuple(dates))
+                    row = np.round(pool.run(key, forecast_grid, [stop_type], zips, dates)[0], 2)
+                except (ValueError, Overloaded) as e:
+                    yield json.dumps({'stop_type' : stop_type, 'error' : str(e)}) + '\n'
+                    return
+                for zipcode, zip_values in zip(zips, row):
+                    yield json.dumps({'stop_type' : stop_type, 'zip' : zipcode,
+                                      'values' : zip_values.tolist()}) + '\n'
+        return Response(lines(), mimetype='application/x-ndjson')
+
+    # values[stop type][zip][date]
+    return jsonify(stop_types=stop_types, zips=zips, dates=dates, values=values.tolist())
 
 
 @app.route('/')
@@ -82,14 +252,12 @@ def hourly_volume():
     if request.method == 'POST':
         try:
             # use this to get the values of user input from the form
-            print('method is POST')
-            startdate = request.form.get('startdate')
-            enddate = request.form.get('enddate')
-            zipcode = request.form.get('zipcode')
-            pickup_deliv = request.form.get('pickup_deliv')
+            startdate = request.form.get('startdate', startdate)
+            enddate = request.form.get('enddate', enddate)
+            zipcode = request.form.get('zipcode', zipcode)
+            pickup_deliv = request.form.get('pickup_deliv', pickup_deliv)
         except ValueError:
-            print('ValueError!')
-            pass
+            logging.getLogger(__name__).debug('could not read the form')
 
     return render_template("hourly_volume.html", startdate=startdate, enddate=enddate, pickup_deliv=pickup_deliv, zipcode=zipcode)
 
@@ -104,15 +272,15 @@ def prediction():
     if request.method == 'POST':
         try:
             # use this to get the values of user input from the form
-            print('method is POST')
-            date_to_predict = request.form.get('date_to_predict')
-            zipcode_to_predict = request.form.get('zipcode_to_predict')
-            pickup_deliv_predict = request.form.get('pickup_deliv_predict')
+            date_to_predict = request.form.get('date_to_predict', date_to_predict)
+            zipcode_to_predict = request.form.get('zipcode_to_predict', zipcode_to_predict)
+            pickup_deliv_predict = request.form.get('pickup_deliv_predict', pickup_deliv_predict)
         except ValueError:
-            print('ValueError!')
-            pass
+            logging.getLogger(__name__).debug('could not read the form')
 
-    _, date_to_predict_y, _, _ = linear_regression_lassocoefs(pickup_deliv_predict, zipcode_to_predict, date_to_predict)
+    # same key as the /predict plot on this page, so the one computation serves both
+    key = prediction_key(pickup_deliv_predict, zipcode_to_predict, date_to_predict)
+    date_to_predict_y = prediction_values.get_or_fit(key, lambda: prediction_value(key, pickup_deliv_predict, zipcode_to_predict, date_to_predict))
     date_to_predict_y = round(date_to_predict_y,1)
 
     return render_template("prediction.html", date_to_predict=date_to_predict, zipcode_to_predict=zipcode_to_predict, pickup_deliv_predict=pickup_deliv_predict, date_to_predict_y=date_to_predict_y)
@@ -128,3 +296,100 @@ def map_totalstops():
 @app.route('/map_travelcost')
 def map_travelcost():
     return render_template("map_travelcost_shapes.html")
+
+
+
+@app.route('/map_data')
+def map_json():
+    # zipcode shapes overlapping bbox=west,south,east,north, simplified for the map's
+    # zoom, with the zip_summary_2 column metric as each shape's value.
+    # format=geojson decodes the topojson for clients without a topojson reader
+    fmt = request.args.get('format', 'topojson')
+    metric = request.args.get('metric') or None
+
+    try:
+        bbox = parse_bbox(request.args.get('bbox', '-180,-90,180,90'))
+        zoom = float(request.args.get('zoom', 0))
+        key = map_key(bbox, zoom, metric, fmt)
+        etag = figure_etag(key)
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+            response.set_etag(etag)
+            return response
+        data = map_data(bbox, zoom, metric, fmt)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    response = make_response(json.dumps(data, separators=(',', ':')))
+    response.mimetype = 'application/json'
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+
+    return response.make_conditional(request)
+
+
+
+@app.route('/area')
+def area():
+    # zipcodes whose centroid is inside area=radius:lat,lng,km or
+    # area=polygon:lat,lng;lat,lng;... the same area string can be given as the
+    # zipcode to /predict, /predict_data and /forecast
+    area = request.args.get('area', '')
+    try:
+        zipcodes = area_zipcodes(area)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(area=area, zipcodes=zipcodes)
+
+
+
+@app.route('/datastore')
+def datastore_stats():
+    # load time and memory held for each data file loaded by this worker
+    return jsonify(artifacts=store.stats())
+
+
+
+@app.route('/modelcache')
+def modelcache_stats():
+    # hit rate and fit times of the fitted model and feature caches, summed over the
+    # pool workers that hold them, and of this server's figure cache
+    stats = worker_cache_stats()
+    return jsonify(models=stats['models'], features=stats['features'], figures=figures.stats(),
+                   workers=pool.worker_reports(cache_stats))
+
+
+
+@app.route('/offload')
+def offload_stats():
+    # process pool queue, coalesced and refused requests in this server
+    return jsonify(pool.stats())
+
+
+
+@app.route('/ready')
+def ready():
+    # 200 once warmup has loaded the data and primed the caches, 503 until then
+    if not warmup_state['ready']:
+        return jsonify(ready=False), 503
+    return jsonify(ready=True, warmup=warmup_state['steps'])
+
+
+
+@app.route('/metrics')
+def metrics():
+    # request and stage timings, plus the cache and pool counters, in prometheus text format.
+    # the model and feature caches are the pool workers', as last reported with their results
+    gauges = []
+    worker_stats = worker_cache_stats()
+    for cache, stats in [('models', worker_stats['models']), ('features', worker_stats['features']), ('figures', figures.stats())]:
+        for name in ['size', 'hits', 'misses', 'hit_rate']:
+            gauges.append(('dashboard_cache_%s' % name, 'Cache %s, by cache' % name.replace('_', ' '),
+                           [((('cache', cache),), stats[name])]))
+    offload = pool.stats()
+    for name in ['in_flight', 'submitted', 'coalesced', 'shed', 'inline']:
+        gauges.append(('dashboard_offload_%s' % name, 'Offloaded computations %s' % name.replace('_', ' '),
+                       [((), offload[name])]))
+    gauges.append(('dashboard_ready', 'Whether warmup has finished', [((), warmup_state['ready'])]))
+
+    return Response(render(registry, gauges), mimetype='text/plain; version=0.0.4')
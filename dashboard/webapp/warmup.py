@@ -0,0 +1,132 @@
+# coding: utf-8
+
+'''Preload data files and prime the caches before a worker takes traffic
+
+Heavy imports (sklearn, matplotlib) are deferred until a route needs them, and
+every data file, fitted model and feature table is loaded on first use. warmup()
+does all of that up front, so a freshly started worker answers its first request
+as fast as its thousandth. serve.py and run.py call start_warmup, which runs it in
+the background while the server already listens, and /ready answers 503 until it
+is done. serve.py also runs it in every pool worker as it starts.
+'''
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from webapp.cube import load_cube
+from webapp.datastore import store
+from webapp.forecasts import forecast_grid
+from webapp.matplotlib_funcs import STOP_TYPES, HEATMAP_PATHS, lassocoefs_model, new_figure, lasso_paths
+from webapp.regions import series_paths
+from webapp.spatial import centroid_index
+from webapp.storage import MappedTable, INDEX_KEY
+
+
+#set once start_warmup has finished in this process
+state = {'ready' : False, 'steps' : None}
+
+logger = logging.getLogger('webapp.warmup')
+
+
+def _load_artifacts(outdir, stop_type):
+    table = STOP_TYPES[stop_type][0]
+    for path in series_paths(outdir, table):
+        store.get(path, MappedTable)
+    for path in lasso_paths(outdir, stop_type):
+        store.get(path, pd.read_pickle)
+    store.get(HEATMAP_PATHS[stop_type] + '_cube', load_cube)
+
+
+def _prime_forecasts(outdir, stop_type):
+    table = STOP_TYPES[stop_type][0]
+    lastdate = store.get(outdir + 'di_%s_allcounts' % table, MappedTable).column(INDEX_KEY)[-1]
+    forecast_grid([stop_type], ['all'], [str(lastdate)], outdir=outdir)
+
+
+def warmup(outdir='', fit_models=True):
+    '''Import the plotting and model libraries, load every artifact and fit the
+    default models of every stop type
+
+    A step that fails (a missing data file, say) is recorded and skipped, so a
+    partial deploy still comes up.
+
+    Parameters
+    ----------
+    outdir: string
+        place where the dataprep tables are stored
+    fit_models: bool
+        fit the default models and forecasts. the server process skips them when
+        a process pool does the fitting
+
+    Returns
+    -------
+    steps: OrderedDict
+        seconds taken by each step, or the error it raised
+    '''
+    steps = OrderedDict()
+
+    def step(name, fn, *args):
+        start = time.time()
+        try:
+            fn(*args)
+            steps[name] = round(time.time() - start, 3)
+        except Exception as e:
+            steps[name] = 'failed: %s' % e
+
+    #draws nothing, but imports matplotlib and the Agg backend
+    step('matplotlib', new_figure, (1, 1))
+    step('centroid index', centroid_index, outdir)
+    for stop_type in sorted(STOP_TYPES):
+        step('artifacts %s' % stop_type, _load_artifacts, outdir, stop_type)
+        if fit_models:
+            step('model %s' % stop_type, lassocoefs_model, stop_type, 'all', outdir)
+            step('forecasts %s' % stop_type, _prime_forecasts, outdir, stop_type)
+
+    return steps
+
+
+def start_warmup(outdir='', pool=None):
+    '''Run warmup in a background thread and set state['ready'] when it is done
+
+    Parameters
+    ----------
+    outdir: string
+        place where the dataprep tables are stored
+    pool: Offloader
+        the process pool, if configure() was called on it. its workers fit the
+        models (with warmup as their initializer), so this process only loads the
+        data, then starts the workers and waits for them to be warm
+
+    Returns
+    -------
+    thread: threading.Thread
+    '''
+    offloaded = pool is not None and pool.executor is not None
+
+    def run():
+        start = time.time()
+        steps = warmup(outdir, fit_models=not offloaded)
+        if offloaded:
+            step_start = time.time()
+            try:
+                pids = pool.prestart()
+                steps['workers'] = round(time.time() - step_start, 3)
+                steps['worker pids'] = pids
+            except Exception as e:
+                steps['workers'] = 'failed: %s' % e
+
+        state['steps'] = steps
+        state['ready'] = True
+        for name, seconds in steps.items():
+            logger.info('warmup %s: %s' % (name, seconds))
+        logger.info('ready in %.1fs' % (time.time() - start))
+
+    thread = threading.Thread(target=run, name='warmup')
+    thread.daemon = True
+    thread.start()
+
+    return thread
@@ -0,0 +1,318 @@
+# coding: utf-8
+
+'''Walk-forward backtest of the dashboard's demand forecasts
+
+The notebook only reported in-sample r2 and MSE, one series at a time. This replays
+the forecast the dashboard makes (linear regression on the lasso-selected
+features, as in matplotlib_funcs.fit_lassocoefs_model) from a series of past
+origins: fit on the days before an origin, forecast the next horizon days, compare
+with what happened. Every stop type's whole market, city and cluster rollup and
+zipcode is evaluated.
+
+- the training days grow from the first day (expanding) or keep a fixed length
+  (sliding), and origins are step days apart
+- one make_regression_features_oct matrix covers every date. the series of a stop
+  type that share a feature selection share one design matrix per fold, so each
+  fold is one least-squares factorization and a matrix product for all of them
+- blocks of series are spread over worker processes, which get the feature matrix
+  and the folds once when they start
+
+Errors are summed over every forecast day of every fold. The table saved at
+outdir + 'backtest_errors' (storage.write_table) has, per stop type and series,
+MAE, RMSE, MAPE (over days with events), WAPE, bias (mean forecast minus actual)
+and MASE against repeating the last observed week. backtest_errors.json records
+the settings.
+
+The features are the current lasso selection, chosen with every day of data, so
+the selection itself is not walked forward; the coefficients are.
+
+    python backtest.py --outdir ../dashboard/ --horizon 28 --step 14 --workers 4
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from instrument import stage
+from lassoselect import import_dashboard, load_series
+from storage import write_table
+
+
+ERRORS_TABLE = 'backtest_errors'
+SETTINGS_FILE = 'backtest_errors.json'
+
+WINDOWS = ('expanding', 'sliding')
+
+#seasonal naive forecast the errors are scaled by: the last week before the origin
+SEASON = 7
+
+#worker process state, set by _init_worker
+_shared = {}
+
+
+def make_folds(n_samples, horizon=28, step=None, initial=180, window='expanding'):
+    '''Rolling-origin folds over n_samples days
+
+    Parameters
+    ----------
+    horizon: int
+        days forecast from each origin
+    step: int
+        days between origins. default horizon, so test periods don't overlap
+    initial: int
+        training days before the first origin, and the length of every training
+        window when sliding
+    window: string
+        'expanding' trains on every day before the origin, 'sliding' on the
+        initial days before it
+
+    Returns
+    -------
+    folds: list of (train_start, origin) pairs
+        train on rows train_start to origin - 1, test on origin to origin + horizon - 1
+    '''
+    if window not in WINDOWS:
+        raise ValueError('window must be one of %s' % (WINDOWS,))
+    step = step or horizon
+    if horizon < 1 or step < 1 or initial < SEASON:
+        raise ValueError('horizon and step must be positive and initial at least %d days' % SEASON)
+
+    origins = range(initial, n_samples - horizon + 1, step)
+    folds = [(0 if window == 'expanding' else origin - initial, origin) for origin in origins]
+    if not folds:
+        raise ValueError('%d days is too short for %d training and %d forecast days' % (n_samples, initial, horizon))
+
+    return folds
+
+
+def _init_worker(X, folds, horizon):
+    _shared['X'] = X
+    _shared['folds'] = folds
+    _shared['horizon'] = horizon
+    #least-squares solvers by (feature columns, fold), reused by every block of
+    #series with the same selection
+    _shared['solvers'] = {}
+
+
+def _solver(columns, fold):
+    '''Pseudo-inverse of the centered training features of a fold, with the column
+    means, for fitting any number of series on them
+    '''
+    key = (columns, fold)
+    if key not in _shared['solvers']:
+        start, origin = _shared['folds'][fold]
+        X = _shared['X'][start:origin][:, list(columns)]
+        X_offset = X.mean(axis=0)
+        #same minimum-norm solution and cutoff as batchfit.BatchLinearRegression
+        U, s, Vt = np.linalg.svd(X - X_offset, full_matrices=False)
+        keep = s > np.finfo(float).eps * max(X.shape) * s[0]
+        s_inv = np.zeros_like(s)
+        s_inv[keep] = 1. / s[keep]
+        _shared['solvers'][key] = (np.dot(Vt.T * s_inv, U.T), X_offset)
+
+    return _shared['solvers'][key]
+
+
+def backtest_block(columns, Y):
+    '''Error sums of every series in Y over every fold
+
+    Parameters
+    ----------
+    columns: tuple of ints
+        columns of the shared feature matrix the series are fitted on
+    Y: array, days x series
+
+    Returns
+    -------
+    sums: dict
+        arrays (one value per series) of 'n', 'abs', 'sq', 'err', 'actual', 'ape',
+        'ape_n' and 'naive_abs'
+    '''
+    X = _shared['X']
+    horizon = _shared['horizon']
+    n_series = Y.shape[1]
+    sums = dict((name, np.zeros(n_series)) for name in ['abs', 'sq', 'err', 'actual', 'ape', 'ape_n', 'naive_abs'])
+    sums['n'] = np.zeros(n_series)
+
+    for fold, (start, origin) in enumerate(_shared['folds']):
+        pinv, X_offset = _solver(columns, fold)
+        Y_train = Y[start:origin]
+        Y_offset = Y_train.mean(axis=0)
+        coef = np.dot(pinv, Y_train - Y_offset)
+
+        test = slice(origin, origin + horizon)
+        X_test = X[test][:, list(columns)]
+        pred = np.dot(X_test - X_offset, coef) + Y_offset
+        actual = Y[test]
+        err = pred - actual
+
+        #repeat the last week before the origin
+        lead = np.arange(len(actual))
+        naive = Y[origin - SEASON + lead % SEASON]
+
+        sums['n'] += len(actual)
+        sums['abs'] += np.abs(err).sum(axis=0)
+        sums['sq'] += (err ** 2).sum(axis=0)
+        sums['err'] += err.sum(axis=0)
+        sums['actual'] += np.abs(actual).sum(axis=0)
+        sums['naive_abs'] += np.abs(naive - actual).sum(axis=0)
+        positive = actual > 0
+        sums['ape'] += np.where(positive, np.abs(err) / np.where(positive, actual, 1.), 0.).sum(axis=0)
+        sums['ape_n'] += positive.sum(axis=0)
+
+    return sums
+
+
+def _run_block(task):
+    stop_type, names, columns, Y = task
+    return stop_type, names, backtest_block(columns, Y)
+
+
+def error_table(stop_type, names, sums, means):
+    '''Per-series error measures from the sums of backtest_block
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mae = sums['abs'] / sums['n']
+        naive_mae = sums['naive_abs'] / sums['n']
+        return pd.DataFrame({'stop_type' : stop_type,
+                             'series' : names,
+                             'mean_daily' : means,
+                             'n_days' : sums['n'].astype(int),
+                             'mae' : mae,
+                             'rmse' : np.sqrt(sums['sq'] / sums['n']),
+                             'mape' : np.where(sums['ape_n'] > 0, sums['ape'] / sums['ape_n'], np.nan),
+                             'wape' : np.where(sums['actual'] > 0, sums['abs'] / sums['actual'], np.nan),
+                             'bias' : sums['err'] / sums['n'],
+                             'naive_mae' : naive_mae,
+                             'mase' : np.where(naive_mae > 0, mae / naive_mae, np.nan)},
+                            columns=['stop_type', 'series', 'mean_daily', 'n_days', 'mae', 'rmse', 'mape',
+                                     'wape', 'bias', 'naive_mae', 'mase'])
+
+
+@stage('backtest')
+def backtest(outdir, horizon=28, step=None, initial=180, window='expanding', zips=True,
+             workers=None, chunksize=512):
+    '''Walk-forward errors of the forecast for every stop type and series
+
+    Parameters
+    ----------
+    outdir: string
+        place where time_by_zip and write_region_rollups stored their output files
+    horizon, step, initial, window:
+        fold settings, see make_folds
+    zips: bool
+        evaluate every zipcode, not only the market, cities and clusters
+    workers: int
+        worker processes. default one per cpu, 1 runs everything in this process
+    chunksize: int
+        series sent to a worker at a time
+
+    Returns
+    -------
+    errors: pandas dataframe
+        one row per stop type and series, see error_table
+    info: dict
+        the folds, their dates and the number of series
+    '''
+    matplotlib_funcs = import_dashboard()
+    stop_types = dict((stop_type, files) for stop_type, files in matplotlib_funcs.STOP_TYPES.items()
+                      if os.path.exists(outdir + 'di_%s_allcounts' % files[0]))
+    if not stop_types:
+        raise IOError('No count tables in %r, run dataprep.time_by_zip first' % outdir)
+
+    series = dict((stop_type, load_series(outdir, table, zips=zips))
+                  for stop_type, (table, coefs_file) in sorted(stop_types.items()))
+    dates = series[sorted(series)[0]].index
+    for stop_type, tbl in series.items():
+        if not tbl.index.equals(dates):
+            raise ValueError('The count tables of %s cover different dates' % stop_type)
+
+    #the one feature matrix every fold and series is fitted on
+    date_frame, X_vars = matplotlib_funcs.regression_features(dates.min(), dates.max())
+    X = X_vars.values.astype(float)
+    position = dict((feature, i) for i, feature in enumerate(X_vars.columns))
+    folds = make_folds(len(X), horizon=horizon, step=step, initial=initial, window=window)
+
+    #group each stop type's series by feature selection: the market one, and cities
+    #and clusters lassoselect chose their own for
+    tasks = []
+    for stop_type, tbl in sorted(series.items()):
+        market = tuple(matplotlib_funcs.lasso_features(outdir, stop_type))
+        groups = {}
+        for name in tbl.columns:
+            features = market
+            if name.startswith(matplotlib_funcs.REGION_PREFIXES):
+                features = tuple(matplotlib_funcs.lasso_features(outdir, stop_type, name))
+            groups.setdefault(features, []).append(name)
+
+        for features, names in groups.items():
+            columns = tuple(position[feature] for feature in features)
+            for i in range(0, len(names), chunksize):
+                chunk = names[i:i + chunksize]
+                tasks.append((stop_type, chunk, columns, tbl[chunk].values))
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        _init_worker(X, folds, horizon)
+        results = [_run_block(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(X, folds, horizon)) as executor:
+            results = list(executor.map(_run_block, tasks))
+
+    errors = pd.concat([error_table(stop_type, names, sums, series[stop_type][names].mean().values)
+                        for stop_type, names, sums in results], ignore_index=True)
+    errors = errors.sort_values(['stop_type', 'series'], kind='mergesort').reset_index(drop=True)
+
+    info = {'horizon' : horizon,
+            'step' : step or horizon,
+            'initial' : initial,
+            'window' : window,
+            'features_version' : matplotlib_funcs.FEATURES_VERSION,
+            'origins' : [date_frame['daterange_str'].iloc[origin] for start, origin in folds],
+            'series' : len(errors)}
+
+    return errors, info
+
+
+def write_errors(outdir, errors, info):
+    '''Save the error table and the settings it was made with
+
+    Returns
+    -------
+    path: string
+    '''
+    write_table(errors, outdir + ERRORS_TABLE)
+
+    tmp = outdir + SETTINGS_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(dict(info, created=time.strftime('%Y-%m-%dT%H:%M:%S')), f, indent=2)
+    os.rename(tmp, outdir + SETTINGS_FILE)
+
+    return outdir + ERRORS_TABLE
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='walk-forward backtest of the demand forecasts')
+    parser.add_argument('--outdir', default='', help='the dashboard data directory, ending with a slash')
+    parser.add_argument('--horizon', type=int, default=28, help='days forecast from each origin')
+    parser.add_argument('--step', type=int, default=None, help='days between origins, default the horizon')
+    parser.add_argument('--initial', type=int, default=180, help='training days before the first origin')
+    parser.add_argument('--window', choices=WINDOWS, default='expanding')
+    parser.add_argument('--no-zips', action='store_true', help='only the market, cities and clusters')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.time()
+    errors, info = backtest(args.outdir, horizon=args.horizon, step=args.step, initial=args.initial,
+                            window=args.window, zips=not args.no_zips, workers=args.workers)
+    write_errors(args.outdir, errors, info)
+
+    print('%d series, %d folds in %.1fs' % (len(errors), len(info['origins']), time.time() - start))
+    print(errors.groupby('stop_type')[['mae', 'wape', 'bias', 'mase']].median())
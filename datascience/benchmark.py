@@ -0,0 +1,352 @@
+# coding: utf-8
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from pytz import timezone
+
+import dataprep
+import synthetic
+
+
+#events and zipcodes at each named scale of the pipeline suite
+SCALES = [('10k', 10000, 100),
+          ('1m', 1000000, 2000),
+          ('10m', 10000000, 10000),
+          ('50m', 50000000, 40000)]
+
+#features the synthetic lasso coefficient files select
+LASSO_FEATURES = ['dayssincestart', 'dayofweek_0', 'dayofweek_1', 'dayofweek_2', 'dayofweek_3',
+                  'dayofweek_4', 'dayofweek_5', 'isweekend', 'x_isholiday', 'x_isholidaywknd',
+                  'week1', 'week4', 'isfrisat', 'istueswed']
+
+DASHBOARD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dashboard')
+
+
+def date_conv_rowwise(tbl, cols):
+    '''Original element-by-element version of dataprep.date_conv, kept as the
+    reference the vectorized version is checked and timed against
+    '''
+    local_tz = timezone('US/Pacific')
+
+    for col in cols:
+        date_converted = [pd.to_datetime(dt, utc=True) for dt in tbl[col]]
+        date_converted = [date.astimezone(local_tz) for date in date_converted]
+        tbl[col] = date_converted
+
+        critical_date = cols[0]
+        tbl['hour'] = [date.hour for date in tbl[critical_date]]
+        tbl['day'] = [date.day for date in tbl[critical_date]]
+        tbl['dayofweek'] = [date.dayofweek for date in tbl[critical_date]]
+        tbl['week'] = [date.week for date in tbl[critical_date]]
+        tbl['month'] = [date.month for date in tbl[critical_date]]
+        tbl['daterange_str'] = [date.strftime('%Y-%m-%d') for date in tbl[critical_date]]
+
+    return tbl
+
+
+def make_timestamps(n_rows, cols, seed=0):
+    '''Make a table of n_rows random UTC timestamp strings in each of cols,
+    formatted the way the move loot json exports hold them
+    '''
+    rs = np.random.RandomState(seed)
+    start = np.datetime64('2015-01-01T00:00:00', 's')
+    span = 365 * 24 * 3600
+
+    tbl = pd.DataFrame()
+    for col in cols:
+        stamps = start + rs.randint(0, span, n_rows).astype('timedelta64[s]')
+        tbl[col] = np.datetime_as_string(stamps, unit='s').astype(object)
+
+    return tbl
+
+
+def timed(func, *args):
+    '''Call func(*args) and return its result with the wall time in seconds
+    '''
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def bench_date_conv(sizes, cols=('pickup_date', 'created_at'), check_rows=100000, rowwise=True):
+    '''Time dataprep.date_conv against the row-wise reference
+
+    Parameters
+    ----------
+    sizes: list of ints
+        numbers of rows to time at
+    cols: tuple of strings
+        datetime columns to convert. the first is the critical date
+    check_rows: int
+        the two versions are compared for identical output on this many rows
+    rowwise: bool
+        if False, only the vectorized version is timed. the row-wise version
+        takes several minutes at 10M rows
+
+    Returns
+    -------
+    results: list of dicts
+        one entry per size with the timings in seconds and the speedup
+    '''
+    cols = list(cols)
+
+    sample = make_timestamps(check_rows, cols)
+    expected = date_conv_rowwise(sample.copy(), cols)
+    actual = dataprep.date_conv(sample.copy(), cols)
+    for col in expected.columns:
+        if not np.array_equal(np.asarray(expected[col], dtype=object),
+                              np.asarray(actual[col], dtype=object)):
+            raise AssertionError('date_conv output differs from reference in %s' % col)
+
+    results = []
+    for n_rows in sizes:
+        tbl = make_timestamps(n_rows, cols)
+        _, vectorized = timed(dataprep.date_conv, tbl.copy(), cols)
+        result = {'stage' : 'date_conv', 'rows' : n_rows, 'vectorized_s' : vectorized}
+        if rowwise:
+            _, reference = timed(date_conv_rowwise, tbl.copy(), cols)
+            result['rowwise_s'] = reference
+            result['speedup'] = reference / vectorized
+        results.append(result)
+
+    return results
+
+
+def environment():
+    '''Versions and machine details recorded with each set of results
+    '''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_commit' : commit,
+            'python' : platform.python_version(),
+            'pandas' : pd.__version__,
+            'numpy' : np.__version__,
+            'machine' : platform.machine(),
+            'cpus' : os.cpu_count()}
+
+
+def import_dashboard():
+    '''Import the dashboard's plotting module, and its caches so they can be reset
+    '''
+    if DASHBOARD_DIR not in sys.path:
+        sys.path.insert(0, DASHBOARD_DIR)
+    from webapp import matplotlib_funcs
+    from webapp.datastore import store
+
+    return matplotlib_funcs, store
+
+
+def check_batchfit(stop_type='Deliveries', max_series=20, tolerance=1e-8, outdir=''):
+    '''Check the dashboard's one-step fit of every series, batchfit.batch_forecasts,
+    against the per-series sklearn fit it replaces, matplotlib_funcs.fit_lassocoefs_model.
+    run from the directory the dashboard reads its data from
+
+    Parameters
+    ----------
+    stop_type: string
+        'Pickups and Deliveries', 'Deliveries' or 'Pickups'
+    max_series: int
+        number of series, spread over the zipcodes and regions, fitted one by one
+    tolerance: float
+        largest difference allowed in y_pred and y_pred_future, relative to the
+        series' largest prediction
+
+    Returns
+    -------
+    worst: float
+        largest relative difference found
+    '''
+    matplotlib_funcs, _ = import_dashboard()
+    from webapp.batchfit import batch_forecasts
+
+    forecasts = batch_forecasts(stop_type, outdir)
+    names = list(forecasts['y'].columns)
+    step = max(1, len(names) // max_series)
+
+    worst = 0.
+    for name in names[::step][:max_series]:
+        model = matplotlib_funcs.fit_lassocoefs_model(stop_type, name, outdir)
+        for key in ['y_pred', 'y_pred_future']:
+            expected = np.asarray(model[key], dtype=float)
+            diff = np.abs(expected - forecasts[key][name].values).max() / max(1., np.abs(expected).max())
+            if diff > tolerance:
+                raise AssertionError('batch_forecasts %s of %s differs from the per-series fit by %g'
+                                     % (key, name, diff))
+            worst = max(worst, diff)
+
+    return worst
+
+
+def bench_pipeline(n_events, n_zips, workdir, seed=0):
+    '''Run each pipeline stage once on a synthetic dataset and time it
+
+    Stages are date_conv, rep_by_zip, summarize_by_zip, time_by_zip,
+    summarize_by_zip_dataframe, and the dashboard's make_heatmap and
+    linear_regression_lassocoefs (cold, then again with the model cached). The
+    batch fit of every series is checked against the per-series fit on the way.
+
+    Parameters
+    ----------
+    n_events: int
+        orders and submissions together
+    n_zips: int
+        number of zipcodes the events are spread over
+    workdir: string
+        directory for the synthetic inputs and every output, laid out the way the
+        dashboard expects. ends with a slash
+
+    Returns
+    -------
+    results: list of dicts
+        one per stage, with 'stage', 'events', 'zips' and 'seconds'
+    '''
+    datadir = workdir + 'webapp/static/data/'
+    if not os.path.exists(datadir):
+        os.makedirs(datadir)
+
+    results = []
+
+    def record(stage, seconds, **extra):
+        result = {'stage' : stage, 'events' : n_events, 'zips' : n_zips, 'seconds' : seconds}
+        result.update(extra)
+        results.append(result)
+        print(result)
+        sys.stdout.flush()
+
+    paths, seconds = timed(synthetic.make_dataset, workdir, n_events, n_zips, '2015-01-01', '2015-07-31', seed)
+    record('generate', seconds)
+
+    raw = pd.read_json(paths['orders'])
+    _, seconds = timed(dataprep.date_conv, raw, ['delivery_date', 'created_at'])
+    record('date_conv', seconds, rows=len(raw))
+    del raw
+
+    orders, seconds = timed(dataprep.rep_by_zip, paths['orders'], ['delivery_date', 'created_at'],
+                            datadir, 'orderzips_filt')
+    record('rep_by_zip', seconds, rows=len(orders))
+    submissions, _ = timed(dataprep.rep_by_zip, paths['submissions'], ['pickup_date', 'created_at'],
+                           datadir, 'submissionzips_filt')
+
+    tbl = pd.DataFrame({'keydate' : orders['delivery_date'].values,
+                        'zipcode' : orders['zipcode'].astype(str).values})
+    _, seconds = timed(dataprep.summarize_by_zip, tbl)
+    record('summarize_by_zip', seconds, rows=len(tbl))
+
+    tables, seconds = timed(dataprep.time_by_zip, orders.copy(), submissions.copy(), workdir)
+    record('time_by_zip', seconds)
+    di_submissions_allcounts, di_orders_allcounts, di_subandord_allcounts, date_frame = tables
+
+    _, seconds = timed(dataprep.summarize_by_zip_dataframe, submissions, orders, date_frame,
+                       di_orders_allcounts, di_submissions_allcounts, di_subandord_allcounts,
+                       paths['zip_summary'], workdir)
+    record('summarize_by_zip_dataframe', seconds)
+
+    for name in ['lasso_coefs_ords.pkl', 'lasso_coefs_subs.pkl', 'lasso_coefs_subandords.pkl']:
+        pd.DataFrame({'var' : LASSO_FEATURES}).to_pickle(workdir + name)
+
+    #the dashboard reads its files relative to the working directory
+    matplotlib_funcs, store = import_dashboard()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        store.clear()
+        matplotlib_funcs.models.clear()
+        matplotlib_funcs.feature_cache.clear()
+
+        _, seconds = timed(matplotlib_funcs.make_heatmap, 'Deliveries', '1/5/2015', '7/1/2015', 'all')
+        record('make_heatmap', seconds)
+
+        for cache in ['cold', 'warm']:
+            _, seconds = timed(matplotlib_funcs.linear_regression_lassocoefs, 'Deliveries', 'all', '2015-11-11')
+            record('linear_regression_lassocoefs', seconds, cache=cache)
+
+        worst, seconds = timed(check_batchfit, 'Deliveries')
+        record('check_batchfit', seconds, max_diff=worst)
+    finally:
+        os.chdir(cwd)
+
+    return results
+
+
+def result_key(result):
+    return (result['stage'], result['events'], result['zips'], result.get('cache'))
+
+
+def compare(baseline, results, threshold=1.2):
+    '''Print the ratio of each stage's time to the same stage in a baseline run
+
+    Returns
+    -------
+    slower: list of dicts
+        results more than threshold times slower than the baseline
+    '''
+    before = dict((result_key(result), result['seconds']) for result in baseline['results'])
+
+    slower = []
+    for result in results['results']:
+        key = result_key(result)
+        if key not in before:
+            continue
+        ratio = result['seconds'] / max(before[key], 1e-9)
+        print('%-30s %10d events %6d zips  %8.3fs -> %8.3fs  x%.2f'
+              % (result['stage'] + (' (%s)' % result['cache'] if result.get('cache') else ''),
+                 result['events'], result['zips'], before[key], result['seconds'], ratio))
+        if ratio > threshold:
+            slower.append(result)
+
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='time the dataprep stages')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000000, 10000000])
+    parser.add_argument('--skip-rowwise', action='store_true',
+                        help='only time the vectorized implementation')
+    parser.add_argument('--scales', nargs='+', choices=[name for name, _, _ in SCALES],
+                        help='run the whole pipeline on synthetic data at these scales instead')
+    parser.add_argument('--workdir', default=None,
+                        help='where to write the synthetic data and outputs. default a new temporary directory')
+    parser.add_argument('--output', default=None, help='save the results as json')
+    parser.add_argument('--compare', default=None,
+                        help='json results of an earlier run to compare against, eg. benchmark_baseline.json '
+                             '(--scales 10k)')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='with --compare, exit with status 1 if a stage got this many times slower')
+    args = parser.parse_args()
+
+    if args.scales is None:
+        for result in bench_date_conv(args.sizes, rowwise=not args.skip_rowwise):
+            print(result)
+        sys.exit(0)
+
+    root = args.workdir or tempfile.mkdtemp(prefix='moveloot_bench_')
+    results = {'environment' : environment(), 'results' : []}
+    for name, n_events, n_zips in SCALES:
+        if name not in args.scales:
+            continue
+        workdir = os.path.join(root, name, '')
+        results['results'] += bench_pipeline(n_events, n_zips, workdir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, threshold=args.threshold):
+            sys.exit(1)
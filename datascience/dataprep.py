@@ -13,7 +13,88 @@ import itertools
 import os, sys
 import json
 
+from storage import (read_table, write_table, migrate_pickle, new_version, publish_version, zip_labels,
+                     INDEX_KEY)
+from instrument import stage, logger
 
+
+def to_local_time(dates, local_tz):
+    '''Parse a column of timestamps as UTC and convert it to a local timezone
+
+    Parameters
+    ----------
+    dates: pandas series
+        timestamps as strings, datetimes or datetime64 values. naive values are
+        assumed to be UTC
+    local_tz: pytz timezone
+        timezone to convert to
+
+    Returns
+    -------
+    local: pandas series
+        tz-aware datetime64 series in local_tz, with the same index as dates
+    '''
+    utc = pd.to_datetime(dates, utc=True)
+    #older pandas hands back naive utc values for a series
+    if utc.dt.tz is None:
+        utc = utc.dt.tz_localize('UTC')
+
+    return utc.dt.tz_convert(local_tz)
+
+
+def calendar_fields(dates):
+    '''Break a datetime series out into hour, day, dayofweek, week, month and
+    daterange_str columns
+
+    Parameters
+    ----------
+    dates: pandas series
+        datetime64 series, tz-aware or naive. fields are taken from wall time
+
+    Returns
+    -------
+    fields: pandas dataframe
+        one row per entry in dates, with the columns listed above
+    '''
+    if hasattr(dates.dt, 'isocalendar'):
+        week = dates.dt.isocalendar().week
+    else:
+        week = dates.dt.week
+
+    fields = pd.DataFrame({'hour' : dates.dt.hour.values.astype('int64'),
+                           'day' : dates.dt.day.values.astype('int64'),
+                           'dayofweek' : dates.dt.dayofweek.values.astype('int64'),
+                           'week' : np.asarray(week, dtype='int64'),
+                           'month' : dates.dt.month.values.astype('int64'),
+                           'daterange_str' : date_strings(dates)},
+                          index=dates.index,
+                          columns=['hour', 'day', 'dayofweek', 'week', 'month', 'daterange_str'])
+
+    return fields
+
+
+def date_strings(dates):
+    '''Format a datetime series as 'YYYY-MM-DD' strings of its wall-clock date
+
+    Parameters
+    ----------
+    dates: pandas series
+        datetime64 series, tz-aware or naive
+
+    Returns
+    -------
+    strings: numpy array
+        object array of date strings, one per entry in dates
+    '''
+    #go through datetime64[D] so the strings come straight from numpy
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_localize(None)
+    days = dates.values.astype('datetime64[D]')
+
+    return np.datetime_as_string(days, unit='D').astype(object)
+
+
+@stage('date_conv')
 def date_conv(tbl, cols):
     '''Converts dates to proper format and timezone and creates columns for hour, day, etc
 
@@ -37,25 +118,21 @@ def date_conv(tbl, cols):
     #set timezone to pacific since data was from san francisco bay area
     local_tz = timezone('US/Pacific')
 
-    #iterate through columns that contain datetimes
+    #convert each datetime column in one vectorized pass
     for col in cols:
-        date_converted = [pd.to_datetime(dt, utc=True) for dt in tbl[col]]
-        date_converted = [date.astimezone(local_tz) for date in date_converted]
-        tbl[col] = date_converted
-
-        critical_date = cols[0]
-        tbl['hour'] = [date.hour for date in tbl[critical_date]]
-        tbl['day'] = [date.day for date in tbl[critical_date]]
-        tbl['dayofweek'] = [date.dayofweek for date in tbl[critical_date]]
-        tbl['week'] = [date.week for date in tbl[critical_date]]
-        tbl['month'] = [date.month for date in tbl[critical_date]]
-        tbl['daterange_str'] = [date.strftime('%Y-%m-%d') for date in tbl[critical_date]]
+        tbl[col] = to_local_time(tbl[col], local_tz)
+
+    #derive calendar fields once, from the critical date
+    calendar = calendar_fields(tbl[cols[0]])
+    for field in calendar.columns:
+        tbl[field] = calendar[field].values
 
     return tbl
 
 
-def rep_by_zip(path, cols, outdir, filename):
-    '''Load initial files, convert to pd.dataframe, convert dates, and save as pkl and xls
+@stage('rep_by_zip')
+def rep_by_zip(path, cols, outdir, filename, excel=False):
+    '''Load initial files, convert to pd.dataframe, convert dates, and save in columnar format
 
     Parameters
     ----------
@@ -69,11 +146,14 @@ def rep_by_zip(path, cols, outdir, filename):
         place where output files will be stored
     filename: string
         name of files to be saved
+    excel: bool
+        if True, also save an xls copy of the table. default False
 
     Returns
     -------
     zips: pandas dataframe
-        after date conversion. also saves this as xls and pkl format for further analysis
+        after date conversion. also saves this with storage.write_table for further analysis,
+        and its date x zipcode x hour event cube as filename + '_cube'
     '''
     dtf = '%Y-%m-%d %H:%M:%S'
     local_tz = timezone('US/Pacific')
@@ -83,15 +163,99 @@ def rep_by_zip(path, cols, outdir, filename):
     zips = pd.read_json(path)
     #convert dates
     zips = date_conv(zips,cols)
-    zips = zips.sort(columns=cols[0])
+    zips = zips.sort_values(cols[0], kind='mergesort')
 
     #save data
-    zips.to_pickle(outdir + filename + '.pkl')
-    zips.to_excel(outdir + filename + '.xls', engine='openpyxl')
+    write_table(zips, outdir + filename, sort_key='daterange_str', excel=excel)
+    write_event_cube(zips, outdir + filename + '_cube')
 
     return zips
 
 
+#version of the layout event_cube writes. the first was one dense running-total
+#array for every zipcode, which grew to gigabytes with tens of thousands of zipcodes
+CUBE_FORMAT = 2
+
+
+def event_cube(tbl):
+    '''Count events by date, zipcode and hour, in a form any date range can be
+    counted from without touching the events
+
+    For all zipcodes together, total[d, h] holds the number of events at hour h on
+    day d and on every earlier day with the same day of week, so the events on any
+    one day of week over a range of dates are the difference of two entries. Single
+    zipcodes only have events on a few of the days and hours, so they are kept
+    sparse: the (day * 24 + hour, count) pairs of zipcode z, ordered by day and hour,
+    are entries zip_ptr[z] to zip_ptr[z + 1] of keys and counts.
+
+    Parameters
+    ----------
+    tbl: pandas dataframe
+        holds 'daterange_str', 'zipcode' and 'hour' columns, one row per event
+
+    Returns
+    -------
+    arrays: dict
+        'total' (int32, days x 24), 'zip_ptr' (int64, zipcodes + 1), 'keys' (int32)
+        and 'counts' (int32)
+    meta: dict
+        'format', 'start' date string, 'start_dayofweek' (monday is 0) and
+        'zipcodes', five-digit strings in zip_ptr order
+    '''
+    daterng = pd.date_range(tbl['daterange_str'].min(), tbl['daterange_str'].max(), freq='D')
+    rng = [date.strftime('%Y-%m-%d') for date in daterng]
+    n_slots = len(rng) * 24
+
+    date_ix = pd.Index(rng).get_indexer(tbl['daterange_str'])
+    hours = np.asarray(tbl['hour'], dtype=np.int64)
+
+    #the same zipcode may be a number in some rows and a string in others
+    zip_ix, zipcodes = pd.factorize(zip_labels(tbl['zipcode']), sort=True)
+    zipcodes = list(zipcodes)
+
+    keep = (zip_ix >= 0) & (date_ix >= 0)
+    keys = date_ix[keep] * 24 + hours[keep]
+    zip_ix = zip_ix[keep]
+
+    total = np.bincount(keys, minlength=n_slots).reshape(len(rng), 24).astype(np.int32)
+    #running totals down each day of week
+    for dayofweek in range(7):
+        total[dayofweek::7] = np.cumsum(total[dayofweek::7], axis=0)
+
+    entries, counts = np.unique(zip_ix.astype(np.int64) * n_slots + keys, return_counts=True)
+    zip_ptr = np.searchsorted(entries, np.arange(len(zipcodes) + 1) * n_slots).astype(np.int64)
+
+    arrays = {'total' : total,
+              'zip_ptr' : zip_ptr,
+              'keys' : (entries % n_slots).astype(np.int32),
+              'counts' : counts.astype(np.int32)}
+
+    meta = {'format' : CUBE_FORMAT,
+            'start' : rng[0],
+            'start_dayofweek' : int(daterng[0].dayofweek),
+            'zipcodes' : zipcodes}
+
+    return arrays, meta
+
+
+@stage('write_event_cube')
+def write_event_cube(tbl, path):
+    '''Save the event cube of tbl (see event_cube) as one .npy file per array with a
+    meta.json sidecar, so it can be memory-mapped. like a table, it is written to a
+    new version directory in path and swapped in once complete
+    '''
+    arrays, meta = event_cube(tbl)
+
+    version_path = new_version(path)
+    for name, values in arrays.items():
+        np.save(os.path.join(version_path, name + '.npy'), values)
+    with open(os.path.join(version_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    publish_version(path, version_path)
+
+    return path
+
+
 #make date reference table
 def dateref_tbl(tbl,keydate='keydate'):
     '''Create reference date table based on minimum and maximum dates in tbl.
@@ -165,7 +329,59 @@ def count_stops(tbl,keydate,zipcode=None):
     return counted
 
 
-def summarize_by_zip(tbl,keydate='keydate'):
+def count_matrix(tbl, rng, sparse=False, weights=None):
+    '''Count the number of truck events for every day and zipcode in a single pass
+
+    Parameters
+    ----------
+    tbl: pandas dataframe
+        holds 'daterange_str' and 'zipcode' columns, one row per event
+    rng: list
+        list of date strings giving the rows of the matrix. events on dates
+        outside rng are not counted
+    sparse: bool
+        if True, return a scipy csr matrix instead of a dense array. useful when
+        most zipcodes only see an event every few days
+    weights: string
+        if given, sum this column of tbl instead of counting events. missing
+        values count as zero
+
+    Returns
+    -------
+    counts: numpy array or scipy.sparse.csr_matrix
+        matrix of shape (len(rng), len(zipcodes)) holding event counts
+    zipcodes: list
+        sorted list of the unique zipcodes of events in rng, giving the columns of counts
+    '''
+    date_ix = pd.Index(rng).get_indexer(tbl['daterange_str'])
+    in_range = date_ix >= 0
+    zip_ix, zipcodes = pd.factorize(tbl['zipcode'].values[in_range], sort=True)
+
+    #drop events outside the date range and events with no zipcode
+    keep = zip_ix >= 0
+    date_ix = date_ix[in_range][keep]
+    zip_ix = zip_ix[keep]
+
+    if weights is None:
+        values = np.ones(len(date_ix))
+    else:
+        values = np.nan_to_num(np.asarray(tbl[weights].values[in_range][keep], dtype=float))
+
+    shape = (len(rng), len(zipcodes))
+
+    if sparse:
+        from scipy.sparse import coo_matrix
+        #duplicate (day, zip) entries are summed when converting to csr
+        counts = coo_matrix((values, (date_ix, zip_ix)), shape=shape).tocsr()
+    else:
+        flat = np.bincount(date_ix * shape[1] + zip_ix, weights=values, minlength=shape[0] * shape[1])
+        counts = flat.reshape(shape)
+
+    return counts, list(zipcodes)
+
+
+@stage('summarize_by_zip')
+def summarize_by_zip(tbl,keydate='keydate', sparse=False):
     '''Given a dataframe of truck event timestamps, convert to a table where each
     row is a day and each column is a zipcode with the number of events per time
 
@@ -174,13 +390,15 @@ def summarize_by_zip(tbl,keydate='keydate'):
     tbl: pandas dataframe
     keydate: string
         name of column in tbl holding date information. default "keydate"
+    sparse: bool
+        if True, zipcode columns of tbl_allcounts are stored sparse. default False
 
     Returns
     -------
     tbl_allcounts: pandas dataframe
         tbl where each row is a day and each column is a zipcode and tbl values are counts
-    tbl_counted: pandas dataframe
-        don't use this one for anything
+    counts: numpy array or scipy.sparse.csr_matrix
+        the raw day x zipcode count matrix behind tbl_allcounts (see count_matrix)
     zipcdoes: list
         list of unique zipcodes in the zipcode column of tbl
     date_frame: pandas dataframe
@@ -188,26 +406,60 @@ def summarize_by_zip(tbl,keydate='keydate'):
     '''
     date_frame, rng = dateref_tbl(tbl,keydate)
 
-    dtf = '%Y-%m-%d'
-
     #make simplified date_str
-    tbl['daterange_str'] = [date.strftime(dtf) for date in tbl[keydate]]
+    tbl['daterange_str'] = date_strings(tbl[keydate])
     tbl.reset_index(inplace=True, drop=True)
 
-    zipcodes = list(set(tbl.zipcode))
+    #rng steps from the time of day of the first event, so the last day can fall
+    #outside it. keep those days as extra rows, like the old outer merge did
+    rows = rng + sorted(set(tbl['daterange_str'].unique()) - set(rng))
 
-    tbl_allcounts = pd.DataFrame({'daterange_str' : rng})
+    #one pass over tbl for every zipcode at once
+    counts, zipcodes = count_matrix(tbl, rows, sparse=sparse)
 
-    for zipcode in zipcodes:
-        tbl_counted = count_stops(tbl,keydate,zipcode=zipcode)
-        tbl_allcounts = tbl_allcounts.merge(tbl_counted,on='daterange_str',how='outer')
+    if sparse:
+        tbl_allcounts = pd.DataFrame.sparse.from_spmatrix(counts, columns=zipcodes)
+    else:
+        tbl_allcounts = pd.DataFrame(counts, columns=zipcodes)
+    tbl_allcounts.insert(0, 'daterange_str', rows)
 
-    tbl_allcounts.fillna(value=0, inplace=True)
+    return tbl_allcounts, counts, zipcodes, date_frame
 
-    return tbl_allcounts, tbl_counted, zipcodes, date_frame
 
+def modeling_date_frame(mindate, maxdate):
+    '''Create the date reference table for the range of dates used for modeling
 
-def time_by_zip(ordtbl, subtbl, outdir):
+    Parameters
+    ----------
+    mindate, maxdate: strings or datetimes
+        first and last day of the range, inclusive
+
+    Returns
+    -------
+    date_frame: pandas DataFrame
+        one row per day with the date broken out into month, week, dayofweek, etc
+    rng: list
+        list of date strings for the days in the range
+    '''
+    dtf = '%Y-%m-%d'
+
+    daterng = pd.date_range(mindate, maxdate, freq='D')
+    rng = [date.strftime(dtf) for date in daterng]
+
+    date_frame = pd.DataFrame({'daterange_str' : rng,
+                              'datetime' : daterng,
+                              'dayofmonth' : daterng.day,
+                              'month' : daterng.month,
+                              'week' : daterng.week,
+                              'year' : daterng.year,
+                              'dayofweek' : daterng.dayofweek,
+                              'dayofyear' : daterng.dayofyear})
+
+    return date_frame, rng
+
+
+@stage('time_by_zip')
+def time_by_zip(ordtbl, subtbl, outdir, sparse=False, mindate='1/1/2015', maxdate='7/31/2015'):
     '''Converts zipcodes to strings and creates individual tables for orders, submissions,
     and both where each row is a day and each column in a zipcode
 
@@ -219,6 +471,12 @@ def time_by_zip(ordtbl, subtbl, outdir):
         dataframe following import with rep_by_zip. holds submissions
     outdir: string
         place where output files will be stored
+    sparse: bool
+        if True, count tables are built and stored with sparse zipcode columns,
+        which saves memory when there are many zipcodes with few events. default False
+    mindate, maxdate: strings
+        first and last day of the "approved" date range kept for modeling.
+        default 1/1/2015 to 7/31/2015
 
     Returns
     -------
@@ -231,26 +489,28 @@ def time_by_zip(ordtbl, subtbl, outdir):
     date_frame: pandas dataframe
         dataframe containing dates broken out in a number of ways for a range given
         by the min and max date in tbl's date column
+
+    If write_region_rollups has saved a region hierarchy in outdir, the region
+    rollups are rebuilt from the new tables as well.
     '''
     keydate = 'keydate'
 
-    #standardize column names, convert zipcodes to strings
+    #standardize column names, convert zipcodes to five-digit strings
     ordtbl.rename(columns={'delivery_date':keydate},inplace=True)
     ordtbl = ordtbl[[keydate,'zipcode']]
-    ordtbl['zipcode'] = [str(zipcode) for zipcode in ordtbl['zipcode']]
+    ordtbl['zipcode'] = zip_labels(ordtbl['zipcode'])
 
     subtbl.rename(columns={'pickup_date':keydate},inplace=True)
     subtbl = subtbl[[keydate,'zipcode']]
-    subtbl['zipcode'] = [str(zipcode) for zipcode in subtbl['zipcode']]
+    subtbl['zipcode'] = zip_labels(subtbl['zipcode'])
 
     #combine orders and submssions into single table
     tbl_subandord = pd.concat([subtbl, ordtbl],ignore_index=True)
 
-    dtf = '%Y-%m-%d'
     #create count tables
-    orders_allcounts, _, ordzips, date_frame_ord = summarize_by_zip(ordtbl)
-    submissions_allcounts, _, subzips, date_frame_sub = summarize_by_zip(subtbl)
-    subandord_allcounts, _, subandordzips, date_frame_subandord = summarize_by_zip(tbl_subandord)
+    orders_allcounts, _, ordzips, date_frame_ord = summarize_by_zip(ordtbl, sparse=sparse)
+    submissions_allcounts, _, subzips, date_frame_sub = summarize_by_zip(subtbl, sparse=sparse)
+    subandord_allcounts, _, subandordzips, date_frame_subandord = summarize_by_zip(tbl_subandord, sparse=sparse)
 
     #set the date as index
     di_submissions_allcounts = submissions_allcounts.set_index('daterange_str')
@@ -258,105 +518,428 @@ def time_by_zip(ordtbl, subtbl, outdir):
     di_subandord_allcounts = subandord_allcounts.set_index('daterange_str')
 
     #create list of "approved" dates for modeling
-    mindate = '1/1/2015'
-    maxdate = '7/31/2015'
-
-    daterng = pd.date_range(mindate, maxdate, freq='D')
-    rng = [date.strftime(dtf) for date in daterng]
-
-    date_frame = pd.DataFrame(daterng, index=rng, columns=['datetime'])
-
-    date_frame = pd.DataFrame({'daterange_str' : rng,
-                              'datetime' : daterng,
-                              'dayofmonth' : daterng.day,
-                              'month' : daterng.month,
-                              'week' : daterng.week,
-                              'year' : daterng.year,
-                              'dayofweek' : daterng.dayofweek,
-                              'dayofyear' : daterng.dayofyear})
+    date_frame, rng = modeling_date_frame(mindate, maxdate)
 
     #filter tables by date range of interest
     di_submissions_allcounts = di_submissions_allcounts.loc[rng]
     di_orders_allcounts = di_orders_allcounts.loc[rng]
     di_subandord_allcounts = di_subandord_allcounts.loc[rng]
 
-    di_submissions_allcounts.to_pickle(outdir + 'di_submissions_allcounts.pkl')
-    di_orders_allcounts.to_pickle(outdir + 'di_orders_allcounts.pkl')
-    di_subandord_allcounts.to_pickle(outdir + 'di_subandord_allcounts.pkl')
-    date_frame.to_pickle(outdir + 'date_frame.pkl')
+    write_table(di_submissions_allcounts, outdir + 'di_submissions_allcounts', sort_key=INDEX_KEY)
+    write_table(di_orders_allcounts, outdir + 'di_orders_allcounts', sort_key=INDEX_KEY)
+    write_table(di_subandord_allcounts, outdir + 'di_subandord_allcounts', sort_key=INDEX_KEY)
+    write_table(date_frame, outdir + 'date_frame', sort_key='daterange_str')
+
+    #record how far the tables go so update_time_by_zip can append to them
+    save_update_state(outdir, {'high_water_mark' : rng[-1]})
+
+    #rebuild the region rollups too, so they never cover other dates than the tables
+    if os.path.exists(outdir + 'region_hierarchy'):
+        write_region_rollups(outdir)
 
     return di_submissions_allcounts, di_orders_allcounts, di_subandord_allcounts, date_frame
 
 
-def latslngs_fromGoogle(zipcodes, GOOGLE_API_KEY):
+def load_update_state(outdir):
+    '''Load the state file recording which days the count tables in outdir cover
+    '''
+    with open(outdir + 'time_by_zip_state.json') as f:
+        return json.load(f)
+
+
+def save_update_state(outdir, state):
+    '''Write the state file for the count tables in outdir. the file is replaced
+    in one step so an interrupted run leaves the previous state in place
+    '''
+    path = outdir + 'time_by_zip_state.json'
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def stop_events(tbl, datecol):
+    '''Reduce an imported orders or submissions table to the day and zipcode of each event
+
+    Parameters
+    ----------
+    tbl: pandas dataframe
+        dataframe following import with rep_by_zip
+    datecol: string
+        name of the column holding the critical date (eg. "delivery_date")
+
+    Returns
+    -------
+    events: pandas dataframe
+        one row per event with columns 'daterange_str' and 'zipcode' as strings, the
+        zipcode as storage.zip_label writes it
+    '''
+    return pd.DataFrame({'daterange_str' : date_strings(tbl[datecol]),
+                         'zipcode' : zip_labels(tbl['zipcode'])})
+
+
+@stage('update_time_by_zip')
+def update_time_by_zip(ordtbl, subtbl, outdir, through=None, window_days=None):
+    '''Append new days of events to the count tables written by time_by_zip, without
+    recounting the days already in them
+
+    Only events dated after the high-water mark in outdir's state file and up to
+    through are counted, so ordtbl and subtbl can be either the new events alone or
+    a full export, and re-running with the same input changes nothing. Zipcodes seen
+    for the first time become new columns, zero for all earlier days.
+
+    Parameters
+    ----------
+    ordtbl: pandas dataframe
+        dataframe following import with rep_by_zip. holds orders
+    subtbl: pandas dataframe
+        dataframe following import with rep_by_zip. holds submissions
+    outdir: string
+        place where time_by_zip stored its output files
+    through: string
+        last day to count, as 'YYYY-MM-DD'. pass yesterday's date from a nightly job
+        so a partly finished day is not frozen into the tables. default is the latest
+        day found in ordtbl and subtbl
+    window_days: int
+        if given, only the most recent window_days days are kept, so the modeling
+        window moves forward with the data. default keeps every day
+
+    Returns
+    -------
+    di_submissions_allcounts, di_orders_allcounts, di_subandord_allcounts, date_frame:
+        the updated tables, as returned by time_by_zip
+    '''
+    state = load_update_state(outdir)
+    high_water_mark = state['high_water_mark']
+
+    ordevents = stop_events(ordtbl, 'delivery_date')
+    subevents = stop_events(subtbl, 'pickup_date')
+    events = {'orders' : ordevents,
+              'submissions' : subevents,
+              'subandord' : pd.concat([subevents, ordevents], ignore_index=True)}
+
+    if through is None:
+        through = events['subandord'].daterange_str.max()
+
+    #days after the high-water mark, up to and including through
+    daterng = pd.date_range(pd.to_datetime(high_water_mark) + pd.Timedelta(days=1), through, freq='D')
+    new_rng = [date.strftime('%Y-%m-%d') for date in daterng]
+
+    tables = {}
+    for name in ['submissions', 'orders', 'subandord']:
+        path = outdir + 'di_%s_allcounts' % name
+        allcounts = read_table(path, mmap=False)
+
+        #tables from before zipcodes were labelled with zip_label ('2134', '94110.0',
+        #'nan') get their columns relabelled, and merged where two name one zipcode
+        labels = zip_labels(allcounts.columns)
+        if list(labels) != list(allcounts.columns):
+            known = pd.notnull(labels)
+            allcounts = allcounts.loc[:, known]
+            allcounts.columns = labels[known]
+            allcounts = allcounts.T.groupby(level=0, sort=False).sum().T
+
+        if new_rng:
+            counts, zipcodes = count_matrix(events[name], new_rng)
+            new_counts = pd.DataFrame(counts, columns=zipcodes,
+                                      index=pd.Index(new_rng, name=allcounts.index.name))
+            #skip days an interrupted earlier run already appended
+            new_counts = new_counts[~new_counts.index.isin(allcounts.index)]
+            #zipcodes missing on either side are filled with zeros
+            allcounts = pd.concat([allcounts, new_counts]).fillna(0)
+
+        if window_days is not None:
+            allcounts = allcounts.iloc[-window_days:]
+
+        write_table(allcounts, path, sort_key=INDEX_KEY)
+        tables[name] = allcounts
+
+    rng = tables['subandord'].index.tolist()
+    date_frame, _ = modeling_date_frame(rng[0], rng[-1])
+    write_table(date_frame, outdir + 'date_frame', sort_key='daterange_str')
+
+    if new_rng:
+        state['high_water_mark'] = new_rng[-1]
+        save_update_state(outdir, state)
+
+    #keep the region rollups in step with the zip-level tables
+    if os.path.exists(outdir + 'region_hierarchy'):
+        write_region_rollups(outdir)
+
+    return tables['submissions'], tables['orders'], tables['subandord'], date_frame
+
+
+def region_label(value):
+    '''Format a cluster or city label as a string, with whole-number floats as ints
+    '''
+    if pd.isnull(value):
+        return 'unassigned'
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def region_hierarchy(zip_summary, cluster_col='classifier_label_edited', city_col='city', default_city='bayarea'):
+    '''Make the zipcode -> cluster -> city lookup used to roll counts up to regions
+
+    Parameters
+    ----------
+    zip_summary: pandas dataframe
+        one row per zipcode in column 'zipcodes', with the cluster label from the
+        k-means clustering
+    cluster_col: string
+        column holding each zipcode's cluster label. zipcodes without one are put
+        in cluster 'unassigned'
+    city_col: string
+        column holding each zipcode's city. if zip_summary has no such column, every
+        zipcode is put in default_city
+    default_city: string
+        city used when zip_summary has no city column
+
+    Returns
+    -------
+    hierarchy: pandas dataframe
+        one row per zipcode with string columns 'zipcode', 'cluster' and 'city'
+    '''
+    if city_col in zip_summary.columns:
+        cities = [region_label(city) for city in zip_summary[city_col]]
+    else:
+        cities = [default_city] * len(zip_summary)
+
+    hierarchy = pd.DataFrame({'zipcode' : zip_labels(zip_summary['zipcodes']),
+                              'cluster' : [region_label(c) for c in zip_summary[cluster_col]],
+                              'city' : cities},
+                             columns=['zipcode', 'cluster', 'city'])
+
+    #rows without a zipcode can't be looked up
+    hierarchy = hierarchy[hierarchy['zipcode'].notnull()]
+
+    return hierarchy.drop_duplicates('zipcode')
+
+
+def region_rollups(allcounts, hierarchy):
+    '''Sum a day x zipcode count table up to every cluster, every city and the whole market
+
+    Parameters
+    ----------
+    allcounts: pandas dataframe
+        tbl where each row is a day and each column is a zipcode and tbl values are counts
+    hierarchy: pandas dataframe
+        zipcode to cluster and city lookup from region_hierarchy
+
+    Returns
+    -------
+    rollups: pandas dataframe
+        same rows as allcounts, with one column per region named 'all', 'city:<city>'
+        and 'cluster:<cluster>'. zipcodes missing from hierarchy only count toward 'all'
+    '''
+    zipcodes = list(zip_labels(allcounts.columns))
+    zip_ix = pd.Index(hierarchy['zipcode']).get_indexer(zipcodes)
+    known = zip_ix >= 0
+
+    regions = ['all']
+    membership = [np.ones(len(zipcodes))]
+    for level in ['city', 'cluster']:
+        labels = np.asarray(hierarchy[level].values, dtype=object)
+        for label in sorted(set(labels)):
+            member = np.zeros(len(zipcodes))
+            member[known] = labels[zip_ix[known]] == label
+            regions.append('%s:%s' % (level, label))
+            membership.append(member)
+
+    #one matrix product sums every region at once
+    values = np.nan_to_num(np.asarray(allcounts.values, dtype=float))
+    rollups = pd.DataFrame(values.dot(np.column_stack(membership)), index=allcounts.index, columns=regions)
+
+    return rollups
+
+
+@stage('write_region_rollups')
+def write_region_rollups(outdir, hierarchy=None):
+    '''Save rolled-up region series next to each zip-level count table in outdir
+
+    Parameters
+    ----------
+    outdir: string
+        place where time_by_zip stored its output files
+    hierarchy: pandas dataframe
+        zipcode to cluster and city lookup from region_hierarchy. it is saved as
+        outdir + 'region_hierarchy'. default reuses the one saved last time
+
+    Returns
+    -------
+    rollups: dict
+        rollup tables for 'submissions', 'orders' and 'subandord', also saved as
+        outdir + 'di_<name>_regions'
+    '''
+    if hierarchy is None:
+        hierarchy = read_table(outdir + 'region_hierarchy', mmap=False)
+    else:
+        write_table(hierarchy, outdir + 'region_hierarchy')
+
+    rollups = {}
+    for name in ['submissions', 'orders', 'subandord']:
+        allcounts = read_table(outdir + 'di_%s_allcounts' % name)
+        rollups[name] = region_rollups(allcounts, hierarchy)
+        write_table(rollups[name], outdir + 'di_%s_regions' % name, sort_key=INDEX_KEY)
+
+    return rollups
+
+
+@stage('latslngs_fromGoogle')
+def latslngs_fromGoogle(zipcodes, GOOGLE_API_KEY, cache_path='geocode_cache.json', max_workers=8, provider=None):
     '''Queries the google API to get the latitudes and longitudes for a list of zipcodes
 
+    Lookups are cached on disk in cache_path, so only zipcodes that have not been
+    seen before are sent to the API, several at a time.
+
     Parameters
     ----------
     zipcdoes: list of strings
         list of zipcodes of interest
     GOOGLE_API_KEY: string
         your google developer API key
+    cache_path: string
+        json file holding previous lookups. None turns off the on-disk cache
+    max_workers: int
+        number of requests in flight at once
+    provider: mapsapi provider
+        used instead of the google API if given, eg. mapsapi.CentroidTable for
+        offline runs
 
     Returns
     -------
     lats_google, lngs_google: lists representing latitute and longitude for each zipcode
     '''
-    lats_google = []
-    lngs_google = []
-
-    for zipcode in zipcodes:
-        query_url = 'https://maps.googleapis.com/maps/api/geocode/json?address=%s&key=%s' % (str(zipcode),
-                                                                                            GOOGLE_API_KEY)
-        r = requests.get(query_url)
-        temp = r.json()
-        lat = temp['results'][0]['geometry']['location']['lat']
-        lng = temp['results'][0]['geometry']['location']['lng']
-        lats_google.append(lat)
-        lngs_google.append(lng)
+    import mapsapi
+
+    if provider is None:
+        provider = mapsapi.GoogleGeocoder(GOOGLE_API_KEY, pool_size=max_workers)
+    cache = mapsapi.DiskCache(cache_path)
+
+    lats_google, lngs_google, stats = mapsapi.geocode_zipcodes(zipcodes, provider, cache=cache,
+                                                               max_workers=max_workers)
+    logger.info(json.dumps({'cache' : 'geocoding', 'hits' : stats['hits'], 'misses' : stats['misses']}))
 
     return lats_google, lngs_google
 
 
-def get_google_pt2pt_list(origin_address, destination_addresses):
-    '''Queries the google API to get the latitudes and longitudes for a list of zipcodes
+@stage('get_google_pt2pt_list')
+def get_google_pt2pt_list(origin_address, destination_addresses, GOOGLE_API_KEY=None,
+                          cache_path='distance_cache.json', ttl_days=30, max_workers=8, provider=None):
+    '''Queries the google API to get travel distance and time from an origin to a list
+    of destinations
+
+    Destinations are sent up to 25 at a time, several requests at once, and results
+    are cached on disk in cache_path so reruns only ask for new or expired routes.
 
     Parameters
     ----------
     origin_address: string
     destination_addresses: list of strings
         list of addresses for which to get distance from origin_address
+    GOOGLE_API_KEY: string
+        your google developer API key
+    cache_path: string
+        json file holding previous lookups. None turns off the on-disk cache
+    ttl_days: float
+        days a cached route is trusted before it is fetched again
+    max_workers: int
+        number of requests in flight at once
+    provider: mapsapi provider
+        used instead of the google API if given, eg. a GoogleDistanceMatrix pointed
+        at a local mock server
 
     Returns
     -------
     dist_google, dura_google: lists
-        lists of distances and durations from the origin_address for each destination_addresses
+        distances in meters and durations in seconds from the origin_address for each
+        destination_addresses. None where google found no route
+    '''
+    import mapsapi
+
+    if provider is None:
+        provider = mapsapi.GoogleDistanceMatrix(GOOGLE_API_KEY, pool_size=max_workers)
+    cache = mapsapi.DiskCache(cache_path, ttl=ttl_days * 24 * 3600)
+
+    dist_google, dura_google, stats = mapsapi.distance_matrix(origin_address, destination_addresses,
+                                                              provider, cache=cache,
+                                                              max_workers=max_workers)
+    logger.info(json.dumps({'cache' : 'distance', 'hits' : stats['hits'], 'misses' : stats['misses']}))
 
+    return dist_google, dura_google
+
+#trailing windows summarized by summarize_by_zip_dataframe, as (name, number of days).
+#use 'mtd' instead of a number of days for month-to-date
+DEFAULT_WINDOWS = [('lastmonth', 28)]
+
+
+def window_lengths(rng, windows):
+    '''Number of trailing days covered by each window, with the whole range as 'total'
+
+    Parameters
+    ----------
+    rng: list
+        list of date strings in the date range, in order
+    windows: list of tuples
+        (name, days) pairs, where days is an int or 'mtd' for month-to-date
+
+    Returns
+    -------
+    lengths: list of tuples
+        (name, days) pairs starting with ('total', len(rng)). windows longer than rng
+        are cut to len(rng)
     '''
-    dist_google = []
-    dura_google = []
+    lengths = [('total', len(rng))]
+    for name, days in windows:
+        if days == 'mtd':
+            days = pd.to_datetime(rng[-1]).day
+        lengths.append((name, min(int(days), len(rng))))
 
-    for dest_address in destination_addresses:
+    return lengths
 
-        base_url = 'https://maps.googleapis.com/maps/api/distancematrix/'
-        query_url = '%sjson?origins=%s&destinations=%s&units=imperial' %(base_url,
-                                                                         str(origin_address),
-                                                                         str(dest_address))
 
-        r = requests.get(query_url)
-        temp = r.json()
-        distance = temp['rows'][0]['elements'][0]['distance']['text']
-        duration = temp['rows'][0]['elements'][0]['duration']['text']
+def trailing_sums(matrix, lengths):
+    '''Sum the last k rows of a day x zipcode matrix for each window length k
 
-        dist_google.append(distance)
-        dura_google.append(duration)
+    A single cumulative sum down the date axis is built, after which every trailing
+    window is one difference of two of its rows.
 
-    return dist_google, dura_google
+    Parameters
+    ----------
+    matrix: numpy array
+        day x zipcode values, in date order
+    lengths: list of ints
+        numbers of trailing days to sum
 
-def summarize_by_zip_dataframe(submissionzips, orderzips, date_frame, di_orders_allcounts, di_submissions_allcounts, di_subandord_allcounts, zip_summary_path, outdir):
+    Returns
+    -------
+    sums: list of numpy arrays
+        per-zipcode sums, one array per entry in lengths
+    '''
+    n = matrix.shape[0]
+    csum = np.zeros((n + 1, matrix.shape[1]))
+    np.cumsum(matrix, axis=0, out=csum[1:])
+
+    return [csum[n] - csum[n - k] for k in lengths]
+
+
+def align_zips(matrix, zipcodes, all_zipcodes):
+    '''Spread the columns of matrix out to all_zipcodes, with nan for zipcodes it lacks
+    '''
+    aligned = np.full((matrix.shape[0], len(all_zipcodes)), np.nan)
+    aligned[:, pd.Index(all_zipcodes).get_indexer(zipcodes)] = matrix
+
+    return aligned
+
+
+@stage('summarize_by_zip_dataframe')
+def summarize_by_zip_dataframe(submissionzips, orderzips, date_frame, di_orders_allcounts, di_submissions_allcounts, di_subandord_allcounts, zip_summary_path, outdir, windows=DEFAULT_WINDOWS):
     '''make summary dataframe where each row is a zipcode and columns contain information about
     that zipcode
 
+    Every metric is computed from day x zipcode matrices built in one pass over each
+    table, so adding windows costs one subtraction per window rather than another scan.
+
     Parameters
     ----------
     submissionzips, orderzips: pandas dataframes
@@ -369,76 +952,146 @@ def summarize_by_zip_dataframe(submissionzips, orderzips, date_frame, di_orders_
         path to the zip_summary file that contains cluster information for each zipcode
     outdir: string
         place where output files will be stored
+    windows: list of tuples
+        trailing windows to summarize besides the whole range, as (name, days) pairs
+        where days is an int or 'mtd'. eg. [('lastmonth', 28), ('last7', 7),
+        ('last90', 90), ('monthtodate', 'mtd')]. default [('lastmonth', 28)]
     '''
 
     #make list of dates to include in analysis
     approved_dates = date_frame.daterange_str.tolist()
-
-    #filter submissionzips and orderzips so they only contain dates in the approved range
-    submissionzips = submissionzips[submissionzips.daterange_str.isin(approved_dates)]
-    orderzips = orderzips[orderzips.daterange_str.isin(approved_dates)]
-
-    submissionzips['zipcode'] = [str(zipcode) for zipcode in submissionzips['zipcode']]
-    orderzips['zipcode'] = [str(zipcode) for zipcode in orderzips['zipcode']]
-
-    submissionzips['total_submission_value_cents'] = submissionzips.total_submission_value_cents / 100
-    orderzips['total_cents'] = orderzips.total_cents / 100
+    lengths = window_lengths(approved_dates, windows)
+    names = [name for name, _ in lengths]
+    days = [k for _, k in lengths]
 
     zip_summary = pd.read_pickle(zip_summary_path)
 
-    #total number of delivery and pickup events
-    pickups_total = pd.DataFrame({'pickups_total':di_submissions_allcounts.sum(axis=0)})
-    deliveries_total = pd.DataFrame({'deliveries_total':di_orders_allcounts.sum(axis=0)})
-    visits_total = pd.DataFrame({'visits_total':di_subandord_allcounts.sum(axis=0)})
-
-    #number of delivery and pickup events in the last month
-    pickups_lastmonth = pd.DataFrame({'pickups_lastmonth':di_submissions_allcounts[-28:].sum(axis=0)})
-    deliveries_lastmonth = pd.DataFrame({'deliveries_lastmonth':di_orders_allcounts[-28:].sum(axis=0)})
-    visits_lastmonth = pd.DataFrame({'visits_lastmonth':di_subandord_allcounts[-28:].sum(axis=0)})
-
-    #total price of pickups and deliveries in approved date range
-    pickups_money_total = pd.DataFrame({'pickups_money_total':submissionzips.groupby('zipcode').sum().total_submission_value_cents})
-    deliveries_money_total = pd.DataFrame({'deliveries_money_total':orderzips.groupby('zipcode').sum().total_cents})
+    #day x zipcode event counts, with zipcodes as strings
+    counts = {}
+    for kind, tbl in [('pickups', di_submissions_allcounts),
+                      ('deliveries', di_orders_allcounts),
+                      ('visits', di_subandord_allcounts)]:
+        tbl = tbl.rename(columns=str).reindex(approved_dates).fillna(0)
+        counts[kind] = (tbl.values, tbl.columns.tolist())
+
+    #day x zipcode money and number of events behind it, in one pass per table.
+    #events outside the approved dates are left out by count_matrix
+    money = {}
+    for kind, tbl, col in [('pickups', submissionzips, 'total_submission_value_cents'),
+                           ('deliveries', orderzips, 'total_cents')]:
+        tbl = pd.DataFrame({'daterange_str' : tbl['daterange_str'].values,
+                            'zipcode' : zip_labels(tbl['zipcode']),
+                            col : tbl[col].values / 100})
+        cents, zipcodes = count_matrix(tbl, approved_dates, weights=col)
+        events, _ = count_matrix(tbl, approved_dates)
+        money[kind] = (cents, events, zipcodes)
+
+    all_zipcodes = sorted(set().union(*([zipcodes for _, zipcodes in counts.values()] +
+                                         [zipcodes for _, _, zipcodes in money.values()])))
+
+    metrics = {}
+    columns = []
+
+    #number of delivery and pickup events in the whole range and each window
+    sums = dict((kind, trailing_sums(align_zips(matrix, zipcodes, all_zipcodes), days))
+                for kind, (matrix, zipcodes) in counts.items())
+    for i, name in enumerate(names):
+        for kind in ['pickups', 'deliveries', 'visits']:
+            columns.append('%s_%s' % (kind, name))
+            metrics[columns[-1]] = sums[kind][i]
+
+    #price of pickups and deliveries. zipcodes without events in a window get nan
+    money_sums = {}
+    for kind, (cents, events, zipcodes) in money.items():
+        cents = trailing_sums(align_zips(cents, zipcodes, all_zipcodes), days)
+        events = trailing_sums(align_zips(events, zipcodes, all_zipcodes), days)
+        money_sums[kind] = [np.where(n > 0, total, np.nan) for total, n in zip(cents, events)]
+    for i, name in enumerate(names):
+        for kind in ['pickups', 'deliveries']:
+            columns.append('%s_money_%s' % (kind, name))
+            metrics[columns[-1]] = money_sums[kind][i]
+
+    metrics = pd.DataFrame(metrics, index=all_zipcodes, columns=columns)
+    #keyed like the count tables' columns
+    zip_summary['zipcodes'] = zip_labels(zip_summary['zipcodes'])
+    zip_summary = zip_summary.merge(metrics, left_on='zipcodes', right_index=True, how='left')
+
+    for name in names:
+        zip_summary['visits_money_%s' % name] = np.nansum([zip_summary['pickups_money_%s' % name],
+                                                           zip_summary['deliveries_money_%s' % name]], axis=0)
+
+    for name in names:
+        zip_summary['visits_moneypervisit_%s' % name] = zip_summary['visits_money_%s' % name] / zip_summary['visits_%s' % name]
+
+    for name, k in lengths:
+        #number of weeks in the approved date range, or in the window
+        if name == 'total':
+            number_of_weeks = round(len(date_frame)/7,2)
+        else:
+            number_of_weeks = k / 7.
+
+        zip_summary['visits_perweek_%s' % name] = zip_summary['visits_%s' % name] / number_of_weeks
+        zip_summary['visits_money_perweek_%s' % name] = zip_summary['visits_money_%s' % name] / number_of_weeks
+
+    write_table(zip_summary, outdir + 'zip_summary_2')
 
-    #list of dates in the last month
-    lastmonth_dates = date_frame.daterange_str[-28:].tolist()
-
-    #price of pickups and deliveries in the last month
-    submissionzips_lastmonth = submissionzips[submissionzips.daterange_str.isin(lastmonth_dates)]
-    orderzips_lastmonth = orderzips[orderzips.daterange_str.isin(lastmonth_dates)]
-
-    pickups_money_lastmonth = pd.DataFrame({'pickups_money_lastmonth':submissionzips_lastmonth.groupby('zipcode').sum().total_submission_value_cents})
-    deliveries_money_lastmonth = pd.DataFrame({'deliveries_money_lastmonth':orderzips_lastmonth.groupby('zipcode').sum().total_cents})
-
-    zip_summary = zip_summary.merge(pickups_total, left_on='zipcodes', right_index=True, how='left')
-    zip_summary = zip_summary.merge(deliveries_total, left_on='zipcodes', right_index=True, how='left')
-    zip_summary = zip_summary.merge(visits_total, left_on='zipcodes', right_index=True, how='left')
-
-    zip_summary = zip_summary.merge(pickups_lastmonth, left_on='zipcodes', right_index=True, how='left')
-    zip_summary = zip_summary.merge(deliveries_lastmonth, left_on='zipcodes', right_index=True, how='left')
-    zip_summary = zip_summary.merge(visits_lastmonth, left_on='zipcodes', right_index=True, how='left')
-
-    zip_summary = zip_summary.merge(pickups_money_total, left_on='zipcodes', right_index=True, how='left')
-    zip_summary = zip_summary.merge(deliveries_money_total, left_on='zipcodes', right_index=True, how='left')
-
-    zip_summary = zip_summary.merge(pickups_money_lastmonth, left_on='zipcodes', right_index=True, how='left')
-    zip_summary = zip_summary.merge(deliveries_money_lastmonth, left_on='zipcodes', right_index=True, how='left')
-
-    #number of weeks in the approved date range
-    number_of_weeks = round(len(date_frame)/7,2)
+    return zip_summary
 
-    zip_summary['visits_money_total'] = np.nansum([zip_summary.pickups_money_total,zip_summary.deliveries_money_total],axis=0)
-    zip_summary['visits_money_lastmonth'] = np.nansum([zip_summary.pickups_money_lastmonth,zip_summary.deliveries_money_lastmonth],axis=0)
 
-    zip_summary['visits_moneypervisit_total'] = zip_summary.visits_money_total / zip_summary.visits_total
-    zip_summary['visits_moneypervisit_lastmonth'] = zip_summary.visits_money_lastmonth / zip_summary.visits_lastmonth
+#tables earlier versions of this module pickled, by name, with the sort key
+#they are saved with now
+PICKLED_TABLES = [('orderzips_filt', 'daterange_str'),
+                  ('submissionzips_filt', 'daterange_str'),
+                  ('subandordzips_filt', 'daterange_str'),
+                  ('di_submissions_allcounts', INDEX_KEY),
+                  ('di_orders_allcounts', INDEX_KEY),
+                  ('di_subandord_allcounts', INDEX_KEY),
+                  ('date_frame', 'daterange_str'),
+                  ('zip_summary_2', None)]
 
-    zip_summary['visits_perweek_total'] = zip_summary.visits_total / number_of_weeks
-    zip_summary['visits_money_perweek_total'] = zip_summary.visits_money_total / number_of_weeks
 
-    zip_summary['visits_perweek_lastmonth'] = zip_summary.visits_lastmonth / 4
-    zip_summary['visits_money_perweek_lastmonth'] = zip_summary.visits_money_lastmonth / 4
+def migrate_pickles(outdir, remove=False):
+    '''Convert the .pkl tables an earlier version of dataprep saved in outdir to the
+    columnar format, once, so existing data keeps working without rerunning dataprep.
+    the event tables (rep_by_zip output) get their event cubes too
 
-    zip_summary.to_pickle(outdir + 'zip_summary_2.pkl')
+    Parameters
+    ----------
+    outdir: string
+        place where the .pkl files are stored
+    remove: bool
+        delete each .pkl file once it is converted. default False
 
-    return zip_summary
+    Returns
+    -------
+    migrated: list of strings
+        paths of the tables written. tables already converted are skipped
+    '''
+    migrated = []
+    for name, sort_key in PICKLED_TABLES:
+        pkl_path = outdir + name + '.pkl'
+        if not os.path.exists(pkl_path) or os.path.exists(outdir + name):
+            continue
+
+        migrate_pickle(pkl_path, outdir + name, sort_key=sort_key)
+        if name.endswith('_filt'):
+            write_event_cube(read_table(outdir + name, columns=['daterange_str', 'zipcode', 'hour']),
+                             outdir + name + '_cube')
+        if remove:
+            os.remove(pkl_path)
+        migrated.append(outdir + name)
+
+    return migrated
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='convert pickled dataprep tables to the columnar format')
+    parser.add_argument('outdirs', nargs='+', help='directories holding the .pkl files, ending with a slash')
+    parser.add_argument('--remove', action='store_true', help='delete each .pkl file once converted')
+    args = parser.parse_args()
+
+    for outdir in args.outdirs:
+        for path in migrate_pickles(outdir, remove=args.remove):
+            print('migrated %s' % path)
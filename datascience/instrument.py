@@ -0,0 +1,99 @@
+# coding: utf-8
+
+'''Stage timers for the data prep pipeline
+
+Each pipeline stage in dataprep.py is decorated with @stage. Every call logs one json
+line (stage, seconds, rows of the result when it has any) to the 'dataprep' logger,
+and adds to per-stage totals. write_metrics saves the totals as a Prometheus
+textfile (for node_exporter's textfile collector), so a scheduled run's stage times
+can be graphed next to the dashboard's /metrics.
+'''
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger('dataprep')
+
+#stage name to {'calls', 'seconds', 'last_seconds', 'rows'}, for this process
+_timings = OrderedDict()
+_lock = threading.Lock()
+
+
+def _rows(result):
+    #rows of a table result, or of the first table in a tuple of them
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    shape = getattr(result, 'shape', None)
+    return int(shape[0]) if shape else None
+
+
+def stage(name):
+    '''Decorator timing every call of a pipeline stage as name
+    '''
+    def decorate(fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.time()
+            result = fn(*args, **kwargs)
+            seconds = time.time() - start
+            rows = _rows(result)
+
+            with _lock:
+                entry = _timings.setdefault(name, {'calls' : 0, 'seconds' : 0., 'last_seconds' : 0., 'rows' : None})
+                entry['calls'] += 1
+                entry['seconds'] += seconds
+                entry['last_seconds'] = seconds
+                entry['rows'] = rows
+
+            logger.info(json.dumps({'stage' : name, 'seconds' : round(seconds, 3), 'rows' : rows}))
+            return result
+        return timed
+    return decorate
+
+
+def timings():
+    '''Copy of the per-stage totals so far
+    '''
+    with _lock:
+        return OrderedDict((name, dict(entry)) for name, entry in _timings.items())
+
+
+def reset():
+    with _lock:
+        _timings.clear()
+
+
+def write_metrics(path):
+    '''Save the per-stage totals in Prometheus text format. written to a temporary file
+    and renamed, so a collector never reads half a file
+
+    Returns
+    -------
+    path: string
+    '''
+    lines = ['# HELP dataprep_stage_seconds_total Time spent in each data prep stage',
+             '# TYPE dataprep_stage_seconds_total counter']
+    stats = timings()
+    for name, entry in stats.items():
+        lines.append('dataprep_stage_seconds_total{stage="%s"} %r' % (name, entry['seconds']))
+    lines += ['# HELP dataprep_stage_calls_total Calls of each data prep stage',
+              '# TYPE dataprep_stage_calls_total counter']
+    for name, entry in stats.items():
+        lines.append('dataprep_stage_calls_total{stage="%s"} %d' % (name, entry['calls']))
+    lines += ['# HELP dataprep_stage_last_seconds Duration of the last call of each data prep stage',
+              '# TYPE dataprep_stage_last_seconds gauge']
+    for name, entry in stats.items():
+        lines.append('dataprep_stage_last_seconds{stage="%s"} %r' % (name, entry['last_seconds']))
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(tmp, path)
+
+    return path
@@ -0,0 +1,465 @@
+# coding: utf-8
+
+'''Lasso feature selection for every stop type and region, as a pipeline stage
+
+Replaces hand-running lassoCV_regression in feature_engineering-lassocoefs.ipynb.
+Every series (each stop type's whole market, and each city and cluster rollup
+written by dataprep.write_region_rollups, optionally each zipcode) gets a
+cross-validated lasso on the dashboard's own regression features.
+
+All the series share one design matrix, so the cross-validation folds do too: the
+Gram matrix of each fold is computed once per worker process and reused for every
+series, and each series only adds X'y. Coordinate descent on that Gram matrix then
+solves a whole block of series at once (lasso_paths_gram), down each series' alpha
+grid with every alpha warm-started from the one before. Each series' chosen alpha is
+refitted on all the days the same way. It minimizes the same objective as sklearn's
+LassoCV and stops on the same duality gap test, so given the same folds the chosen
+alphas and selected features agree with LassoCV's, and the coefficients agree to
+within the solver tolerance, without its per-series, per-fold overhead.
+
+Each run is saved to outdir + 'lasso_coefs/<version>/' with the same per stop type
+pickles the notebook made, plus the per-region selections and a manifest, and then
+outdir + 'lasso_coefs/CURRENT' is pointed at it. The dashboard reads its
+coefficient files through that pointer, so a new run is picked up, and its models
+refitted, on the next request.
+
+    python lassoselect.py --outdir ../dashboard/ --workers 4
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from instrument import stage
+from storage import read_table, zip_labels
+
+
+DASHBOARD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dashboard')
+
+LASSO_DIR = 'lasso_coefs/'
+POINTER_FILE = 'CURRENT'
+MANIFEST_FILE = 'manifest.json'
+REGION_COEFS_FILE = 'lasso_coefs_regions.pkl'
+SUMMARY_FILE = 'lasso_summary.pkl'
+
+#coefficients smaller than this count as dropped, as in the notebook
+MIN_COEF = 0.00001
+
+
+def import_dashboard():
+    '''The dashboard's plotting module, whose features and stop types the selection
+    has to match
+    '''
+    if DASHBOARD_DIR not in sys.path:
+        sys.path.insert(0, DASHBOARD_DIR)
+    from webapp import matplotlib_funcs
+
+    return matplotlib_funcs
+
+
+def load_series(outdir, table, zips=False):
+    '''Daily count series to select features for, from one count table
+
+    Parameters
+    ----------
+    outdir: string
+        place where time_by_zip and write_region_rollups stored their output files
+    table: string
+        'orders', 'submissions' or 'subandord'
+    zips: bool
+        also include every zipcode on its own
+
+    Returns
+    -------
+    series: pandas dataframe
+        one column per series, named 'all', 'city:<city>', 'cluster:<cluster>' and
+        with zips, the zipcodes
+    '''
+    allcounts = read_table(outdir + 'di_%s_allcounts' % table)
+    allcounts.columns = zip_labels(allcounts.columns)
+
+    if os.path.exists(outdir + 'di_%s_regions' % table):
+        series = read_table(outdir + 'di_%s_regions' % table)
+    else:
+        series = pd.DataFrame({'all' : allcounts.sum(axis=1)})
+    if zips:
+        series = pd.concat([series, allcounts], axis=1)
+
+    series = series.astype(float)
+    series.index = pd.to_datetime(series.index)
+
+    #get rid of the zeros of days the business was closed, as the dashboard does
+    matplotlib_funcs = import_dashboard()
+    closed = matplotlib_funcs.closed_days(allcounts.sum(axis=1).values)
+    return matplotlib_funcs.fill_closed_days(series, closed)
+
+
+def make_folds(n_samples, n_folds, seed):
+    '''Shuffled k-fold test rows, the same for every series
+    '''
+    order = np.random.RandomState(seed).permutation(n_samples)
+    return [np.sort(test) for test in np.array_split(order, n_folds)]
+
+
+def lasso_paths_gram(gram, Xy, yy, n_samples, alphas, max_iter=1000, tol=1e-4):
+    '''Lasso coefficients of many series at once along their alpha grids, by
+    coordinate descent on the Gram matrix they share
+
+    Solves (1 / (2 * n_samples)) * ||y - Xw||^2 + alpha * ||w||_1 for each series, as
+    sklearn's lasso_path does, starting each alpha from the solution at the one before,
+    and stopping on the same duality gap test.
+
+    Parameters
+    ----------
+    gram: array, features x features
+        X'X of the centered design matrix
+    Xy: array, features x series
+        X'y of each centered series
+    yy: array
+        y'y of each centered series
+    n_samples: int
+        rows of X
+    alphas: array, series x n_alphas
+        decreasing penalties of each series
+    max_iter: int
+        most passes over the features at each alpha
+    tol: float
+        once no coefficient of a series changed by more than tol times its largest
+        coefficient in a pass, the series has converged if its duality gap is below
+        tol times its y'y
+
+    Returns
+    -------
+    coefs: array, features x series x n_alphas
+    '''
+    n_features, n_series = Xy.shape
+    diag = np.diag(gram)
+    #a feature that is constant over these rows stays at zero
+    features = np.flatnonzero(diag > 0)
+
+    W = np.zeros((n_features, n_series))
+    coefs = np.empty((n_features, n_series, alphas.shape[1]))
+
+    for k in range(alphas.shape[1]):
+        #after each pass, only the series that haven't converged yet are updated
+        todo = np.arange(n_series)
+        W_todo, Xy_todo, yy_todo = W, Xy, yy
+        threshold = n_samples * alphas[:, k]
+        for _ in range(max_iter):
+            biggest_change = np.zeros(len(todo))
+            for j in features:
+                z = Xy_todo[j] - gram[j].dot(W_todo) + diag[j] * W_todo[j]
+                #soft threshold
+                change = (z - np.clip(z, -threshold, threshold)) / diag[j] - W_todo[j]
+                if change.any():
+                    W_todo[j] += change
+                    np.maximum(biggest_change, np.abs(change), out=biggest_change)
+            W[:, todo] = W_todo
+
+            #duality gap of the series whose coefficients stopped moving, computed
+            #from the Gram matrix as in sklearn's enet_coordinate_descent_gram
+            settled = biggest_change <= tol * np.abs(W_todo).max(axis=0)
+            done = np.zeros(len(todo), dtype=bool)
+            if settled.any():
+                w, q, y2, a = W_todo[:, settled], Xy_todo[:, settled], yy_todo[settled], threshold[settled]
+                H = gram.dot(w)
+                dual_norm = np.abs(q - H).max(axis=0)
+                wq = (w * q).sum(axis=0)
+                R_norm2 = y2 - 2 * wq + (w * H).sum(axis=0)
+                const = np.where(dual_norm > a, a / np.where(dual_norm > 0, dual_norm, 1.), 1.)
+                gap = np.where(dual_norm > a, 0.5 * R_norm2 * (1 + const ** 2), R_norm2)
+                gap += a * np.abs(w).sum(axis=0) - const * (y2 - wq)
+                done[settled] = gap < tol * y2
+
+            if done.all():
+                break
+            left = ~done
+            todo = todo[left]
+            W_todo, Xy_todo, yy_todo, threshold = W[:, todo], Xy[:, todo], yy[todo], threshold[left]
+        coefs[:, :, k] = W
+
+    return coefs
+
+
+def alpha_grid(Xc, Yc, n_alphas=100, eps=1e-3):
+    '''LassoCV's grid for each series: n_alphas log-spaced from the smallest alpha
+    that drops every feature, down to eps times that
+
+    Returns
+    -------
+    alphas: array, series x n_alphas
+    '''
+    alpha_max = np.maximum(np.abs(Xc.T.dot(Yc)).max(axis=0) / len(Xc), 1e-12)
+    return alpha_max[:, None] * np.logspace(0, np.log10(eps), n_alphas)[None, :]
+
+
+#per-fold centered design matrices and Gram matrices, set once in each worker process
+_shared = {}
+
+
+def _init_worker(X, folds):
+    '''Center X on the training rows of each fold and precompute their Gram matrices,
+    shared by every series the worker fits
+    '''
+    n = len(X)
+    fits = []
+    for test in folds:
+        train = np.setdiff1d(np.arange(n), test)
+        mean = X[train].mean(axis=0)
+        Xc = X[train] - mean
+        fits.append({'train' : train, 'test' : test, 'Xc' : Xc, 'Xc_test' : X[test] - mean,
+                     'gram' : Xc.T.dot(Xc)})
+
+    Xc = X - X.mean(axis=0)
+    _shared.update({'folds' : fits, 'Xc' : Xc, 'gram' : Xc.T.dot(Xc)})
+
+
+def select_series(Y, n_alphas=100, eps=1e-3, max_iter=1000, tol=1e-4):
+    '''Cross-validated lasso for a block of series against the shared design matrix,
+    as LassoCV with the folds given to _init_worker
+
+    Parameters
+    ----------
+    Y: array, days x series
+
+    Returns
+    -------
+    coefs: array, features x series
+        coefficients at each series' chosen alpha, refitted on every day
+    alpha: array
+        chosen alpha of each series
+    cv_mse: array
+        mean test error over the folds at the chosen alpha
+    '''
+    Xc = _shared['Xc']
+    Yc = Y - Y.mean(axis=0)
+    alphas = alpha_grid(Xc, Yc, n_alphas=n_alphas, eps=eps)
+
+    mse = np.zeros(alphas.shape)
+    for fold in _shared['folds']:
+        Y_train = Y[fold['train']]
+        Yc_train = Y_train - Y_train.mean(axis=0)
+        coefs = lasso_paths_gram(fold['gram'], fold['Xc'].T.dot(Yc_train), (Yc_train ** 2).sum(axis=0),
+                                 len(Y_train), alphas, max_iter=max_iter, tol=tol)
+        #test error of every series at every alpha at once, days x series x alphas
+        resid = (Y[fold['test']] - Y_train.mean(axis=0))[:, :, None] - np.tensordot(fold['Xc_test'], coefs, axes=(1, 0))
+        mse += (resid ** 2).mean(axis=0) / len(_shared['folds'])
+
+    best = np.argmin(mse, axis=1)
+    series = np.arange(Y.shape[1])
+    coefs = lasso_paths_gram(_shared['gram'], Xc.T.dot(Yc), (Yc ** 2).sum(axis=0), len(Y), alphas,
+                             max_iter=max_iter, tol=tol)
+
+    return coefs[:, series, best], alphas[series, best], mse[series, best]
+
+
+def _select_chunk(chunk, params):
+    Y = np.column_stack([y for stop_type, name, y in chunk])
+    coefs, alpha, cv_mse = select_series(Y, **params)
+
+    return [(stop_type, name, coefs[:, i], alpha[i], cv_mse[i]) for i, (stop_type, name, y) in enumerate(chunk)]
+
+
+def coef_table(features, coef):
+    '''Nonzero coefficients as the notebook saved them: 'var' and 'coef_weight',
+    largest weight first
+    '''
+    keep = np.abs(coef) > MIN_COEF
+    order = np.argsort(-coef[keep], kind='mergesort')
+    return pd.DataFrame({'var' : np.asarray(features)[keep][order],
+                         'coef_weight' : coef[keep][order]},
+                        columns=['var', 'coef_weight']).reset_index(drop=True)
+
+
+@stage('lasso_select')
+def lasso_select(outdir, zips=False, min_daily=1.0, n_folds=10, n_alphas=100, eps=1e-3,
+                 max_iter=1000, seed=0, workers=None, chunksize=256):
+    '''Run the cross-validated lasso for every stop type and series
+
+    Parameters
+    ----------
+    outdir: string
+        place where time_by_zip and write_region_rollups stored their output files
+    zips: bool
+        also select features for each zipcode on its own
+    min_daily: float
+        series averaging fewer events per day than this are skipped, and the
+        dashboard falls back to the stop type's selection for them
+    n_folds, n_alphas, eps, max_iter: ints and float
+        as for sklearn's LassoCV
+    seed: int
+        shuffles the folds
+    workers: int
+        worker processes. default one per cpu, 1 runs everything in this process
+    chunksize: int
+        series sent to a worker at a time
+
+    Returns
+    -------
+    coefs: pandas dataframe
+        'stop_type', 'series', 'var' and 'coef_weight' for every nonzero coefficient
+    summary: pandas dataframe
+        'stop_type', 'series', 'alpha', 'cv_mse', 'mean_daily' and 'n_selected'
+        for every series
+    info: dict
+        features_version, stop_types and the feature names
+    '''
+    matplotlib_funcs = import_dashboard()
+    stop_types = dict((stop_type, files) for stop_type, files in matplotlib_funcs.STOP_TYPES.items()
+                      if os.path.exists(outdir + 'di_%s_allcounts' % files[0]))
+    if not stop_types:
+        raise IOError('No count tables in %r, run dataprep.time_by_zip first' % outdir)
+
+    tasks = []
+    dates = None
+    for stop_type, (table, coefs_file) in sorted(stop_types.items()):
+        series = load_series(outdir, table, zips=zips)
+        #every series is fitted against one design matrix, built from these dates
+        if dates is None:
+            dates = series.index
+        elif not series.index.equals(dates):
+            raise ValueError('The count tables of %s cover different dates' % stop_type)
+        means = series.mean()
+        for name in series.columns:
+            if name == 'all' or means[name] >= min_daily:
+                tasks.append((stop_type, name, series[name].values))
+
+    #the dashboard's own features, so the selected names are the ones it fits with
+    date_frame, X_vars = matplotlib_funcs.regression_features(dates.min(), dates.max())
+    X = X_vars.values.astype(float)
+    folds = make_folds(len(X), n_folds, seed)
+    params = {'n_alphas' : n_alphas, 'eps' : eps, 'max_iter' : max_iter}
+    chunks = [tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)]
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        _init_worker(X, folds)
+        results = [_select_chunk(chunk, params) for chunk in chunks]
+    else:
+        #the design matrix goes to each worker once, with its initializer
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(X, folds)) as executor:
+            results = list(executor.map(_select_chunk, chunks, [params] * len(chunks)))
+
+    means = dict(((stop_type, name), y.mean()) for stop_type, name, y in tasks)
+    coefs = []
+    summary = []
+    for stop_type, name, coef, alpha, cv_mse in [result for chunk in results for result in chunk]:
+        tbl = coef_table(X_vars.columns, coef)
+        tbl.insert(0, 'series', name)
+        tbl.insert(0, 'stop_type', stop_type)
+        coefs.append(tbl)
+        summary.append({'stop_type' : stop_type, 'series' : name, 'alpha' : alpha, 'cv_mse' : cv_mse,
+                        'mean_daily' : means[(stop_type, name)], 'n_selected' : len(tbl)})
+
+    coefs = pd.concat(coefs, ignore_index=True)
+    summary = pd.DataFrame(summary, columns=['stop_type', 'series', 'alpha', 'cv_mse', 'mean_daily', 'n_selected'])
+    info = {'features_version' : matplotlib_funcs.FEATURES_VERSION,
+            'stop_types' : dict((stop_type, list(files)) for stop_type, files in stop_types.items()),
+            'features' : list(X_vars.columns)}
+
+    return coefs, summary, info
+
+
+def current_version(outdir):
+    '''Name of the run the dashboard is reading, or None
+    '''
+    pointer = outdir + LASSO_DIR + POINTER_FILE
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as f:
+        return f.read().strip()
+
+
+def write_version(outdir, coefs, summary, info, params=None, keep=5):
+    '''Save a run's coefficients as a new version and make it the current one
+
+    Parameters
+    ----------
+    outdir: string
+        the dashboard's data directory
+    coefs, summary, info:
+        from lasso_select
+    params: dict
+        settings of the run, saved in the manifest
+    keep: int
+        number of versions kept, including the new one, at least 1. older ones are
+        removed
+
+    Returns
+    -------
+    version: string
+    '''
+    if keep < 1:
+        raise ValueError('keep must be at least 1, the new version, got %d' % keep)
+
+    root = outdir + LASSO_DIR
+    version = time.strftime('%Y%m%d-%H%M%S')
+    n = 1
+    while os.path.exists(root + version):
+        version = '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), n)
+        n += 1
+    path = root + version + '/'
+    os.makedirs(path)
+
+    #the whole-market selection of each stop type, in the files the dashboard always read
+    for stop_type, (table, coefs_file) in info['stop_types'].items():
+        market = coefs[(coefs['stop_type'] == stop_type) & (coefs['series'] == 'all')]
+        market[['var', 'coef_weight']].reset_index(drop=True).to_pickle(path + coefs_file)
+
+    coefs.to_pickle(path + REGION_COEFS_FILE)
+    summary.to_pickle(path + SUMMARY_FILE)
+    with open(path + MANIFEST_FILE, 'w') as f:
+        json.dump({'version' : version,
+                   'created' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'features_version' : info['features_version'],
+                   'features' : info['features'],
+                   'series' : len(summary),
+                   'params' : params or {}}, f, indent=2)
+
+    #rename is atomic, so the dashboard never reads a half-written pointer
+    tmp = root + POINTER_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(version)
+    os.rename(tmp, root + POINTER_FILE)
+
+    versions = sorted(name for name in os.listdir(root) if os.path.isdir(root + name))
+    for name in versions[:-keep]:
+        if name != version:
+            shutil.rmtree(root + name)
+
+    return version
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='select regression features with a cross-validated lasso')
+    parser.add_argument('--outdir', default='', help='the dashboard data directory, ending with a slash')
+    parser.add_argument('--zips', action='store_true', help='also select features for each zipcode')
+    parser.add_argument('--min-daily', type=float, default=1.0)
+    parser.add_argument('--folds', type=int, default=10)
+    parser.add_argument('--alphas', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--keep', type=int, default=5, help='versions to keep')
+    args = parser.parse_args()
+    if args.keep < 1:
+        parser.error('--keep must be at least 1')
+
+    start = time.time()
+    coefs, summary, info = lasso_select(args.outdir, zips=args.zips, min_daily=args.min_daily,
+                                        n_folds=args.folds, n_alphas=args.alphas, seed=args.seed,
+                                        workers=args.workers)
+    params = {'zips' : args.zips, 'min_daily' : args.min_daily, 'folds' : args.folds,
+              'alphas' : args.alphas, 'seed' : args.seed, 'seconds' : round(time.time() - start, 1)}
+    version = write_version(args.outdir, coefs, summary, info, params=params, keep=args.keep)
+
+    print('%d series in %.1fs, saved as %s' % (len(summary), time.time() - start, version))
+    print(summary.groupby('stop_type')['n_selected'].describe())
@@ -0,0 +1,370 @@
+# coding: utf-8
+
+'''Cached, concurrent clients for the google maps web services
+
+Lookups go through a provider object, so the google API can be swapped for a
+local stand-in server (GoogleGeocoder or GoogleDistanceMatrix with a different
+base_url) or an offline table of ZCTA centroids (CentroidTable) in tests and
+air-gapped runs. Results are kept in a json cache on disk, so reruns of the
+pipeline only query for what they have not seen before.
+'''
+
+import csv
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+GOOGLE_GEOCODE_URL = 'https://maps.googleapis.com/maps/api/geocode/json'
+GOOGLE_DISTANCE_URL = 'https://maps.googleapis.com/maps/api/distancematrix/json'
+
+#the distance matrix API takes at most 25 destinations per request
+MAX_DESTINATIONS = 25
+
+#api statuses worth retrying after a pause
+RETRY_STATUSES = ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+
+
+class DiskCache(object):
+    '''Thread-safe key/value cache kept in a json file
+
+    Parameters
+    ----------
+    path: string
+        json file holding the cache. if None, the cache only lives in memory
+    ttl: float
+        seconds an entry stays valid. default None keeps entries forever
+    '''
+
+    def __init__(self, path=None, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, key):
+        '''Return the cached value for key, or None if it is missing or expired
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry['time'] > self.ttl:
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry['value']
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = {'value' : value, 'time' : time.time()}
+
+    def save(self):
+        '''Write the cache to disk, replacing the old file in one step
+        '''
+        if self.path is None:
+            return
+        with self.lock:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(self.path + '.tmp', self.path)
+
+
+class RateLimiter(object):
+    '''Spaces calls to wait() so no more than per_second of them start each second,
+    across all threads
+    '''
+
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second if per_second else 0.
+        self.lock = threading.Lock()
+        self.next_time = 0.
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def make_session(pool_size=8):
+    '''Create a requests session whose connection pool is shared by all worker threads
+    '''
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def get_json(session, url, params, limiter=None, retries=4, backoff=0.5):
+    '''GET url and return the decoded json, retrying with exponential backoff on
+    connection errors, 429/5xx responses and over-quota api statuses
+
+    Parameters
+    ----------
+    session: requests.Session
+    url: string
+    params: dict
+        query parameters
+    limiter: RateLimiter
+        if given, every attempt waits for its turn
+    retries: int
+        number of retries after the first attempt
+    backoff: float
+        seconds to wait before the first retry, doubled for each one after that
+    '''
+    import requests
+
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            r = session.get(url, params=params, timeout=30)
+            if r.status_code != 429 and r.status_code < 500:
+                r.raise_for_status()
+                temp = r.json()
+                if temp.get('status') not in RETRY_STATUSES:
+                    return temp
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+
+    raise ValueError('Gave up on %s after %d attempts' % (url, retries + 1))
+
+
+class GoogleGeocoder(object):
+    '''Geocoding provider for the google geocoding API, or any local server that
+    answers in the same format
+
+    Parameters
+    ----------
+    api_key: string
+        your google developer API key
+    base_url: string
+        geocoding endpoint. point it at a local stand-in server for tests
+    pool_size: int
+        number of connections kept open to the endpoint
+    '''
+
+    def __init__(self, api_key, base_url=GOOGLE_GEOCODE_URL, pool_size=8):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.session = make_session(pool_size)
+
+    def lookup(self, zipcode, limiter=None):
+        temp = get_json(self.session, self.base_url, {'address' : str(zipcode), 'key' : self.api_key},
+                        limiter=limiter)
+        if not temp.get('results'):
+            raise ValueError('No geocoding result for %s: %s' % (zipcode, temp.get('status')))
+        location = temp['results'][0]['geometry']['location']
+        return location['lat'], location['lng']
+
+
+class CentroidTable(object):
+    '''Offline geocoding provider that reads zipcode centroids from a table, such as
+    the census ZCTA gazetteer file
+
+    Parameters
+    ----------
+    path: string
+        delimited text file with one row per zipcode
+    zip_col, lat_col, lng_col: strings
+        names of the zipcode, latitude and longitude columns. defaults match the
+        census gazetteer
+    delimiter: string
+        default tab, as in the gazetteer
+    '''
+
+    def __init__(self, path, zip_col='GEOID', lat_col='INTPTLAT', lng_col='INTPTLONG', delimiter='\t'):
+        self.centroids = {}
+        with open(path) as f:
+            reader = csv.DictReader(f, delimiter=delimiter)
+            for row in reader:
+                #the gazetteer pads its last column name with spaces
+                row = dict((key.strip(), value) for key, value in row.items())
+                self.centroids[row[zip_col].strip()] = (float(row[lat_col]), float(row[lng_col]))
+
+    def lookup(self, zipcode, limiter=None):
+        try:
+            return self.centroids[str(zipcode)]
+        except KeyError:
+            raise ValueError('Zipcode %s not in centroid table' % zipcode)
+
+
+def geocode_zipcodes(zipcodes, provider, cache=None, max_workers=8, per_second=10):
+    '''Look up the latitude and longitude of each zipcode, using the cache where possible
+    and fetching the rest concurrently
+
+    Parameters
+    ----------
+    zipcodes: list of strings
+        list of zipcodes of interest
+    provider: GoogleGeocoder or CentroidTable
+        where lookups that miss the cache are sent. any object with a
+        lookup(zipcode, limiter) method returning (lat, lng) will do
+    cache: DiskCache
+        cache keyed by zipcode. default is an in-memory cache for this call only
+    max_workers: int
+        number of lookups in flight at once
+    per_second: float
+        maximum number of requests started per second
+
+    Returns
+    -------
+    lats, lngs: lists representing latitute and longitude for each zipcode
+    stats: dict
+        number of cache 'hits' and 'misses'
+    '''
+    if cache is None:
+        cache = DiskCache()
+
+    keys = [str(zipcode) for zipcode in zipcodes]
+    hits_before, misses_before = cache.hits, cache.misses
+    found = dict((key, cache.get(key)) for key in set(keys))
+    missing = [key for key, value in found.items() if value is None]
+
+    if missing:
+        limiter = RateLimiter(per_second)
+
+        def fetch(key):
+            return key, list(provider.lookup(key, limiter))
+
+        #keep whatever was fetched even if a lookup fails part way through
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for key, value in pool.map(fetch, missing):
+                    found[key] = value
+                    cache.set(key, value)
+        finally:
+            cache.save()
+
+    lats = [found[key][0] for key in keys]
+    lngs = [found[key][1] for key in keys]
+    stats = {'hits' : cache.hits - hits_before, 'misses' : cache.misses - misses_before}
+
+    return lats, lngs, stats
+
+
+class GoogleDistanceMatrix(object):
+    '''Travel distance provider for the google distance matrix API, or any local
+    server that answers in the same format
+
+    Parameters
+    ----------
+    api_key: string
+        your google developer API key
+    base_url: string
+        distance matrix endpoint. point it at a local stand-in server for tests
+    pool_size: int
+        number of connections kept open to the endpoint
+    '''
+
+    def __init__(self, api_key=None, base_url=GOOGLE_DISTANCE_URL, pool_size=8):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.session = make_session(pool_size)
+
+    def lookup(self, origin, destinations, limiter=None):
+        '''Return a (meters, seconds) pair for each destination, or None where the
+        API found no route
+        '''
+        params = {'origins' : str(origin),
+                  'destinations' : '|'.join(str(dest) for dest in destinations)}
+        if self.api_key is not None:
+            params['key'] = self.api_key
+
+        temp = get_json(self.session, self.base_url, params, limiter=limiter)
+        if temp.get('status') != 'OK':
+            raise ValueError('Distance matrix request failed: %s' % temp.get('status'))
+
+        results = []
+        for element in temp['rows'][0]['elements']:
+            if element.get('status') == 'OK':
+                results.append([element['distance']['value'], element['duration']['value']])
+            else:
+                results.append(None)
+
+        return results
+
+
+def distance_matrix(origin, destinations, provider, cache=None, batch_size=MAX_DESTINATIONS,
+                    max_workers=8, per_second=10):
+    '''Get travel distance and time from origin to each destination, using the cache
+    where possible and packing the rest into concurrent multi-destination requests
+
+    Parameters
+    ----------
+    origin: string
+    destinations: list of strings
+        list of addresses for which to get distance from origin
+    provider: GoogleDistanceMatrix
+        where lookups that miss the cache are sent. any object with a
+        lookup(origin, destinations, limiter) method will do
+    cache: DiskCache
+        cache keyed by (origin, destination). give it a ttl so routes are refreshed
+        now and then. default is an in-memory cache for this call only
+    batch_size: int
+        destinations per request, at most 25 for the google API
+    max_workers: int
+        number of requests in flight at once
+    per_second: float
+        maximum number of requests started per second
+
+    Returns
+    -------
+    meters, seconds: lists
+        distance and duration for each destination, None where there is no route
+    stats: dict
+        number of cache 'hits' and 'misses'
+    '''
+    if cache is None:
+        cache = DiskCache()
+
+    origin = str(origin)
+    keys = dict((str(dest), '%s|%s' % (origin, dest)) for dest in destinations)
+    hits_before, misses_before = cache.hits, cache.misses
+    found = dict((dest, cache.get(key)) for dest, key in keys.items())
+    missing = [dest for dest, value in found.items() if value is None]
+
+    if missing:
+        limiter = RateLimiter(per_second)
+        batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+
+        def fetch(batch):
+            return batch, provider.lookup(origin, batch, limiter)
+
+        #keep whatever was fetched even if a request fails part way through
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for batch, results in pool.map(fetch, batches):
+                    for dest, value in zip(batch, results):
+                        found[dest] = value
+                        #don't remember failed routes, they are retried next time
+                        if value is not None:
+                            cache.set(keys[dest], value)
+        finally:
+            cache.save()
+
+    values = [found[str(dest)] for dest in destinations]
+    meters = [value[0] if value is not None else None for value in values]
+    seconds = [value[1] if value is not None else None for value in values]
+    stats = {'hits' : cache.hits - hits_before, 'misses' : cache.misses - misses_before}
+
+    return meters, seconds, stats
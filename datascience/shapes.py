@@ -0,0 +1,479 @@
+# coding: utf-8
+
+'''Simplified, quantized zipcode shapes for the dashboard maps
+
+maps/mapping.ipynb filtered zip.geojson down to the zipcodes we serve by looping over
+every feature, and the maps then download all of those full-resolution polygons.
+This writes the same shapes once per zoom level, small enough to send only the part
+of the map in view:
+
+- coordinates are quantized to integers on a grid over the whole area (the
+  topojson transform), and every boundary shared by two zipcodes is stored once, as
+  an arc both polygons point to
+- each arc is simplified (Douglas-Peucker) to about one pixel at each zoom level.
+  neighbours share the simplified arc, so no gaps or overlaps open between them,
+  and rings smaller than a pixel are dropped
+- index.json has the bounding box of every zipcode, so the dashboard can pick the
+  zipcodes in view without reading the shapes
+
+Output goes to outdir + 'zip_shapes/': index.json, and z<zoom>.json (a topojson
+topology with delta-encoded arcs) for each zoom level. webapp/shapes.py serves them.
+
+    python shapes.py --geojson maps/zip.geojson --zip-summary zip_summary.pkl --outdir ../dashboard/webapp/static/data/
+'''
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from instrument import stage
+from storage import zip_label
+
+
+#zipcode property of the census ZCTA features
+ZIP_KEY = 'ZCTA5CE10'
+
+#web map zoom levels to simplify for. the dashboard uses the closest one at or below
+#the map's zoom
+ZOOMS = [6, 8, 10, 12]
+
+#grid points along each axis of the quantized coordinates
+QUANTIZATION = 100000
+
+SHAPES_DIR = 'zip_shapes/'
+INDEX_FILE = 'index.json'
+
+
+def zoom_file(zoom):
+    return 'z%d.json' % zoom
+
+
+def pixel_degrees(zoom):
+    '''Width of one 256 pixel tile pixel at zoom, in degrees of longitude
+    '''
+    return 360. / (256 * 2 ** zoom)
+
+
+def read_features(path, zipcodes=None, key=ZIP_KEY):
+    '''The features of a geojson file by zipcode, only those in zipcodes if given
+
+    Returns
+    -------
+    features: dict
+        zipcode to geojson geometry
+    '''
+    with open(path) as f:
+        data = json.load(f)
+
+    wanted = None if zipcodes is None else set(zip_label(z) for z in zipcodes)
+
+    features = {}
+    for feature in data['features']:
+        zipcode = zip_label(feature['properties'][key])
+        if wanted is None or zipcode in wanted:
+            features[zipcode] = feature['geometry']
+
+    return features
+
+
+def polygons(geometry):
+    '''The polygons of a Polygon or MultiPolygon geometry, each a list of rings
+    '''
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    raise ValueError('Unsupported geometry type %s' % geometry['type'])
+
+
+def make_transform(features, quantization=QUANTIZATION):
+    '''Scale and translate mapping the quantized grid onto the extent of all features
+    '''
+    points = np.concatenate([np.asarray(ring, dtype=float)[:, :2] for geometry in features.values()
+                             for polygon in polygons(geometry) for ring in polygon])
+    lo = points.min(axis=0)
+    hi = points.max(axis=0)
+    scale = np.where(hi > lo, (hi - lo) / (quantization - 1), 1.)
+
+    return {'scale' : scale.tolist(), 'translate' : lo.tolist()}
+
+
+def quantize_ring(ring, transform):
+    '''Ring as an (n, 2) array of integer points, without repeated points or the
+    closing point. None when fewer than 3 points are left
+    '''
+    q = np.round((np.asarray(ring, dtype=float)[:, :2] - transform['translate']) / transform['scale'])
+    q = q.astype(np.int64)
+
+    keep = np.ones(len(q), dtype=bool)
+    keep[1:] = (q[1:] != q[:-1]).any(axis=1)
+    q = q[keep]
+    if len(q) > 1 and (q[0] == q[-1]).all():
+        q = q[:-1]
+
+    if len(q) < 3:
+        return None
+    return q
+
+
+def _runs(first, last):
+    '''Indices first[i]..last[i] of every run one after the other, with the run each
+    belongs to and where each run starts in the result
+    '''
+    counts = last - first + 1
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    run = np.repeat(np.arange(len(counts)), counts)
+    return np.arange(counts.sum()) - starts[run] + first[run], run, starts
+
+
+def _run_argmax(values, run, starts):
+    #index in values of the (first) largest value of every run
+    order = np.lexsort((-values, run))
+    return order[starts]
+
+
+def find_junctions(rings):
+    '''Which points of each ring are junctions: points whose neighbouring points
+    differ between the rings passing through them, where a boundary stops being
+    shared with the same neighbour
+
+    Returns
+    -------
+    flags: list of arrays of bools, one per ring
+    '''
+    lengths = np.array([len(ring) for ring in rings])
+    points = np.concatenate(rings)
+    width = points[:, 1].max() + 1
+    keys = points[:, 0] * width + points[:, 1]
+
+    first = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    idx, run, _ = _runs(first, first + lengths - 1)
+    offset = idx - first[run]
+    prev = keys[first[run] + (offset - 1) % lengths[run]]
+    next = keys[first[run] + (offset + 1) % lengths[run]]
+    lo = np.minimum(prev, next)
+    hi = np.maximum(prev, next)
+
+    order = np.lexsort((hi, lo, keys))
+    k, l, h = keys[order], lo[order], hi[order]
+    differs = (k[1:] == k[:-1]) & ((l[1:] != l[:-1]) | (h[1:] != h[:-1]))
+    flags = np.in1d(keys, k[1:][differs])
+
+    return np.split(flags, np.cumsum(lengths)[:-1])
+
+
+def cut_ring(ring, flags):
+    '''Split a ring into arcs at its junctions. a ring without junctions becomes one
+    closed arc starting at its smallest point, so the same ring reached from either
+    side gives the same arc
+    '''
+    cuts = np.flatnonzero(flags)
+
+    if not len(cuts):
+        start = np.lexsort((ring[:, 1], ring[:, 0]))[0]
+        ring = np.roll(ring, -start, axis=0)
+        return [np.vstack([ring, ring[:1]])]
+
+    ring = np.roll(ring, -cuts[0], axis=0)
+    cuts = np.append(cuts - cuts[0], len(ring))
+    ring = np.vstack([ring, ring[:1]])
+
+    return [ring[first:last + 1] for first, last in zip(cuts[:-1], cuts[1:])]
+
+
+class Topology(object):
+    '''Zipcode polygons as rings of shared arcs
+
+    Arcs are (n, 2) arrays of quantized points. a ring is a list of arc indices, ~i
+    for arc i walked backwards, as in topojson
+    '''
+
+    def __init__(self, transform):
+        self.transform = transform
+        self.arcs = []
+        self.arc_index = {}
+        #zipcode to list of polygons, each a list of rings of arc indices
+        self.shapes = {}
+
+    def add_arc(self, arc):
+        key = arc.tobytes()
+        if key in self.arc_index:
+            return self.arc_index[key]
+        reverse = arc[::-1].tobytes()
+        if reverse in self.arc_index:
+            return ~self.arc_index[reverse]
+
+        self.arc_index[key] = len(self.arcs)
+        self.arcs.append(arc)
+        return len(self.arcs) - 1
+
+    @classmethod
+    def from_features(cls, features, quantization=QUANTIZATION):
+        topology = cls(make_transform(features, quantization))
+
+        shapes = {}
+        rings = []
+        for zipcode, geometry in features.items():
+            shape = []
+            for polygon in polygons(geometry):
+                quantized = [quantize_ring(ring, topology.transform) for ring in polygon]
+                #a polygon whose exterior collapsed at this quantization is dropped,
+                #a hole that did is just left out
+                if quantized[0] is None:
+                    continue
+                quantized = [ring for ring in quantized if ring is not None]
+                shape.append(range(len(rings), len(rings) + len(quantized)))
+                rings += quantized
+            if shape:
+                shapes[zipcode] = shape
+
+        flags = find_junctions(rings)
+
+        for zipcode, shape in shapes.items():
+            topology.shapes[zipcode] = [[[topology.add_arc(arc) for arc in cut_ring(rings[i], flags[i])]
+                                         for i in polygon] for polygon in shape]
+
+        return topology
+
+    def flat(self):
+        '''Points of all arcs one after the other, and where each arc starts (then the
+        number of points)
+        '''
+        offsets = np.concatenate([[0], np.cumsum([len(arc) for arc in self.arcs])])
+        return np.concatenate(self.arcs), offsets
+
+    def ring_sizes(self, offsets, points):
+        '''Larger side, in degrees, of the bounding box of every ring, by zipcode
+        '''
+        scale = np.array(self.transform['scale'])
+        lo = np.minimum.reduceat(points, offsets[:-1])
+        hi = np.maximum.reduceat(points, offsets[:-1])
+
+        def size(ring):
+            ids = [~i if i < 0 else i for i in ring]
+            return float(((hi[ids].max(axis=0) - lo[ids].min(axis=0)) * scale).max())
+
+        return dict((zipcode, [[size(ring) for ring in polygon] for polygon in shape])
+                    for zipcode, shape in self.shapes.items())
+
+    def bboxes(self, offsets, points):
+        '''Bounding box [west, south, east, north] in degrees of every zipcode
+        '''
+        scale = np.array(self.transform['scale'])
+        translate = np.array(self.transform['translate'])
+        lo = np.minimum.reduceat(points, offsets[:-1])
+        hi = np.maximum.reduceat(points, offsets[:-1])
+
+        boxes = {}
+        for zipcode, shape in self.shapes.items():
+            ids = [~i if i < 0 else i for polygon in shape for i in polygon[0]]
+            west, south = lo[ids].min(axis=0) * scale + translate
+            east, north = hi[ids].max(axis=0) * scale + translate
+            boxes[zipcode] = [round(float(v), 6) for v in (west, south, east, north)]
+
+        return boxes
+
+
+def presimplify(points, offsets):
+    '''Douglas-Peucker importance of every point of many lines, all lines at once: the
+    largest tolerance at which Douglas-Peucker keeps the point. the points whose
+    importance is above a tolerance are that tolerance's simplification, so the lines
+    are simplified once for every zoom level
+
+    The ends of every line are always kept, and so are enough points of a closed
+    line to keep it a ring.
+
+    Parameters
+    ----------
+    points: (n, 2) array
+        the lines one after the other
+    offsets: array of ints
+        where each line starts, then n
+
+    Returns
+    -------
+    importance: array of floats
+    '''
+    first = offsets[:-1]
+    last = offsets[1:] - 1
+    importance = np.zeros(len(points))
+    importance[first] = importance[last] = np.inf
+
+    #a closed line has no chord: split it at the point farthest from its start, and
+    #keep the farthest point of each half whatever its distance
+    closed = (points[first] == points[last]).all(axis=1) & (last - first >= 3)
+    seg_first = first[~closed]
+    seg_last = last[~closed]
+    forced = np.zeros(len(seg_first), dtype=bool)
+    if closed.any():
+        idx, run, starts = _runs(first[closed], last[closed])
+        d = ((points[idx] - points[first[closed]][run]) ** 2).sum(axis=1)
+        far = idx[_run_argmax(d, run, starts)]
+        importance[far] = np.inf
+        seg_first = np.concatenate([seg_first, first[closed], far])
+        seg_last = np.concatenate([seg_last, far, last[closed]])
+        forced = np.concatenate([forced, np.ones(2 * len(far), dtype=bool)])
+    caps = np.full(len(seg_first), np.inf)
+
+    while True:
+        inner = seg_last - seg_first >= 2
+        seg_first, seg_last, caps, forced = seg_first[inner], seg_last[inner], caps[inner], forced[inner]
+        if not len(seg_first):
+            break
+
+        idx, run, starts = _runs(seg_first + 1, seg_last - 1)
+        start = points[seg_first][run]
+        chord = points[seg_last][run] - start
+        offset = points[idx] - start
+        length = np.hypot(chord[:, 0], chord[:, 1])
+        d = np.where(length > 0,
+                     np.abs(chord[:, 0] * offset[:, 1] - chord[:, 1] * offset[:, 0]) / np.where(length > 0, length, 1),
+                     np.hypot(offset[:, 0], offset[:, 1]))
+
+        pick = _run_argmax(d, run, starts)
+        split = idx[pick]
+        #a point is only kept when the point it was split from is, so its importance
+        #is at most that point's
+        value = np.where(forced, np.inf, np.minimum(d[pick], caps))
+        importance[split] = value
+
+        seg_first = np.concatenate([seg_first, split])
+        seg_last = np.concatenate([split, seg_last])
+        caps = np.concatenate([value, value])
+        forced = np.zeros(len(seg_first), dtype=bool)
+
+    return importance
+
+
+def encode_level(topology, zoom, points, offsets, importance, sizes, key=ZIP_KEY):
+    '''Topojson topology of the zipcodes simplified for zoom, with only the arcs used
+
+    Parameters
+    ----------
+    points, offsets: arrays
+        the arcs of topology, from Topology.flat
+    importance: array of floats
+        from presimplify
+    sizes: dict
+        ring sizes from Topology.ring_sizes
+    '''
+    tolerance = pixel_degrees(zoom)
+
+    geometries = []
+    used = {}
+    for zipcode in sorted(topology.shapes):
+        shape = topology.shapes[zipcode]
+        size = sizes[zipcode]
+
+        #rings smaller than a pixel are dropped, but the largest polygon is kept
+        #whatever its size, so every zipcode is drawn
+        largest = int(np.argmax([s[0] for s in size]))
+        kept = [[ring for ring, s in zip(polygon, size[i]) if s >= tolerance or ring is polygon[0]]
+                for i, polygon in enumerate(shape) if i == largest or size[i][0] >= tolerance]
+
+        arcs = [[[_renumber(arc_id, used) for arc_id in ring] for ring in polygon] for polygon in kept]
+        geometry = {'id' : zipcode, 'properties' : {key : zipcode}}
+        if len(arcs) == 1:
+            geometry.update(type='Polygon', arcs=arcs[0])
+        else:
+            geometry.update(type='MultiPolygon', arcs=arcs)
+        geometries.append(geometry)
+
+    #delta-encode the kept points of every arc, all arcs at once
+    keep = importance > tolerance
+    arc_of = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))[keep]
+    q = points[keep]
+    deltas = np.vstack([q[:1], np.diff(q, axis=0)])
+    starts = np.searchsorted(arc_of, np.arange(len(offsets)))
+    deltas[starts[:-1]] = q[starts[:-1]]
+    deltas = deltas.tolist()
+
+    arcs = [None] * len(used)
+    for arc_id, new_id in used.items():
+        arcs[new_id] = deltas[starts[arc_id]:starts[arc_id + 1]]
+
+    return {'type' : 'Topology',
+            'transform' : topology.transform,
+            'arcs' : arcs,
+            'objects' : {'zips' : {'type' : 'GeometryCollection', 'geometries' : geometries}}}
+
+
+def _renumber(arc_id, used):
+    #index of arc_id among the arcs used at this level, keeping its direction
+    i = ~arc_id if arc_id < 0 else arc_id
+    if i not in used:
+        used[i] = len(used)
+    return ~used[i] if arc_id < 0 else used[i]
+
+
+@stage('simplify_shapes')
+def write_shapes(features, outdir, zooms=ZOOMS, quantization=QUANTIZATION, key=ZIP_KEY):
+    '''Write the index and the simplified topology for every zoom level
+
+    Parameters
+    ----------
+    features: dict
+        zipcode to geojson geometry, as from read_features
+    outdir: string
+        directory the zip_shapes directory is written in, ending with a slash
+    zooms: list of ints
+        web map zoom levels to simplify for
+    quantization: int
+        grid points along each axis
+
+    Returns
+    -------
+    sizes: pandas series
+        bytes written for each zoom level
+    '''
+    topology = Topology.from_features(features, quantization)
+    points, offsets = topology.flat()
+    importance = presimplify(points * topology.transform['scale'], offsets)
+    ring_sizes = topology.ring_sizes(offsets, points)
+
+    path = outdir + SHAPES_DIR
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    sizes = {}
+    for zoom in sorted(zooms):
+        level = encode_level(topology, zoom, points, offsets, importance, ring_sizes, key)
+        sizes[zoom] = _write_json(level, path + zoom_file(zoom))
+
+    index = {'key' : key,
+             'zooms' : sorted(zooms),
+             'transform' : topology.transform,
+             'bboxes' : topology.bboxes(offsets, points)}
+    _write_json(index, path + INDEX_FILE)
+
+    return pd.Series(sizes, name='bytes')
+
+
+def _write_json(value, path):
+    #compact json, replaced atomically so the dashboard never reads a partial file
+    text = json.dumps(value, separators=(',', ':'))
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.rename(tmp, path)
+    return len(text)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='simplify zipcode shapes for the dashboard maps')
+    parser.add_argument('--geojson', required=True, help='census ZCTA geojson')
+    parser.add_argument('--zip-summary', help='pickled zip_summary table; only its zipcodes are kept')
+    parser.add_argument('--outdir', default='', help='the dashboard static data directory, ending with a slash')
+    parser.add_argument('--zooms', type=int, nargs='+', default=ZOOMS)
+    parser.add_argument('--quantization', type=int, default=QUANTIZATION)
+    args = parser.parse_args()
+
+    zipcodes = None
+    if args.zip_summary:
+        zipcodes = pd.read_pickle(args.zip_summary)['zipcodes'].dropna()
+
+    features = read_features(args.geojson, zipcodes)
+    print(write_shapes(features, args.outdir, zooms=args.zooms, quantization=args.quantization))
@@ -0,0 +1,44 @@
+# coding: utf-8
+
+'''Columnar on-disk storage for the dataprep tables
+
+The format is implemented once, in dashboard/webapp/storage.py, which the dashboard
+reads the tables with. That file is loaded here on its own, without importing the
+webapp package (and flask) with it, and its functions are re-exported for the
+pipeline: write_table, read_table, read_column, read_meta, migrate_pickle,
+table_dir, new_version and publish_version for other versioned directories, and
+zip_label and zip_labels, which every table keys zipcodes with.
+'''
+
+import importlib.util
+import os
+import sys
+
+
+_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'dashboard', 'webapp', 'storage.py')
+_NAME = '_webapp_storage'
+
+if _NAME not in sys.modules:
+    _spec = importlib.util.spec_from_file_location(_NAME, _PATH)
+    _module = importlib.util.module_from_spec(_spec)
+    #registered like an imported module, so it only runs once per process
+    sys.modules[_NAME] = _module
+    _spec.loader.exec_module(_module)
+_module = sys.modules[_NAME]
+
+FORMAT_VERSION = _module.FORMAT_VERSION
+META_FILE = _module.META_FILE
+INDEX_KEY = _module.INDEX_KEY
+POINTER_FILE = _module.POINTER_FILE
+
+write_table = _module.write_table
+migrate_pickle = _module.migrate_pickle
+read_meta = _module.read_meta
+read_column = _module.read_column
+read_table = _module.read_table
+zip_label = _module.zip_label
+zip_labels = _module.zip_labels
+table_dir = _module.table_dir
+new_version = _module.new_version
+publish_version = _module.publish_version
+MappedTable = _module.MappedTable
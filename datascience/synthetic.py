@@ -0,0 +1,132 @@
+# coding: utf-8
+
+'''Synthetic order and submission exports for testing and benchmarking the pipeline
+
+The real move loot exports are private, so this makes json files with the same
+columns rep_by_zip reads (UTC timestamp strings, zipcode, zipcode_tier and the
+value in cents), at any scale. Zipcodes are drawn with a long-tailed popularity,
+days with a weekly pattern and a slow trend, and hours around business hours, so
+the count tables, heatmaps and regressions built from them look like the real ones.
+'''
+
+import numpy as np
+import pandas as pd
+
+
+#columns of each export, besides zipcode and zipcode_tier
+EXPORTS = {'orders' : ('delivery_date', 'total_cents'),
+           'submissions' : ('pickup_date', 'total_submission_value_cents')}
+
+#relative volume by day of week (monday first) and by local hour of day
+DAY_WEIGHTS = np.array([1.0, 1.1, 1.1, 1.0, 1.2, 1.4, 0.9])
+HOUR_WEIGHTS = np.array([0, 0, 0, 0, 0, 0, 0.2, 1, 3, 4, 4, 4, 3, 3, 4, 4, 3, 2, 1, 0.5, 0.2, 0, 0, 0])
+
+#hours added to pacific time to get UTC. close enough for synthetic data
+UTC_OFFSET_HOURS = 8
+
+
+def make_zipcodes(n_zips):
+    '''n_zips distinct 5 digit zipcodes, ending at san francisco's 941xx
+    '''
+    first = max(10001, 94102 - n_zips)
+    return first + np.arange(n_zips)
+
+
+def make_events(n_events, zipcodes, kind='orders', start='2015-01-01', end='2015-07-31', seed=0):
+    '''Make a table of events shaped like a move loot export
+
+    Parameters
+    ----------
+    n_events: int
+        number of rows
+    zipcodes: array of ints
+        zipcodes to spread the events over, from make_zipcodes
+    kind: string
+        'orders' or 'submissions'
+    start, end: strings
+        first and last local day of events
+    seed: int
+
+    Returns
+    -------
+    tbl: pandas dataframe
+        with the export's date column and 'created_at' as UTC timestamp strings,
+        'zipcode', 'zipcode_tier' and the export's value column in cents
+    '''
+    datecol, valuecol = EXPORTS[kind]
+    rs = np.random.RandomState(seed)
+    n_zips = len(zipcodes)
+
+    #long-tailed zipcode popularity, in random order so it isn't tied to the number
+    popularity = 1. / np.arange(1, n_zips + 1) ** 0.8
+    popularity = popularity[rs.permutation(n_zips)]
+    zip_ix = rs.choice(n_zips, n_events, p=popularity / popularity.sum())
+
+    days = pd.date_range(start, end, freq='D')
+    day_weights = DAY_WEIGHTS[days.dayofweek] * np.linspace(1., 1.5, len(days))
+    day_ix = rs.choice(len(days), n_events, p=day_weights / day_weights.sum())
+    hours = rs.choice(24, n_events, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum())
+
+    local = (days.values.astype('datetime64[s]')[day_ix]
+             + (hours * 3600 + rs.randint(0, 3600, n_events)).astype('timedelta64[s]'))
+    stamps = local + np.timedelta64(UTC_OFFSET_HOURS, 'h')
+    created = stamps - rs.randint(3600, 14 * 24 * 3600, n_events).astype('timedelta64[s]')
+
+    tiers = rs.randint(1, 4, n_zips)
+
+    tbl = pd.DataFrame({datecol : np.datetime_as_string(stamps, unit='s').astype(object),
+                        'created_at' : np.datetime_as_string(created, unit='s').astype(object),
+                        'zipcode' : zipcodes[zip_ix],
+                        'zipcode_tier' : tiers[zip_ix],
+                        valuecol : np.round(rs.lognormal(9., 0.8, n_events)).astype(np.int64)})
+
+    return tbl
+
+
+def write_events(tbl, path, chunksize=1000000):
+    '''Save tbl as a json list of records, like the exports, a chunk at a time so
+    large tables don't need a second copy as one string
+    '''
+    with open(path, 'w') as f:
+        f.write('[')
+        for i, start in enumerate(range(0, len(tbl), chunksize)):
+            chunk = tbl.iloc[start:start + chunksize].to_json(orient='records')
+            if i > 0:
+                f.write(',')
+            f.write(chunk[1:-1])
+        f.write(']')
+
+    return path
+
+
+def make_zip_summary(zipcodes, n_clusters=20, seed=0):
+    '''zip_summary table with a cluster and a city for each zipcode, zipcodes as
+    strings, as read by summarize_by_zip_dataframe and region_hierarchy
+    '''
+    rs = np.random.RandomState(seed)
+    cities = np.array(['sanfrancisco', 'oakland', 'sanjose', 'peninsula'])
+
+    return pd.DataFrame({'zipcodes' : np.asarray(zipcodes).astype(str),
+                         'classifier_label_edited' : rs.randint(0, n_clusters, len(zipcodes)),
+                         'city' : cities[rs.randint(0, len(cities), len(zipcodes))]})
+
+
+def make_dataset(outdir, n_events, n_zips, start='2015-01-01', end='2015-07-31', seed=0):
+    '''Write a full set of synthetic inputs to outdir: orders.json and submissions.json
+    with n_events between them, and zip_summary.pkl
+
+    Returns
+    -------
+    paths: dict
+        'orders', 'submissions' and 'zip_summary' file paths
+    '''
+    zipcodes = make_zipcodes(n_zips)
+    paths = {}
+    for i, kind in enumerate(sorted(EXPORTS)):
+        tbl = make_events(n_events // 2, zipcodes, kind=kind, start=start, end=end, seed=seed + i)
+        paths[kind] = write_events(tbl, outdir + kind + '.json')
+
+    paths['zip_summary'] = outdir + 'zip_summary.pkl'
+    make_zip_summary(zipcodes, seed=seed).to_pickle(paths['zip_summary'])
+
+    return paths
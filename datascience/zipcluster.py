@@ -0,0 +1,492 @@
+# coding: utf-8
+
+'''Cluster zipcodes into regions with mini-batch k-means
+
+The regions in the dashboard came from k-means on each zipcode's whitened latitude,
+longitude and travel cost (maps/mapping.ipynb), which was fine for the ~200 bay
+area zipcodes. This does the same for any number of zipcodes and cities:
+
+- several k-means++ starts, each on its own sample and seed, run in parallel and
+  the one with the lowest inertia on a common sample is kept
+- the centers are then refined with mini-batch updates (Sculley, 2010), so the
+  cost of a pass doesn't grow with the number of zipcodes
+- the fitted centers and feature scaling are saved, so zipcodes added later are
+  assigned to the existing clusters without refitting (--assign-only), or update
+  the restored centers with partial_fit first (--update)
+
+Results only depend on the seed, not on the number of workers. The zipcode to
+cluster lookup is saved as a table (storage.write_table) at outdir + 'zip_clusters',
+and as the region hierarchy dataprep.write_region_rollups and the dashboard read.
+
+    python zipcluster.py --zip-summary zip_summary.pkl --outdir ../dashboard/ --clusters 12
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from instrument import stage
+from storage import read_column, write_table, zip_label, zip_labels
+
+
+#zip_summary columns clustered on, as in the notebook
+FEATURES = ['lats', 'lngs', 'travel_cost']
+
+LOOKUP_TABLE = 'zip_clusters'
+MODEL_FILE = 'zip_clusters_model.json'
+
+
+def squared_distances(X, centers):
+    '''Squared euclidean distance from every row of X to every center
+    '''
+    d = (X ** 2).sum(axis=1)[:, None] - 2 * X.dot(centers.T) + (centers ** 2).sum(axis=1)[None, :]
+    return np.maximum(d, 0)
+
+
+def nearest(X, centers, chunksize=65536):
+    '''Closest center of every row of X, and the squared distance to it, a chunk of
+    rows at a time to bound memory
+
+    Returns
+    -------
+    labels: array of ints
+    distances: array of floats
+    '''
+    labels = np.empty(len(X), dtype=np.int32)
+    distances = np.empty(len(X))
+    for start in range(0, len(X), chunksize):
+        d = squared_distances(X[start:start + chunksize], centers)
+        labels[start:start + chunksize] = d.argmin(axis=1)
+        distances[start:start + chunksize] = d[np.arange(len(d)), labels[start:start + chunksize]]
+
+    return labels, distances
+
+
+def center_sums(X, labels, n_clusters):
+    '''Number of rows and sum of rows assigned to each center
+    '''
+    counts = np.bincount(labels, minlength=n_clusters).astype(float)
+    sums = np.column_stack([np.bincount(labels, weights=X[:, i], minlength=n_clusters)
+                            for i in range(X.shape[1])])
+    return counts, sums
+
+
+def kmeans_plusplus(X, n_clusters, rs):
+    '''k-means++ seeding, with 2 + log(k) candidates tried for each center and the
+    one that lowers the total squared distance most kept, as sklearn does
+    '''
+    n = len(X)
+    trials = 2 + int(np.log(n_clusters))
+
+    centers = np.empty((n_clusters, X.shape[1]))
+    centers[0] = X[rs.randint(n)]
+    closest = ((X - centers[0]) ** 2).sum(axis=1)
+
+    for c in range(1, n_clusters):
+        total = closest.sum()
+        if total > 0:
+            candidates = np.searchsorted(np.cumsum(closest), rs.random_sample(trials) * total)
+        else:
+            candidates = rs.randint(n, size=trials)
+        candidates = np.minimum(candidates, n - 1)
+
+        d = np.minimum(closest[:, None], squared_distances(X, X[candidates]))
+        best = int(d.sum(axis=0).argmin())
+        centers[c] = X[candidates[best]]
+        closest = d[:, best]
+
+    return centers
+
+
+def lloyd(X, centers, n_iter):
+    '''A few full k-means iterations. centers nobody is closest to stay where they are
+    '''
+    centers = centers.copy()
+    for _ in range(n_iter):
+        labels = nearest(X, centers)[0]
+        counts, sums = center_sums(X, labels, len(centers))
+        used = counts > 0
+        centers[used] = sums[used] / counts[used, None]
+
+    return centers
+
+
+def _start(X_init, X_valid, n_clusters, seed, n_iter):
+    #one seeded start: k-means++ and a few lloyd iterations on its own sample, scored
+    #on the sample shared by every start
+    centers = lloyd(X_init, kmeans_plusplus(X_init, n_clusters, np.random.RandomState(seed)), n_iter)
+    return nearest(X_valid, centers)[1].sum(), centers
+
+
+class MiniBatchKMeans(object):
+    '''k-means with parallel multi-start k-means++ initialization and mini-batch
+    center updates
+
+    Parameters
+    ----------
+    n_clusters: int
+    batch_size: int
+        rows per mini-batch update
+    max_iter: int
+        most passes over the data, counted in batches of batch_size
+    n_init: int
+        number of k-means++ starts
+    init_size: int
+        rows sampled for each start. default 3 * batch_size, at least 10 * n_clusters
+    tol: float
+        stop once the centers move less than tol times the data's mean variance, for
+        a pass worth of batches in a row
+    seed: int
+    workers: int
+        processes running the starts. default one per cpu
+    '''
+
+    def __init__(self, n_clusters=8, batch_size=1024, max_iter=100, n_init=8, init_size=None,
+                 tol=1e-4, seed=0, workers=None):
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+        self.max_iter = max_iter
+        self.n_init = n_init
+        self.init_size = init_size
+        self.tol = tol
+        self.seed = seed
+        self.workers = workers
+        self.cluster_centers_ = None
+        self.counts_ = None
+        self.n_steps_ = 0
+
+    @classmethod
+    def from_model(cls, model, **params):
+        '''Restore the centers and the rows each has seen from a model saved by
+        cluster_zipcodes, so partial_fit carries on where the fit stopped
+
+        Parameters
+        ----------
+        model: dict
+            from cluster_zipcodes or load_model
+        params:
+            passed on to MiniBatchKMeans, eg. batch_size
+        '''
+        if 'counts' not in model:
+            raise ValueError('The model has no center counts to update, refit it')
+        centers = np.array(model['centers'], dtype=float)
+        kmeans = cls(n_clusters=len(centers), seed=model.get('seed', 0), **params)
+        kmeans.cluster_centers_ = centers
+        kmeans.counts_ = np.array(model['counts'], dtype=float)
+
+        return kmeans
+
+    def _init_centers(self, X, rs):
+        n = len(X)
+        init_size = min(n, self.init_size or max(3 * self.batch_size, 10 * self.n_clusters))
+        if n < self.n_clusters:
+            raise ValueError('%d rows is fewer than %d clusters' % (n, self.n_clusters))
+
+        seeds = rs.randint(0, 2 ** 31 - 1, size=self.n_init)
+        samples = [X[np.random.RandomState(seed).choice(n, init_size, replace=False)] for seed in seeds]
+        X_valid = X[rs.choice(n, init_size, replace=False)]
+        args = [(sample, X_valid, self.n_clusters, seed, 3) for sample, seed in zip(samples, seeds)]
+
+        workers = min(self.workers or os.cpu_count() or 1, self.n_init)
+        if workers == 1:
+            starts = [_start(*arg) for arg in args]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                starts = list(executor.map(_start, *zip(*args)))
+
+        #ties go to the earlier start, so the choice doesn't depend on the workers
+        best = int(np.argmin([inertia for inertia, centers in starts]))
+        self.cluster_centers_ = starts[best][1]
+        self.counts_ = np.zeros(self.n_clusters)
+
+    def _update(self, X):
+        '''One mini-batch step. each center moves toward the mean of its batch rows
+        with a step of its batch count over all the rows it has seen
+
+        Returns
+        -------
+        shift: float
+            largest squared distance a center moved
+        '''
+        labels = nearest(X, self.cluster_centers_)[0]
+        counts, sums = center_sums(X, labels, self.n_clusters)
+        used = counts > 0
+
+        self.counts_ += counts
+        old = self.cluster_centers_[used].copy()
+        self.cluster_centers_[used] += ((sums[used] - counts[used, None] * old)
+                                        / self.counts_[used, None])
+        self.n_steps_ += 1
+
+        return ((self.cluster_centers_[used] - old) ** 2).sum(axis=1).max()
+
+    def fit(self, X):
+        '''Initialize the centers from X and refine them with mini-batches of X
+
+        Returns
+        -------
+        self
+        '''
+        X = np.asarray(X, dtype=float)
+        rs = np.random.RandomState(self.seed)
+        self._init_centers(X, rs)
+
+        n = len(X)
+        steps_per_pass = max(1, int(np.ceil(n / float(self.batch_size))))
+        tol = self.tol * X.var(axis=0).mean()
+        quiet = 0
+        for step in range(self.max_iter * steps_per_pass):
+            shift = self._update(X[rs.randint(0, n, size=min(self.batch_size, n))])
+            quiet = quiet + 1 if shift <= tol else 0
+            if quiet >= steps_per_pass:
+                break
+
+        self.labels_, distances = nearest(X, self.cluster_centers_)
+        self.inertia_ = distances.sum()
+
+        return self
+
+    def partial_fit(self, X):
+        '''Update the centers with one more batch, eg. newly added zipcodes. the first
+        call initializes the centers from X
+        '''
+        X = np.asarray(X, dtype=float)
+        if self.cluster_centers_ is None:
+            self._init_centers(X, np.random.RandomState(self.seed))
+        self._update(X)
+
+        return self
+
+    def predict(self, X):
+        '''Closest cluster of every row, without changing the centers
+        '''
+        return nearest(np.asarray(X, dtype=float), self.cluster_centers_)[0]
+
+
+def cluster_features(zip_summary, columns=FEATURES, scale=None):
+    '''Feature matrix of the zipcodes that have every feature, whitened like
+    scipy.cluster.vq.whiten
+
+    Parameters
+    ----------
+    zip_summary: pandas dataframe
+        one row per zipcode
+    columns: list of strings
+        columns of zip_summary to cluster on
+    scale: array
+        divide each column by this instead of its standard deviation, to put new
+        zipcodes on the scale a model was fitted with
+
+    Returns
+    -------
+    X: array
+        whitened features of the complete rows
+    complete: array of bools
+        rows of zip_summary that are in X
+    scale: array
+    '''
+    values = zip_summary[list(columns)].values.astype(float)
+    complete = ~np.isnan(values).any(axis=1)
+    values = values[complete]
+
+    if scale is None:
+        scale = values.std(axis=0)
+        scale[scale == 0] = 1.
+
+    return values / scale, complete, np.asarray(scale, dtype=float)
+
+
+def _by_size(model, labels):
+    #renumber clusters by decreasing size, so labels are readable and repeatable
+    order = np.argsort(-np.bincount(labels, minlength=model.n_clusters), kind='mergesort')
+    model.cluster_centers_ = model.cluster_centers_[order]
+    model.counts_ = model.counts_[order]
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order))
+    return rank[labels]
+
+
+@stage('cluster_zipcodes')
+def cluster_zipcodes(zip_summary, n_clusters, columns=FEATURES, seed=0, workers=None, **params):
+    '''Cluster every zipcode of zip_summary on columns
+
+    Parameters
+    ----------
+    zip_summary: pandas dataframe
+        one row per zipcode in column 'zipcodes', with the columns to cluster on
+    n_clusters: int
+    columns: list of strings
+    seed: int
+    workers: int
+        processes for the k-means++ starts
+    params:
+        passed on to MiniBatchKMeans
+
+    Returns
+    -------
+    labels: pandas series
+        cluster of each zipcode, indexed like zip_summary. NaN where a zipcode is
+        missing a feature (not geocoded, say)
+    model: dict
+        'columns', 'scale' and 'centers', for assign_zipcodes and save_model
+    '''
+    X, complete, scale = cluster_features(zip_summary, columns)
+
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, seed=seed, workers=workers, **params).fit(X)
+
+    labels = pd.Series(np.nan, index=zip_summary.index)
+    labels[complete] = _by_size(kmeans, kmeans.labels_)
+    model = {'columns' : list(columns),
+             'scale' : scale.tolist(),
+             'centers' : kmeans.cluster_centers_.tolist(),
+             'counts' : kmeans.counts_.tolist(),
+             'inertia' : float(kmeans.inertia_),
+             'seed' : seed}
+
+    return labels, model
+
+
+def assign_zipcodes(zip_summary, model):
+    '''Clusters of zipcodes under an already fitted model, without refitting
+
+    Returns
+    -------
+    labels: pandas series
+        as from cluster_zipcodes
+    '''
+    X, complete, scale = cluster_features(zip_summary, model['columns'], scale=model['scale'])
+
+    labels = pd.Series(np.nan, index=zip_summary.index)
+    labels[complete] = nearest(X, np.asarray(model['centers']))[0]
+
+    return labels
+
+
+@stage('update_clusters')
+def update_clusters(zip_summary, model, known=(), batch_size=1024):
+    '''Move the centers of a fitted model toward the zipcodes it has not seen, with
+    mini-batch updates, then assign every zipcode. cluster numbers stay the same
+
+    Parameters
+    ----------
+    zip_summary: pandas dataframe
+        one row per zipcode in column 'zipcodes', with the model's columns
+    model: dict
+        from cluster_zipcodes or load_model
+    known: collection
+        zipcodes the model was already fitted or updated with, left out of the update.
+        compared as storage.zip_label writes them
+    batch_size: int
+        rows per mini-batch update
+
+    Returns
+    -------
+    labels: pandas series
+        as from cluster_zipcodes
+    model: dict
+        the model with the updated centers and counts
+    '''
+    X, complete, scale = cluster_features(zip_summary, model['columns'], scale=model['scale'])
+    known = set(zip_label(zipcode) for zipcode in known)
+    new = ~pd.Series(zip_labels(zip_summary['zipcodes'])).isin(known).values[complete]
+
+    kmeans = MiniBatchKMeans.from_model(model, batch_size=batch_size)
+    X_new = X[new]
+    for start in range(0, len(X_new), batch_size):
+        kmeans.partial_fit(X_new[start:start + batch_size])
+
+    labels = pd.Series(np.nan, index=zip_summary.index)
+    assigned, distances = nearest(X, kmeans.cluster_centers_)
+    labels[complete] = assigned
+    model = dict(model,
+                 centers=kmeans.cluster_centers_.tolist(),
+                 counts=kmeans.counts_.tolist(),
+                 inertia=float(distances.sum()))
+
+    return labels, model
+
+
+def save_model(model, path):
+    with open(path, 'w') as f:
+        json.dump(model, f, indent=2)
+    return path
+
+
+def load_model(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def lookup_table(zip_summary, labels, city_col='city'):
+    '''Compact zipcode to cluster table: 'zipcode' as storage.zip_label writes it,
+    int16 'cluster' (-1 where there is no label) and 'city' when zip_summary has
+    one, null where it is missing
+    '''
+    lookup = pd.DataFrame({'zipcode' : zip_labels(zip_summary['zipcodes']),
+                           'cluster' : labels.fillna(-1).values.astype(np.int16)})
+    if city_col in zip_summary.columns:
+        lookup['city'] = [None if pd.isnull(city) else str(city) for city in zip_summary[city_col]]
+
+    #in zipcode order, the table's sort key. rows without a zipcode can't be looked up
+    lookup = lookup[lookup['zipcode'].notnull()]
+    return lookup.sort_values('zipcode', kind='mergesort').reset_index(drop=True)
+
+
+def write_lookup(lookup, outdir, model=None):
+    '''Save the lookup table as outdir + 'zip_clusters', and the model next to it
+    '''
+    write_table(lookup, outdir + LOOKUP_TABLE, sort_key='zipcode')
+    if model is not None:
+        save_model(model, outdir + MODEL_FILE)
+
+    return outdir + LOOKUP_TABLE
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='cluster zipcodes into regions')
+    parser.add_argument('--zip-summary', required=True, help='pickled zip_summary table')
+    parser.add_argument('--outdir', default='', help='the dashboard data directory, ending with a slash')
+    parser.add_argument('--clusters', type=int, default=10)
+    parser.add_argument('--columns', nargs='+', default=FEATURES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--n-init', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=1024)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--assign-only', action='store_true',
+                        help='assign zipcodes to the clusters of the saved model instead of refitting')
+    parser.add_argument('--update', action='store_true',
+                        help='update the saved model with the zipcodes not in its lookup table, then assign them all')
+    args = parser.parse_args()
+
+    zip_summary = pd.read_pickle(args.zip_summary)
+    if args.assign_only:
+        model = load_model(args.outdir + MODEL_FILE)
+        labels = assign_zipcodes(zip_summary, model)
+    elif args.update:
+        known = []
+        if os.path.exists(args.outdir + LOOKUP_TABLE):
+            known = read_column(args.outdir + LOOKUP_TABLE, 'zipcode', mmap=False)
+        labels, model = update_clusters(zip_summary, load_model(args.outdir + MODEL_FILE), known=known,
+                                        batch_size=args.batch_size)
+    else:
+        labels, model = cluster_zipcodes(zip_summary, args.clusters, columns=args.columns, seed=args.seed,
+                                         workers=args.workers, n_init=args.n_init, batch_size=args.batch_size)
+
+    write_lookup(lookup_table(zip_summary, labels), args.outdir, model=model)
+
+    #roll the count tables up to the new clusters for the dashboard
+    import dataprep
+    zip_summary = zip_summary.assign(cluster=labels.values)
+    hierarchy = dataprep.region_hierarchy(zip_summary, cluster_col='cluster')
+    if os.path.exists(args.outdir + 'di_orders_allcounts'):
+        dataprep.write_region_rollups(args.outdir, hierarchy)
+    else:
+        write_table(hierarchy, args.outdir + 'region_hierarchy')
+
+    print('%d zipcodes in %d clusters, %d unassigned'
+          % (len(labels), len(model['centers']), labels.isnull().sum()))